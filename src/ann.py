@@ -0,0 +1,159 @@
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+import similarity
+
+
+class NeighborIndex(object):
+    '''
+    Approximate nearest-neighbor index over the rows of an entity matrix (users x items for UserBased).
+    Every row gets `nTables` hash keys; rows sharing a key in any table are neighbor candidates,
+    which are then scored exactly. More tables find more of the true neighbors (recall) at the cost of
+    more candidates to score; longer keys (more bits or rows per band) make the candidates fewer and more similar.
+    Subclasses compute the keys (`getKeys`) and list the block measures they approximate (`measures`).
+    '''
+    measures = ()
+
+    def __init__(self, nTables, seed = 0):
+        self.nTables = nTables
+        self.seed = seed
+        self.keys = None
+        self.reported = set()       # Names of the unsupported measures already reported by check
+
+    def supports(self, simMeasure):
+        return isinstance(similarity.getBlockMeasure(simMeasure), self.measures)
+
+    def check(self, simMeasure):
+        # Same as supports, but the first request for an unsupported measure is reported, since the exact search is used instead
+        if self.supports(simMeasure):
+            return True
+        name = similarity.getMeasureName(simMeasure)
+        if name not in self.reported:
+            self.reported.add(name)
+            print("{} does not support {}; the exact neighbor search is used.".format(type(self).__name__, name))
+        return False
+
+    def getKeys(self, X):
+        # Hash keys (len(X) x nTables, uint64) of the rows of a CSR matrix
+        raise NotImplementedError
+
+    def build(self, X):
+        X = sparse.csr_matrix(X)
+        self.nFeatures = X.shape[1]
+        self.keys = self.getKeys(X)
+        self.empty = np.diff(X.indptr) == 0        # Rows without ratings are similar to nothing
+        self.sort()
+
+    def update(self, X, rows):
+        '''
+        Recompute the keys of the given rows (and of the rows appended since the last build) after their ratings changed.
+        '''
+        X = sparse.csr_matrix(X)
+        if self.keys is None or X.shape[1] != self.nFeatures:
+            self.build(X)
+            return
+        rows = np.union1d(np.asarray(rows, dtype = np.int64), np.arange(len(self.keys), X.shape[0]))
+        self.keys = np.concatenate((self.keys, np.zeros((X.shape[0] - len(self.keys), self.nTables), dtype = np.uint64)))
+        self.empty = np.concatenate((self.empty, np.zeros(X.shape[0] - len(self.empty), dtype = bool)))
+        if len(rows) > 0:
+            self.keys[rows] = self.getKeys(X[rows])
+            self.empty[rows] = np.diff(X[rows].indptr) == 0
+        self.sort()
+
+    def sort(self):
+        # Rows sorted by key in each table, so that the rows of a bucket are found with a binary search
+        self.order = np.argsort(self.keys, axis = 0, kind = "stable")
+        self.sortedKeys = np.take_along_axis(self.keys, self.order, axis = 0)
+
+    def query(self, row):
+        '''
+        Return the candidate neighbors (row indices) of a row: the rows sharing a bucket with it in at least one table.
+        '''
+        if self.empty[row]:
+            return np.empty(0, dtype = np.int64)
+        buckets = []
+        for table in range(self.nTables):
+            key = self.keys[row, table]
+            start = np.searchsorted(self.sortedKeys[:, table], key, side = "left")
+            end = np.searchsorted(self.sortedKeys[:, table], key, side = "right")
+            buckets.append(self.order[start:end, table])
+        candidates = np.unique(np.concatenate(buckets))
+        return candidates[(candidates != row) & ~self.empty[candidates]]
+
+class HyperplaneLSH(NeighborIndex):
+    '''
+    Random-hyperplane LSH for cosine similarity (Charikar, STOC 2002).
+    Each key holds the signs of `nBits` random projections of a row, so two rows share a key
+    with probability (1 - angle / pi) ^ nBits. The projection matrix holds (# of features) x nBits x nTables floats.
+    '''
+    measures = (similarity.CosineBlock,)
+
+    def __init__(self, nTables = 16, nBits = 4, seed = 0):
+        super().__init__(nTables, seed)
+        self.nBits = min(nBits, 64)
+
+    def getKeys(self, X):
+        if getattr(self, "planes", None) is None or self.planes.shape[0] != X.shape[1]:
+            random = np.random.default_rng(self.seed)
+            self.planes = random.standard_normal((X.shape[1], self.nTables * self.nBits)).astype(np.float32)
+        signs = np.asarray(X @ self.planes) > 0
+        weights = np.left_shift(np.uint64(1), np.arange(self.nBits, dtype = np.uint64))
+        return (signs.reshape(X.shape[0], self.nTables, self.nBits) * weights).sum(axis = 2, dtype = np.uint64)
+
+class MinHashLSH(NeighborIndex):
+    '''
+    MinHash with banding for Jaccard similarity (Broder, 1997).
+    Each key combines `nRows` min-hashes of the set of rated features, so two rows share a key
+    with probability J ^ nRows, where J is their Jaccard similarity.
+    '''
+    measures = (similarity.JaccardBlock,)
+    prime = (1 << 31) - 1
+
+    def __init__(self, nTables = 32, nRows = 1, seed = 0):
+        super().__init__(nTables, seed)
+        self.nRows = nRows
+        random = np.random.default_rng(seed)
+        nHashes = nTables * nRows
+        self.a = random.integers(1, self.prime, nHashes, dtype = np.int64)
+        self.b = random.integers(0, self.prime, nHashes, dtype = np.int64)
+        self.mix = random.integers(1, 1 << 63, nRows, dtype = np.uint64) | np.uint64(1)   # Odd multipliers to combine a band
+
+    def getKeys(self, X):
+        counts = np.diff(X.indptr)
+        nonEmpty = np.flatnonzero(counts > 0)
+        features = X.indices.astype(np.int64)
+        keys = np.zeros((X.shape[0], self.nTables), dtype = np.uint64)
+        for table in range(self.nTables):
+            hashes = np.empty((X.shape[0], self.nRows), dtype = np.uint64)
+            hashes[:] = self.prime
+            for r in range(self.nRows):
+                h = table * self.nRows + r
+                values = (self.a[h] * features + self.b[h]) % self.prime
+                if len(nonEmpty) > 0:
+                    hashes[nonEmpty, r] = np.minimum.reduceat(values, X.indptr[nonEmpty]).astype(np.uint64)
+            keys[:, table] = (hashes * self.mix).sum(axis = 1, dtype = np.uint64)
+        return keys
+
+def compareWithExact(recommender, simMeasure, targets, nNeighbors = 50):
+    '''
+    Benchmark the neighbor index of a recommender against the exact search:
+    recall of the exact `nNeighbors` nearest neighbors (with positive similarities) and the time spent by both.
+    '''
+    index = recommender.neighborIndex
+    recommender.neighborIndex = None
+    start = datetime.now()
+    exact = {target: recommender.getNearestNeighbors(target, simMeasure, nNeighbors) for target in targets}
+    exactTime = (datetime.now() - start).total_seconds()
+    recommender.neighborIndex = index
+    start = datetime.now()
+    approximate = {target: recommender.getNearestNeighbors(target, simMeasure, nNeighbors) for target in targets}
+    approximateTime = (datetime.now() - start).total_seconds()
+
+    nFound = 0
+    nTotal = 0
+    for target in targets:
+        expected = {neighbor for sim, neighbor in exact[target] if sim > 0}
+        nFound += len(expected & {neighbor for sim, neighbor in approximate[target]})
+        nTotal += len(expected)
+    return {"Recall": nFound / nTotal if nTotal > 0 else 1.0, "Exact time": exactTime, "Approximate time": approximateTime}
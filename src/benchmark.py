@@ -0,0 +1,159 @@
+'''
+Benchmark of the recommenders on synthetic data.
+
+    python benchmark.py --sizes 1000x500 5000x2000 --density 0.01 --output results.json
+
+For every data size and data type, the time (and the peak memory traced by tracemalloc, in a second run) of
+loading, neighbor search with each similarity measure, model building, recommendation and k-fold validation
+is written to a JSON file, so that runs of different versions can be compared.
+'''
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+from recommender import DataType, ItemBased, UserBased
+import instrument
+import similarity
+import tool
+import validation
+
+
+def getPowerLawWeights(n, exponent, random):
+    # Zipf-like weights in a random order, so that popular entities are spread over the ID space
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return random.permutation(weights / weights.sum())
+
+def generateRatings(nUsers, nItems, density = 0.01, dataType = DataType.Explicit, exponent = 1.0, seed = 0):
+    '''
+    Generate synthetic ratings whose user activity and item popularity follow power laws (`exponent`).
+    About density * nUsers * nItems distinct (user, item) pairs are drawn.
+    Explicit ratings are integers from 1 to 5 around a per-user bias, binary ratings are 0 or 1 and unary ones are 1.
+    Output data format: (users, items, ratings) arrays of user indices, item indices and rating scores
+    '''
+    random = np.random.default_rng(seed)
+    nRatings = max(1, int(density * nUsers * nItems))
+    users = random.choice(nUsers, nRatings, p = getPowerLawWeights(nUsers, exponent, random))
+    items = random.choice(nItems, nRatings, p = getPowerLawWeights(nItems, exponent, random))
+    keys = np.unique(users.astype(np.int64) * nItems + items)
+    users, items = keys // nItems, keys % nItems
+    if dataType == DataType.Explicit:
+        bias = random.normal(3.5, 0.7, nUsers)
+        ratings = np.clip(np.rint(bias[users] + random.normal(0, 1, len(keys))), 1, 5)
+    elif dataType == DataType.Binary:
+        ratings = random.integers(0, 2, len(keys)).astype(np.float64)
+    else:
+        ratings = np.ones(len(keys))
+    return users, items, ratings
+
+def writeRatings(filePath, users, items, ratings):
+    # Write ratings in the input file format: userID \t itemID \t rating \n
+    with open(filePath, "w") as file:
+        for user, item, rating in zip(users.tolist(), items.tolist(), ratings.tolist()):
+            file.write("u{}\ti{}\t{:g}\n".format(user, item, rating))
+
+def measure(task, traceMemory = True, reset = None):
+    '''
+    Run a task and return its result, the elapsed time (seconds), the peak memory (bytes) it allocated
+    and the report of the instrumentation recorder if it is enabled (see instrument.py).
+    The memory is traced in a second run, since tracing slows the task down.
+    `reset`, if given, is called before each run (e.g. to clear the caches of a recommender),
+    so that the second run does not reuse what the first one cached.
+    '''
+    if instrument.recorder.enabled:
+        instrument.recorder.reset()
+    if reset != None:
+        reset()
+    start = time.perf_counter()
+    result = task()
+    seconds = time.perf_counter() - start
+    breakdown = instrument.recorder.report() if instrument.recorder.enabled else None
+    peakMemory = None
+    if traceMemory == True:
+        if reset != None:
+            reset()
+        tracemalloc.start()
+        task()
+        peakMemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peakMemory, breakdown
+
+def runBenchmark(nUsers, nItems, density, dataType, nTargets = 100, nFolds = 5, traceMemory = True, seed = 0):
+    '''
+    Benchmark the recommenders on one synthetic data set.
+    Return a list of results: [{"phase": ..., "seconds": ..., "peakMemory": ...}, ...]
+    With instrumentation enabled, each result also holds the time of each pipeline phase ("breakdown").
+    The caches of the recommender are cleared before every run, so no phase reuses the work of an earlier one.
+    '''
+    results = []
+    def record(phase, task, reset = None):
+        result, seconds, peakMemory, breakdown = measure(task, traceMemory, reset)
+        results.append({"phase": phase, "seconds": seconds, "peakMemory": peakMemory})
+        if breakdown != None:
+            results[-1]["breakdown"] = breakdown
+        return result
+
+    columns = generateRatings(nUsers, nItems, density, dataType, seed = seed)
+    with tempfile.TemporaryDirectory() as directory:
+        filePath = os.path.join(directory, "ratings.tsv")
+        writeRatings(filePath, *columns)
+        data = record("loadData", lambda: tool.loadData(filePath))
+
+    random = np.random.default_rng(seed)
+    users = list(data)
+    targets = [users[i] for i in random.choice(len(users), min(nTargets, len(users)), replace = False).tolist()]
+    measures = [similarity.cosine, similarity.cosine_intersection, similarity.pearson, similarity.jaccard]
+    for recommender in (UserBased(dataType), ItemBased(dataType)):
+        name = type(recommender).__name__
+        # The rating matrix of the dictionary backend is built on first use, so it is built with the data here
+        record(name + ".loadData", lambda: (recommender.loadData(data), recommender.matrix))
+        for simMeasure in measures:
+            record("{}.neighbors.{}".format(name, simMeasure.__name__),
+                   lambda: recommender.getNeighborhoods(simMeasure, 50, targets = targets if name == "UserBased" else None),
+                   recommender.clearCaches)
+        model = record(name + ".buildModel", lambda: recommender.buildModel(nNeighbors = 50), recommender.clearCaches)
+        record(name + ".Recommendation", lambda: [recommender.Recommendation(user, model = model, topN = 10) for user in targets],
+               recommender.clearCaches)
+        record(name + ".recommendBatch", lambda: recommender.recommendBatch(targets, topN = 10, model = model), recommender.clearCaches)
+        record(name + ".KFold", lambda: validation.CrossValidation().KFold(data, recommender, similarity.cosine, 50,
+                                                                           topN = 10, nFolds = nFolds))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the recommenders on synthetic data.")
+    parser.add_argument("--sizes", nargs = "+", default = ["1000x500", "5000x2000"], help = "data sizes: <# of users>x<# of items>")
+    parser.add_argument("--density", type = float, default = 0.01, help = "fraction of (user, item) pairs rated")
+    parser.add_argument("--dataTypes", nargs = "+", default = ["Unary", "Explicit"], help = "Unary, Binary or Explicit")
+    parser.add_argument("--targets", type = int, default = 100, help = "number of users to recommend to")
+    parser.add_argument("--folds", type = int, default = 5, help = "number of folds of k-fold validation")
+    parser.add_argument("--noMemory", action = "store_true", help = "do not trace the peak memory")
+    parser.add_argument("--instrument", action = "store_true", help = "record the time of each pipeline phase (see instrument.py)")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = "benchmark.json", help = "JSON file the results are written to")
+    args = parser.parse_args()
+    if args.instrument == True:
+        instrument.enable(progressInterval = float("inf"))
+
+    report = {"date": datetime.now().isoformat(), "python": platform.python_version(), "numpy": np.__version__,
+              "scipy": scipy.__version__, "machine": platform.machine(), "cpus": os.cpu_count(), "results": []}
+    for size in args.sizes:
+        nUsers, nItems = [int(n) for n in size.lower().split("x")]
+        for dataTypeName in args.dataTypes:
+            dataType = getattr(DataType, dataTypeName)
+            for result in runBenchmark(nUsers, nItems, args.density, dataType, args.targets, args.folds,
+                                       not args.noMemory, args.seed):
+                result.update({"nUsers": nUsers, "nItems": nItems, "density": args.density, "dataType": dataTypeName})
+                report["results"].append(result)
+                print("{}x{} {} {}: {:.3f}s".format(nUsers, nItems, dataTypeName, result["phase"], result["seconds"]))
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+'''
+Instrumentation of the pipeline: per-phase timers, counters, progress reports and an optional profiler.
+
+Instrumentation is disabled by default: `recorder` is a NullRecorder whose hooks do nothing,
+and hooks are placed per tile, block or call rather than per rating, so they cost next to nothing.
+    >>> import instrument
+    >>> recorder = instrument.enable(profile = ["similarity"])
+    >>> model = ubcf.buildModel(nNeighbors = 30)      # Progress and ETA of the neighbor search are printed
+    >>> recorder.printReport()
+    >>> recorder.printProfile("similarity")
+    >>> instrument.disable()
+Hooks must be looked up as `instrument.recorder`, since enable/disable replace it.
+Phases of the pipeline:
+    load                  reading rating files and loading data into a recommender
+    similarity            similarity computations (tiles of block measures, or pairs of scalar measures)
+    neighbor selection    top-K selection of neighbors
+    prediction            predicted scores of candidate items
+    sort                  ranking of candidate items
+Times are inclusive: a phase run inside another one is counted in both, but a phase run inside itself is counted once.
+Work done in worker processes (nJobs other than 1) is not recorded.
+'''
+import cProfile
+from datetime import timedelta
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class NullRecorder(object):
+    # Recorder used while instrumentation is disabled
+    enabled = False
+    nullPhase = NullPhase()
+
+    def phase(self, name):
+        return self.nullPhase
+
+    def count(self, name, n = 1):
+        pass
+
+    def track(self, iterable, total, name):
+        return iterable
+
+class Phase(object):
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.nested = False
+        self.profiler = None
+
+    def __enter__(self):
+        active = self.recorder.getActivePhases()
+        self.nested = self.name in active
+        if self.nested == False:
+            active.add(self.name)
+            self.profiler = self.recorder.startProfiler(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.nested == False:
+            seconds = time.perf_counter() - self.start
+            self.recorder.stopProfiler(self.profiler)
+            self.recorder.getActivePhases().discard(self.name)
+            self.recorder.addTime(self.name, seconds)
+        return False
+
+class Recorder(object):
+    '''
+    Accumulates the number of calls and the time of each phase, and named counters (e.g. similarity evaluations).
+    If `profile` is True (all phases) or a collection of phase names, those phases are also run under cProfile,
+    one profile per phase accumulated over its calls. Only one profiler runs at a time,
+    so a profiled phase inside another profiled phase is counted in the outer profile.
+    Progress of long loops (see track) is printed to `stream` at most every `progressInterval` seconds.
+    '''
+    enabled = True
+
+    def __init__(self, profile = None, progressInterval = 1.0, stream = None):
+        self.profile = profile
+        self.progressInterval = progressInterval
+        self.stream = stream if stream != None else sys.stdout
+        self.phases = {}            # {name: [calls, seconds]}
+        self.counters = {}          # {name: count}
+        self.profiles = {}          # {name: cProfile.Profile}
+        self.profiling = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def getActivePhases(self):
+        # Phases running in the current thread
+        if not hasattr(self.local, "active"):
+            self.local.active = set()
+        return self.local.active
+
+    def phase(self, name):
+        # Context manager timing a phase: with instrument.recorder.phase("prediction"): ...
+        return Phase(self, name)
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def startProfiler(self, name):
+        if self.profile == None or self.profile == False or (self.profile != True and name not in self.profile):
+            return None
+        with self.lock:
+            if self.profiling == True:
+                return None
+            self.profiling = True
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+        try:
+            profiler.enable()
+        except ValueError:          # Another profiler is running (e.g. the caller's own)
+            self.profiling = False
+            return None
+        return profiler
+
+    def stopProfiler(self, profiler):
+        if profiler != None:
+            profiler.disable()
+            self.profiling = False
+
+    def track(self, iterable, total, name):
+        '''
+        Yield the items of an iterable of `total` items, printing the progress and the estimated remaining time.
+        '''
+        start = time.perf_counter()
+        last = start
+        done = 0
+        for item in iterable:
+            yield item
+            done += 1
+            now = time.perf_counter()
+            if now - last >= self.progressInterval or done == total:
+                last = now
+                elapsed = now - start
+                remaining = elapsed / done * (total - done)
+                print("\t{}: {}/{} ({:.0%}), elapsed {}, ETA {}".format(name, done, total, done / max(total, 1),
+                      timedelta(seconds = round(elapsed)), timedelta(seconds = round(remaining))), file = self.stream)
+
+    def report(self):
+        # Output format: {"phases": {name: {"calls": n, "seconds": s}, ...}, "counters": {name: count, ...}}
+        with self.lock:
+            return {"phases": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.phases.items()},
+                    "counters": dict(self.counters)}
+
+    def printReport(self):
+        report = self.report()
+        print("{:<24}{:>10}{:>14}".format("Phase", "Calls", "Seconds"), file = self.stream)
+        for name, entry in sorted(report["phases"].items(), key = lambda item: -item[1]["seconds"]):
+            print("{:<24}{:>10}{:>14.3f}".format(name, entry["calls"], entry["seconds"]), file = self.stream)
+        for name, value in sorted(report["counters"].items()):
+            print("{:<24}{:>10}".format(name, value), file = self.stream)
+
+    def printProfile(self, name, limit = 20, sortKey = "cumulative"):
+        if name not in self.profiles:
+            print("No profile of {}".format(name), file = self.stream)
+            return
+        pstats.Stats(self.profiles[name], stream = self.stream).sort_stats(sortKey).print_stats(limit)
+
+    def dumpProfiles(self, directory):
+        # Write each profile to <directory>/<phase>.prof, which can be read with pstats or snakeviz
+        for name, profiler in self.profiles.items():
+            profiler.dump_stats(os.path.join(directory, name.replace(" ", "_") + ".prof"))
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+            self.profiles = {}
+
+recorder = NullRecorder()
+
+def enable(profile = None, progressInterval = 1.0, stream = None):
+    # Start recording with a new Recorder and return it
+    global recorder
+    recorder = Recorder(profile, progressInterval, stream)
+    return recorder
+
+def disable():
+    # Stop recording and return the last recorder
+    global recorder
+    previous = recorder
+    recorder = NullRecorder()
+    return previous
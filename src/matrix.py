@@ -0,0 +1,335 @@
+from collections.abc import Mapping
+from functools import lru_cache
+
+import numpy as np
+from scipy import sparse
+
+
+def prefsToColumns(prefs, dtype = np.float64):
+    '''
+    Flatten preference data {subject: {object: rating, ...}, ...} into columns in the order of the dictionaries:
+    (subjects, objects, ratings, subjectIDs, objectIDs), where subjects and objects are indices into the ID lists.
+    '''
+    subjIndex = {}
+    objIndex = {}
+    subjects, objects, ratings = [], [], []
+    for subj in prefs:
+        s = subjIndex.setdefault(subj, len(subjIndex))
+        for obj, rating in prefs[subj].items():
+            subjects.append(s)
+            objects.append(objIndex.setdefault(obj, len(objIndex)))
+            ratings.append(rating)
+    return (np.array(subjects, dtype = np.int64), np.array(objects, dtype = np.int64), np.array(ratings, dtype = dtype),
+            list(subjIndex), list(objIndex))
+
+def replaceRows(indptr, arrays, rows, newIndptr, newArrays, nRows = None):
+    '''
+    Replace rows of compressed arrays, where row i is [indptr[i], indptr[i + 1]) of each of `arrays`:
+    row rows[j] (sorted and unique) becomes [newIndptr[j], newIndptr[j + 1]) of each of `newArrays`.
+    Rows past the end are appended (empty unless replaced) up to `nRows` rows.
+    The other rows are copied in slices between the replaced ones, without being merged or sorted again.
+    Return the new indptr and arrays.
+    '''
+    rows = np.asarray(rows, dtype = np.int64)
+    nOld = len(indptr) - 1
+    if nRows == None:
+        nRows = max(nOld, int(rows[-1]) + 1 if len(rows) > 0 else 0)
+    counts = np.zeros(nRows, dtype = np.int64)
+    counts[:nOld] = np.diff(indptr)
+    counts[rows] = np.diff(newIndptr)
+    resultIndptr = np.zeros(nRows + 1, dtype = np.int64)
+    np.cumsum(counts, out = resultIndptr[1:])
+    bounds = np.concatenate((np.asarray(indptr, dtype = np.int64), np.full(nRows - nOld, indptr[-1], dtype = np.int64)))
+    pieces = [[] for array in arrays]
+    previous = 0
+    for j, row in enumerate(rows.tolist()):
+        for piece, array, newArray in zip(pieces, arrays, newArrays):
+            piece.append(array[bounds[previous]:bounds[row]])
+            piece.append(newArray[newIndptr[j]:newIndptr[j + 1]])
+        previous = row + 1
+    for piece, array in zip(pieces, arrays):
+        piece.append(array[bounds[previous]:bounds[nRows]])
+    return resultIndptr, [np.concatenate(piece).astype(array.dtype, copy = False) for piece, array in zip(pieces, arrays)]
+
+class RatingMatrix(object):
+    '''
+    Sparse storage of preference data.
+    User and item IDs are mapped to dense integer indices in order of their first appearance,
+    and ratings are stored twice: CSR by user (byUser) and CSC by item (byItem).
+    '''
+    def __init__(self, userIds, itemIds, byUser):
+        self.userIds = list(userIds)
+        self.itemIds = list(itemIds)
+        self.userIndex = {user: i for i, user in enumerate(self.userIds)}
+        self.itemIndex = {item: i for i, item in enumerate(self.itemIds)}
+        self.setStorage(byUser)
+
+    def setStorage(self, byUser):
+        self.byUser = sparse.csr_matrix(byUser, shape = (len(self.userIds), len(self.itemIds)))
+        self.byUser.sort_indices()
+        self.byItem = self.byUser.tocsc()
+        self.byItem.sort_indices()
+
+    @staticmethod
+    def toCSR(users, items, ratings, nUsers, nItems):
+        # If a (user, item) pair appears more than once, the last rating is kept.
+        users = np.asarray(users, dtype = np.int64)
+        items = np.asarray(items, dtype = np.int64)
+        ratings = np.asarray(ratings)
+        keys = users * max(nItems, 1) + items
+        keys, last = np.unique(keys[::-1], return_index = True)
+        data = ratings[::-1][last]
+        indptr = np.zeros(nUsers + 1, dtype = np.int64)
+        np.cumsum(np.bincount(keys // max(nItems, 1), minlength = nUsers), out = indptr[1:])
+        indices = keys % max(nItems, 1)
+        return sparse.csr_matrix((data, indices, indptr), shape = (nUsers, nItems))
+
+    @classmethod
+    def fromColumns(cls, users, items, ratings, userIds, itemIds):
+        '''
+        Build a rating matrix from columnar data.
+        * users, items: integer indices into `userIds` and `itemIds`
+        * ratings: rating scores
+        If a (user, item) pair appears more than once, the last rating is kept.
+        '''
+        return cls(userIds, itemIds, cls.toCSR(users, items, ratings, len(userIds), len(itemIds)))
+
+    @classmethod
+    def fromPrefs(cls, prefs, inv = False, dtype = np.float64):
+        '''
+        Build a rating matrix from preference data: {userID: {itemID: rating, ...}, ...}
+        If `inv` is True, `prefs` is regarded as preferences on items: {itemID: {userID: rating, ...}, ...}
+        '''
+        subjects, objects, ratings, subjIds, objIds = prefsToColumns(prefs, dtype)
+        if inv == False:
+            return cls.fromColumns(subjects, objects, ratings, subjIds, objIds)
+        return cls.fromColumns(objects, subjects, ratings, objIds, subjIds)
+
+    @property
+    def nUsers(self):
+        return len(self.userIds)
+
+    @property
+    def nItems(self):
+        return len(self.itemIds)
+
+    @property
+    def nnz(self):
+        return self.byUser.nnz
+
+    def getCoordinates(self, ratings):
+        # Map (userID, itemID, ...) tuples to row/column indices, appending new IDs
+        users, items = [], []
+        for entry in ratings:
+            user, item = entry[0], entry[1]
+            if user not in self.userIndex:
+                self.userIndex[user] = len(self.userIds)
+                self.userIds.append(user)
+            if item not in self.itemIndex:
+                self.itemIndex[item] = len(self.itemIds)
+                self.itemIds.append(item)
+            users.append(self.userIndex[user])
+            items.append(self.itemIndex[item])
+        return np.array(users, dtype = np.int64), np.array(items, dtype = np.int64)
+
+    def setRatings(self, ratings):
+        '''
+        Add or overwrite ratings given as [(userID, itemID, rating), ...], appending new users and items.
+        Return the indices of the users and items whose ratings changed.
+        '''
+        users, items = self.getCoordinates(ratings)
+        values = np.array([entry[2] for entry in ratings], dtype = self.byUser.dtype)
+        self.updateStorage(users, items, values)
+        return np.unique(users), np.unique(items)
+
+    def removeRatings(self, ratings):
+        '''
+        Remove ratings given as [(userID, itemID), ...]. Users and items keep their indices even if no rating is left.
+        Return the indices of the users and items whose ratings changed.
+        '''
+        ratings = [entry for entry in ratings if entry[0] in self.userIndex and entry[1] in self.itemIndex]
+        users, items = self.getCoordinates(ratings)
+        self.updateStorage(users, items)
+        return np.unique(users), np.unique(items)
+
+    def updateStorage(self, users, items, values = None):
+        '''
+        Set the ratings (users[i], items[i]) to values[i], or remove them if `values` is None.
+        Only the rows of the changed users (byUser) and the columns of the changed items (byItem) are merged again;
+        the others are copied as they are (see replaceRows).
+        '''
+        shape = (self.nUsers, self.nItems)
+        for name, rows, columns, nRows, nColumns in (("byUser", users, items, self.nUsers, self.nItems),
+                                                     ("byItem", items, users, self.nItems, self.nUsers)):
+            X = getattr(self, name)
+            changed, merged = self.mergeRows(X, rows, columns, values, nColumns)
+            indptr, (indices, data) = replaceRows(X.indptr, (X.indices, X.data), changed, merged.indptr,
+                                                  (merged.indices, merged.data), nRows)
+            X = (sparse.csr_matrix if name == "byUser" else sparse.csc_matrix)((data, indices, indptr), shape = shape)
+            X.has_sorted_indices = True
+            setattr(self, name, X)
+
+    @classmethod
+    def mergeRows(cls, X, rows, columns, values, nColumns):
+        # Changed rows of the compressed matrix X and their entries after the change, as a CSR matrix of those rows only
+        changed = np.unique(rows)
+        existing = changed[changed < len(X.indptr) - 1]
+        starts, counts = X.indptr[existing], np.diff(X.indptr)[existing]
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum(), dtype = np.int64)
+        oldRows = np.repeat(np.searchsorted(changed, existing), counts)
+        oldColumns, oldValues = X.indices[positions].astype(np.int64), X.data[positions]
+        localRows = np.searchsorted(changed, rows)
+        if values is None:
+            width = max(nColumns, 1)
+            kept = ~np.isin(oldRows * width + oldColumns, localRows * width + columns)
+            return changed, cls.toCSR(oldRows[kept], oldColumns[kept], oldValues[kept], len(changed), nColumns)
+        # New ratings come last, so they overwrite the old ones
+        return changed, cls.toCSR(np.concatenate((oldRows, localRows)), np.concatenate((oldColumns, columns)),
+                                  np.concatenate((oldValues, values)), len(changed), nColumns)
+
+    def entityMatrix(self, inv = False):
+        '''
+        Return the CSR matrix whose rows are the entities to be compared:
+        users (users x items) if `inv` is False, otherwise items (items x users).
+        '''
+        return self.byItem.T.tocsr() if inv else self.byUser
+
+    def entityIds(self, inv = False):
+        return self.itemIds if inv else self.userIds
+
+    def entityIndex(self, inv = False):
+        return self.itemIndex if inv else self.userIndex
+
+    def getRow(self, index, inv = False):
+        '''
+        Return (indices, ratings) of the given row index.
+        The row is a user if `inv` is False, otherwise an item.
+        '''
+        store = self.byItem if inv else self.byUser
+        start, end = store.indptr[index], store.indptr[index + 1]
+        return store.indices[start:end], store.data[start:end]
+
+    def getRatings(self, entity, inv = False):
+        '''
+        Return the ratings of a user (or an item if `inv` is True) in dictionary format.
+        '''
+        indices, ratings = self.getRow(self.entityIndex(inv)[entity], inv)
+        otherIds = self.entityIds(not inv)
+        return {otherIds[j]: r for j, r in zip(indices.tolist(), ratings.tolist())}
+
+    def toPrefs(self, inv = False):
+        '''
+        Return a read-only dictionary view over the matrix: {userID: {itemID: rating, ...}, ...}
+        If `inv` is True, the view is keyed by items: {itemID: {userID: rating, ...}, ...}
+        '''
+        return PrefsView(self, inv)
+
+    def toDict(self, inv = False):
+        return {entity: self.getRatings(entity, inv) for entity in self.entityIds(inv)}
+
+class Statistics(object):
+    '''
+    Per-entity statistics of ratings: count, mean and norm.
+    Entities are users if `inv` is False, otherwise items.
+    Call `update` with the rows whose ratings changed to keep the statistics valid.
+    '''
+    def __init__(self, matrix, inv = False):
+        self.matrix = matrix
+        self.inv = inv
+        self.update()
+    
+    def update(self, rows = None, matrix = None):
+        '''
+        Recompute the statistics of the given rows (all rows if not given) from `matrix` (the current one if not given).
+        New entities appended to the matrix are always computed.
+        '''
+        if matrix is not None:
+            self.matrix = matrix
+        X = self.matrix.entityMatrix(self.inv)
+        if rows is None:
+            rows = np.arange(X.shape[0])
+            self.count = np.zeros(0, dtype = np.int64)
+            self.mean = self.norm = np.zeros(0)
+        rows = np.union1d(np.asarray(rows, dtype = np.int64), np.arange(len(self.count), X.shape[0]))
+        if len(self.count) < X.shape[0]:
+            grow = X.shape[0] - len(self.count)
+            self.count = np.concatenate((self.count, np.zeros(grow, dtype = np.int64)))
+            self.mean, self.norm = [np.concatenate((values, np.zeros(grow))) for values in (self.mean, self.norm)]
+        
+        X = X[rows]
+        count = np.diff(X.indptr)
+        owners = np.repeat(np.arange(len(rows)), count)
+        sums = np.bincount(owners, weights = X.data, minlength = len(rows))
+        mean = np.divide(sums, count, out = np.zeros(len(rows)), where = count > 0)
+        self.count[rows] = count
+        self.mean[rows] = mean
+        self.norm[rows] = np.sqrt(np.bincount(owners, weights = X.data ** 2, minlength = len(rows)))
+    
+    def getCount(self, entity):
+        return int(self.count[self.matrix.entityIndex(self.inv)[entity]])
+    
+    def getMean(self, entity):
+        return float(self.mean[self.matrix.entityIndex(self.inv)[entity]])
+    
+    def getNorm(self, entity):
+        return float(self.norm[self.matrix.entityIndex(self.inv)[entity]])
+
+class InvertedIndex(object):
+    '''
+    Inverted index from features to the entities having them:
+    item -> users who rated it for user rows (`inv` is False), user -> items rated by the user for item rows.
+    The postings are the CSC/CSR arrays of the rating matrix, so nothing is copied.
+    '''
+    def __init__(self, matrix, inv = False):
+        self.matrix = matrix
+        self.inv = inv
+        self.postings = matrix.byUser if inv else matrix.byItem
+        self.popularity = np.diff(self.postings.indptr)     # Number of entities having each feature
+    
+    def getCandidates(self, row, minOverlap = 1, maxPopularity = None):
+        '''
+        Return the entities (row indices) sharing at least `minOverlap` features with the given row
+        and the numbers of their shared features.
+        Features owned by more than `maxPopularity` entities are ignored.
+        '''
+        features, ratings = self.matrix.getRow(row, self.inv)
+        if maxPopularity != None:
+            features = features[self.popularity[features] <= maxPopularity]
+        indptr, indices = self.postings.indptr, self.postings.indices
+        postings = [indices[indptr[feature]:indptr[feature + 1]] for feature in features.tolist()]
+        if len(postings) == 0:
+            return np.empty(0, dtype = np.int64), np.empty(0, dtype = np.int64)
+        candidates, overlaps = np.unique(np.concatenate(postings), return_counts = True)
+        selected = (overlaps >= max(minOverlap, 1)) & (candidates != row)
+        return candidates[selected], overlaps[selected]
+
+class PrefsView(Mapping):
+    '''
+    Compatibility view of a RatingMatrix with the nested dictionary API.
+    Each row is materialized as a dictionary when it is accessed,
+    and the most recently used rows are cached (`cacheSize`). The returned dictionaries must not be modified.
+    '''
+    def __init__(self, matrix, inv = False, cacheSize = 1024):
+        self.matrix = matrix
+        self.inv = inv
+        self.cacheSize = cacheSize
+        self.getRatings = lru_cache(maxsize = cacheSize)(self.loadRatings)
+
+    def __reduce__(self):
+        # The row cache is not pickled, so that views can be sent to worker processes
+        return (PrefsView, (self.matrix, self.inv, self.cacheSize))
+
+    def loadRatings(self, entity):
+        return self.matrix.getRatings(entity, self.inv)
+
+    def __getitem__(self, entity):
+        return self.getRatings(entity)
+
+    def __contains__(self, entity):
+        return entity in self.matrix.entityIndex(self.inv)
+
+    def __iter__(self):
+        return iter(self.matrix.entityIds(self.inv))
+
+    def __len__(self):
+        return len(self.matrix.entityIds(self.inv))
@@ -0,0 +1,350 @@
+from collections.abc import Mapping
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from matrix import replaceRows
+
+
+MAGIC = b"PYCFMDL\0"
+VERSION = 1
+QUANTIZED_VERSION = 2       # Files of quantized models, which version 1 readers cannot read
+
+# Storage of similarities for each precision (bits)
+SIMILARITY_TYPES = {32: "<f4", 16: "<u2", 8: "<u1"}
+
+def align(position):
+    # Arrays start at 8-byte boundaries so that they can be memory-mapped
+    return (position + 7) // 8 * 8
+
+def quantize(similarities, offsets, bits):
+    '''
+    Quantize the similarities of rows [offsets[i], offsets[i + 1]) to `bits`-bit codes (8 or 16).
+    Each row gets its own scale, (minimum, step) in float32, and a similarity is decoded as minimum + code * step:
+    the minimum and maximum of a row map to the first and last codes, so the error is at most half a step.
+    Codes keep the order of the similarities, but close similarities may share a code.
+    Return the codes and the scales (# of rows x 2).
+    '''
+    if bits not in (8, 16):
+        raise ValueError("Similarities can be quantized to 8 or 16 bits: {}".format(bits))
+    similarities = np.asarray(similarities, dtype = np.float32).astype(np.float64)
+    counts = np.diff(offsets)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    starts = np.asarray(offsets[:-1])[counts > 0]
+    minimums = np.zeros(len(counts), dtype = np.float32)
+    steps = np.zeros(len(counts), dtype = np.float32)
+    if len(starts) > 0:
+        lows = np.minimum.reduceat(similarities, starts)
+        minimums[counts > 0] = lows
+        steps[counts > 0] = (np.maximum.reduceat(similarities, starts) - lows) / ((1 << bits) - 1)
+    rowSteps = steps[rows].astype(np.float64)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        codes = np.where(rowSteps > 0, np.rint((similarities - minimums[rows]) / rowSteps), 0)
+    codes = np.clip(codes, 0, (1 << bits) - 1).astype(SIMILARITY_TYPES[bits])
+    return codes, np.stack((minimums, steps), axis = 1)
+
+def dequantize(codes, scales, rows):
+    # Similarities of the codes of the given rows (see quantize)
+    return scales[rows, 0].astype(np.float64) + np.asarray(codes, dtype = np.float64) * scales[rows, 1]
+
+def writeModelFile(path, ids, offsets, nEntries, neighbors, similarities, kind, measure = None, nNeighbors = None,
+                   bits = 32, scales = None):
+    '''
+    Write a model file (see NeighborModel). `neighbors` and `similarities` are the raw little-endian sections
+    (int32, and float32 or `bits`-bit codes) of `nEntries` entries, given as bytes or as binary files which are copied in chunks.
+    Quantized similarities also need their `scales` (see quantize).
+    '''
+    ids = json.dumps(ids).encode("utf-8")
+    header = {"kind": kind, "measure": measure, "nNeighbors": nNeighbors,
+              "nRows": len(offsets) - 1, "nEntries": nEntries, "idsLength": len(ids)}
+    sections = [ids, np.asarray(offsets, dtype = "<i8").tobytes(), neighbors, similarities]
+    version = VERSION
+    if bits != 32:
+        version = QUANTIZED_VERSION
+        header["bits"] = bits
+        sections.append(np.asarray(scales, dtype = "<f4").tobytes())
+    header = json.dumps(header).encode("utf-8")
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.array([version, len(header)], dtype = "<u4").tobytes())
+        file.write(header)
+        for section in sections:
+            file.write(b"\0" * (align(file.tell()) - file.tell()))
+            if isinstance(section, bytes):
+                file.write(section)
+            else:
+                section.seek(0)
+                shutil.copyfileobj(section, file)
+
+class NeighborModel(Mapping):
+    '''
+    Model of nearest neighbors stored in flat arrays:
+    * ids: entity IDs; rows and neighbors are indices into them
+    * offsets: neighbors of row i are in [offsets[i], offsets[i + 1])
+    * neighbors: neighbor indices (int32)
+    * similarities: similarities (float32), or 16/8-bit codes with a scale per row in `scales` (see quantize)
+    It is read like the dictionary models built by recommenders:
+    {user: [(similarity, neighbor), ...], ...} for UserBased and {item: {neighbor: similarity, ...}, ...} for ItemBased.
+    A neighbor takes 8 bytes with float32 similarities, 6 with 16-bit codes and 5 with 8-bit codes,
+    instead of a tuple or dictionary entry of Python objects.
+
+    File format (version 1, little-endian):
+        magic (8 bytes) | version (uint32) | header length (uint32) | header (JSON)
+        | ID dictionary (JSON list) | offsets (int64) | neighbors (int32) | similarities (float32)
+    Each section after the header starts at an 8-byte boundary. The header records the kind of recommender,
+    the similarity measure and the number of neighbors the model was built with.
+    Quantized models are written in version 2, whose header also records `bits`: similarities are uint16 or uint8 codes,
+    followed by a last section of scales (float32, # of rows x 2).
+    '''
+    def __init__(self, ids, offsets, neighbors, similarities, kind, measure = None, nNeighbors = None, scales = None):
+        self.ids = list(ids)
+        self.index = {entity: i for i, entity in enumerate(self.ids)}
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.similarities = similarities
+        self.kind = kind
+        self.measure = measure
+        self.nNeighbors = nNeighbors
+        self.scales = scales        # (minimum, step) of each row if the similarities are quantized
+        self.path = None            # File the arrays are mapped from, if loaded with `load`
+        self.mapping = None         # Cached by getMapping
+
+    @property
+    def bits(self):
+        # Precision of the similarities: 32 (float32), 16 or 8 (quantized)
+        return 32 if self.scales is None else 8 * self.similarities.dtype.itemsize
+
+    @property
+    def nbytes(self):
+        # Memory taken by the arrays (IDs excluded)
+        scales = self.scales.nbytes if self.scales is not None else 0
+        return self.offsets.nbytes + self.neighbors.nbytes + self.similarities.nbytes + scales
+
+    @classmethod
+    def fromModel(cls, model, kind, measure = None, nNeighbors = None):
+        '''
+        Convert a dictionary model into flat arrays.
+        Rows of ItemBased models are dictionaries {neighbor: similarity}, and those of UserBased models are lists [(similarity, neighbor)].
+        '''
+        index = {entity: i for i, entity in enumerate(model)}
+        offsets = np.zeros(len(model) + 1, dtype = np.int64)
+        neighbors, similarities = [], []
+        for i, entity in enumerate(model):
+            row = model[entity].items() if isinstance(model[entity], Mapping) else [(n, s) for s, n in model[entity]]
+            for neighbor, similarity in row:
+                neighbors.append(index.setdefault(neighbor, len(index)))
+                similarities.append(similarity)
+            offsets[i + 1] = len(neighbors)
+        offsets = np.concatenate((offsets, np.full(len(index) - len(model), offsets[-1])))   # Neighbors without their own rows
+        return cls(list(index), offsets, np.array(neighbors, dtype = np.int32),
+                   np.array(similarities, dtype = np.float32), kind, measure, nNeighbors)
+
+    @classmethod
+    def fromNeighborLists(cls, ids, neighborLists, kind, measure = None, nNeighbors = None, bits = 32, normalizeRow = None):
+        '''
+        Build a model from neighbor lists {row: (neighbors, similarities)} of all rows, whose neighbors are indices into `ids`,
+        without going through a dictionary model. The arrays are allocated once and filled row by row.
+        `normalizeRow`, if given, maps the similarities of each row to the values stored.
+        '''
+        offsets = np.zeros(len(ids) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum([len(neighborLists[row][0]) for row in range(len(ids))])
+        neighbors = np.empty(offsets[-1], dtype = np.int32)
+        similarities = np.empty(offsets[-1], dtype = np.float32)
+        for row in range(len(ids)):
+            rowNeighbors, rowSimilarities = neighborLists[row]
+            neighbors[offsets[row]:offsets[row + 1]] = rowNeighbors
+            similarities[offsets[row]:offsets[row + 1]] = rowSimilarities if normalizeRow == None else normalizeRow(rowSimilarities)
+        model = cls(ids, offsets, neighbors, similarities, kind, measure, nNeighbors)
+        return model if bits == 32 else model.quantize(bits)
+
+    def quantize(self, bits):
+        '''
+        Return a copy of the model whose similarities are `bits`-bit codes (8 or 16; 32 for float32) with a scale per row.
+        Rows keep their order, so ranking by similarity only changes where close similarities share a code.
+        '''
+        if bits == 32:
+            return NeighborModel(self.ids, self.offsets, self.neighbors, self.getSimilarities().astype(np.float32),
+                                 self.kind, self.measure, self.nNeighbors)
+        codes, scales = quantize(self.getSimilarities(), self.offsets, bits)
+        return NeighborModel(self.ids, self.offsets, self.neighbors, codes, self.kind, self.measure, self.nNeighbors, scales)
+
+    def updateRows(self, ids, neighborLists, rows, normalizeRow = None):
+        '''
+        Replace the given rows with neighbor lists {row: (neighbors, similarities)} as in fromNeighborLists, in place.
+        `ids` may have grown since the model was built: the new entities are appended, with empty rows unless given.
+        The other rows are copied as they are (see matrix.replaceRows), so the model is no longer mapped from its file.
+        '''
+        rows = np.unique(np.asarray(rows, dtype = np.int64))
+        if len(ids) > len(self.ids):
+            self.index.update((entity, i) for i, entity in enumerate(ids[len(self.ids):], len(self.ids)))
+            self.ids.extend(ids[len(self.ids):])
+        lists = [neighborLists[row] for row in rows.tolist()]
+        offsets = np.zeros(len(rows) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum([len(neighbors) for neighbors, similarities in lists])
+        neighbors = np.concatenate([np.empty(0, dtype = np.int32)] + [neighbors for neighbors, similarities in lists])
+        similarities = np.concatenate([np.empty(0, dtype = np.float32)]
+                                      + [similarities if normalizeRow == None else normalizeRow(similarities)
+                                         for neighbors, similarities in lists]).astype(np.float32)
+        if self.scales is not None:
+            similarities, scales = quantize(similarities, offsets, self.bits)
+            grown = np.zeros((len(self.ids), 2), dtype = np.float32)
+            grown[:len(self.scales)] = self.scales
+            grown[rows] = scales
+            self.scales = grown
+        self.offsets, (self.neighbors, self.similarities) = replaceRows(self.offsets, (self.neighbors, self.similarities), rows,
+                                                                        offsets, (neighbors, similarities), len(self.ids))
+        self.path = None
+        self.mapping = None
+
+    def getSimilarities(self):
+        # Similarities of all entries as float64, decoded if they are quantized
+        if self.scales is None:
+            return np.asarray(self.similarities, dtype = np.float64)
+        return dequantize(self.similarities, self.scales, np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets)))
+
+    def getRow(self, row):
+        # Neighbor indices and similarities of a row
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        if self.scales is None:
+            return self.neighbors[start:end], self.similarities[start:end]
+        return self.neighbors[start:end], dequantize(self.similarities[start:end], self.scales, row)
+
+    def getMapping(self, entityIndex):
+        '''
+        Indices of the model entities in `entityIndex` (e.g. RatingMatrix.itemIndex), -1 for those not in it.
+        The array of the last index given is cached, as long as no entity is added to it.
+        '''
+        key = (id(entityIndex), len(entityIndex))
+        if self.mapping == None or self.mapping[0] != key:
+            self.mapping = (key, np.array([entityIndex.get(entity, -1) for entity in self.ids], dtype = np.int64))
+        return self.mapping[1]
+
+    def __getitem__(self, entity):
+        neighbors, similarities = self.getRow(self.index[entity])
+        neighbors = [self.ids[neighbor] for neighbor in neighbors.tolist()]
+        similarities = similarities.tolist()
+        if self.kind == "ItemBased":
+            return dict(zip(neighbors, similarities))
+        return list(zip(similarities, neighbors))
+
+    def __contains__(self, entity):
+        return entity in self.index
+
+    def __reduce__(self):
+        # A model mapped from a file is pickled as its path, so other processes map the same pages instead of copying them
+        if self.path != None:
+            return (NeighborModel.load, (self.path,))
+        return (NeighborModel, (self.ids, self.offsets, self.neighbors, self.similarities, self.kind, self.measure, self.nNeighbors,
+                                self.scales))
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def toMatrix(self, entityIndex, nEntities):
+        '''
+        Return the model as a sparse matrix W, where W[i, j] is the similarity of neighbor j of entity i,
+        using the row indices of `entityIndex` (e.g. RatingMatrix.itemIndex).
+        '''
+        mapping = np.array([entityIndex[entity] for entity in self.ids], dtype = np.int64)
+        rows = np.repeat(mapping, np.diff(self.offsets))
+        return sparse.csr_matrix((self.getSimilarities(), (rows, mapping[self.neighbors])),
+                                 shape = (nEntities, nEntities))
+
+    def matches(self, kind, measure, nNeighbors, bits = 32):
+        return self.kind == kind and self.measure == measure and self.nNeighbors == nNeighbors and self.bits == bits
+
+    def save(self, path):
+        writeModelFile(path, self.ids, self.offsets, len(self.neighbors), np.asarray(self.neighbors, dtype = "<i4").tobytes(),
+                       np.asarray(self.similarities, dtype = SIMILARITY_TYPES[self.bits]).tobytes(),
+                       self.kind, self.measure, self.nNeighbors, self.bits, self.scales)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a model file. The arrays are memory-mapped read-only,
+        so processes loading the same file share its pages and nothing is copied at startup.
+        '''
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not a model file: {}".format(path))
+            version, headerLength = np.frombuffer(file.read(8), dtype = "<u4").tolist()
+            if version not in (VERSION, QUANTIZED_VERSION):
+                raise ValueError("Unsupported model file version: {}".format(version))
+            header = json.loads(file.read(headerLength).decode("utf-8"))
+            idsStart = align(file.tell())
+            file.seek(idsStart)
+            ids = json.loads(file.read(header["idsLength"]).decode("utf-8"))
+
+        nRows, nEntries = header["nRows"], header["nEntries"]
+        similarityType = np.dtype(SIMILARITY_TYPES[header.get("bits", 32)])
+        offsetsStart = align(idsStart + header["idsLength"])
+        neighborsStart = align(offsetsStart + 8 * (nRows + 1))
+        similaritiesStart = align(neighborsStart + 4 * nEntries)
+        offsets = np.memmap(path, dtype = "<i8", mode = "r", offset = offsetsStart, shape = (nRows + 1,))
+        if nEntries > 0:
+            neighbors = np.memmap(path, dtype = "<i4", mode = "r", offset = neighborsStart, shape = (nEntries,))
+            similarities = np.memmap(path, dtype = similarityType, mode = "r", offset = similaritiesStart, shape = (nEntries,))
+        else:
+            neighbors, similarities = np.empty(0, dtype = np.int32), np.empty(0, dtype = similarityType)
+        scales = None
+        if "bits" in header:
+            scalesStart = align(similaritiesStart + similarityType.itemsize * nEntries)
+            scales = np.fromfile(path, dtype = "<f4", count = 2 * nRows, offset = scalesStart).reshape(nRows, 2)
+        model = cls(ids, offsets, neighbors, similarities, header["kind"], header["measure"], header["nNeighbors"], scales)
+        model.path = path
+        return model
+
+def isModelFile(path):
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+class ModelWriter(object):
+    '''
+    Writes a model file row by row, so that the model is never held in memory.
+    Rows must be added in the order of `ids`. Neighbors and similarities are spooled to temporary files
+    in the directory of the model file, and the file is assembled by `close`; only the offsets (and scales) stay in memory.
+    With `bits` 16 or 8, each row is quantized as it is added (see quantize).
+    '''
+    def __init__(self, path, ids, kind, measure = None, nNeighbors = None, bits = 32):
+        self.path = path
+        self.ids = list(ids)
+        self.kind = kind
+        self.measure = measure
+        self.nNeighbors = nNeighbors
+        self.bits = bits
+        self.offsets = np.zeros(len(self.ids) + 1, dtype = np.int64)
+        self.scales = np.zeros((len(self.ids), 2), dtype = np.float32) if bits != 32 else None
+        self.nRows = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        self.neighbors = tempfile.TemporaryFile(dir = directory)
+        self.similarities = tempfile.TemporaryFile(dir = directory)
+
+    def addRow(self, neighbors, similarities):
+        # Neighbors are indices into `ids`
+        self.neighbors.write(np.asarray(neighbors, dtype = "<i4").tobytes())
+        if self.bits != 32:
+            similarities, self.scales[self.nRows] = quantize(similarities, [0, len(neighbors)], self.bits)
+        self.similarities.write(np.asarray(similarities, dtype = SIMILARITY_TYPES[self.bits]).tobytes())
+        self.offsets[self.nRows + 1] = self.offsets[self.nRows] + len(neighbors)
+        self.nRows += 1
+
+    def close(self):
+        try:
+            if self.nRows != len(self.ids):
+                raise ValueError("{} of {} rows were written".format(self.nRows, len(self.ids)))
+            writeModelFile(self.path, self.ids, self.offsets, int(self.offsets[-1]), self.neighbors, self.similarities,
+                           self.kind, self.measure, self.nNeighbors, self.bits, self.scales)
+        finally:
+            self.discard()
+
+    def discard(self):
+        # Remove the spooled rows without writing the model file
+        self.neighbors.close()
+        self.similarities.close()
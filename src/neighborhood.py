@@ -0,0 +1,370 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+from scipy import sparse
+import instrument
+from shared import SharedArrays, attachArray, initWorker, workerState
+from similarity import CandidatePairs, RowBlock, product, sparseProduct, withData
+
+
+def getTieRanks(ids):
+    '''
+    Rank of each ID in ascending order.
+    Neighbors with the same similarity are ordered by descending rank,
+    which is the order given by sorting (similarity, neighbor) tuples in reverse.
+    '''
+    ranks = np.arange(len(ids))
+    try:
+        order = sorted(range(len(ids)), key = ids.__getitem__)
+        ranks[order] = np.arange(len(ids))
+    except TypeError:       # IDs are not comparable with each other; fall back to the order of appearance
+        pass
+    return ranks
+
+def getBlockSizes(nRows, nColumns, rowBlockSize = None, columnBlockSize = None):
+    '''
+    Sizes of the dense similarity tiles (rows x columns) computed at once.
+    By default, a column block holds at most 64K entities and a tile holds about 4M similarities.
+    '''
+    if columnBlockSize == None:
+        columnBlockSize = min(max(nColumns, 1), 1 << 16)
+    if rowBlockSize == None:
+        rowBlockSize = max(1, (1 << 22) // columnBlockSize)
+    return min(max(nRows, 1), rowBlockSize), columnBlockSize
+
+def selectTopK(values, tieRanks, k = None):
+    '''
+    Return the positions of the k largest values (all values if k is None) in descending order.
+    Ties are broken by descending tie rank, so the selection does not depend on the order of the input.
+    '''
+    if k == 0:
+        return np.empty(0, dtype = np.int64)
+    if k != None and k < len(values):
+        kth = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= kth)      # Only a few more than k unless many values are tied
+    else:
+        candidates = np.arange(len(values))
+    order = np.lexsort((-tieRanks[candidates], -values[candidates]))
+    return candidates[order[0:k]]
+
+def addCandidatePattern(prepared, maxPopularity = None, popularity = None):
+    '''
+    Return `prepared` with the sparsity pattern used for candidate generation (`candidatePattern`),
+    which leaves out the features owned by more than `maxPopularity` entities.
+    The number of entities owning each feature is counted on `prepared` unless given (`popularity`).
+    '''
+    pattern = prepared.pattern
+    if maxPopularity != None:
+        if popularity is None:
+            popularity = np.bincount(pattern.indices, minlength = pattern.shape[1])
+        pattern = withData(pattern, (popularity[pattern.indices] <= maxPopularity).astype(np.float64))
+    return RowBlock(candidatePattern = pattern, **prepared.fields)
+
+class TopKBuffer(object):
+    '''
+    Running top-K neighbors of one row, merged with each block of candidates as it streams in.
+    The buffer never holds more than k neighbors plus one block of candidates.
+    '''
+    def __init__(self, k, tieRanks):
+        self.k = k
+        self.tieRanks = tieRanks
+        self.neighbors = np.empty(0, dtype = np.int64)
+        self.similarities = np.empty(0)
+    
+    def push(self, neighbors, similarities):
+        neighbors = np.concatenate((self.neighbors, neighbors))
+        similarities = np.concatenate((self.similarities, similarities))
+        selected = selectTopK(similarities, self.tieRanks[neighbors], self.k)
+        self.neighbors = neighbors[selected]
+        self.similarities = similarities[selected]
+
+def findNeighbors(measure, prepared, rows, nNeighbors = None, tieRanks = None, rowBlockSize = None, columnBlockSize = None,
+                  minOverlap = None):
+    '''
+    Find the nearest neighbors of the given rows among all rows of `prepared` (similarity.RowBlock),
+    computing similarities tile by tile with `measure` (similarity.BlockMeasure).
+    Only the running top-K of each row is kept while the column blocks stream in,
+    so memory grows with (# of rows) * nNeighbors plus one tile.
+    If `minOverlap` is given, only the rows sharing at least `minOverlap` features
+    (counted on `candidatePattern` if `prepared` has one, see addCandidatePattern) are neighbor candidates.
+    Yield (row, neighbors, similarities) for each row in order.
+    Neighbors are row indices sorted by descending similarity, and the row itself is excluded.
+    '''
+    rows = np.asarray(rows, dtype = np.int64)
+    nColumns = len(prepared)
+    if tieRanks is None:
+        tieRanks = np.arange(nColumns)
+    rowBlockSize, columnBlockSize = getBlockSizes(len(rows), nColumns, rowBlockSize, columnBlockSize)
+    if columnBlockSize >= nColumns:
+        columnBlocks = [(0, prepared)]
+    else:
+        columnBlocks = [(start, prepared.take(slice(start, start + columnBlockSize)))
+                        for start in range(0, nColumns, columnBlockSize)]
+    
+    for start in range(0, len(rows), rowBlockSize):
+        blockRows = rows[start:start + rowBlockSize]
+        buffers = searchBlock(measure, prepared.take(blockRows), blockRows, columnBlocks, nNeighbors, tieRanks, minOverlap)
+        for row, buffer in zip(blockRows.tolist(), buffers):
+            yield row, buffer.neighbors, buffer.similarities
+
+def findCandidatePairs(block, columns, minOverlap):
+    '''
+    CandidatePairs of two prepared blocks sharing at least `minOverlap` features
+    (counted on `candidatePattern` if the blocks have one, see addCandidatePattern).
+    '''
+    pairs = CandidatePairs(block, columns)
+    if "candidatePattern" in block.fields:
+        overlap = pairs.sample(block.candidatePattern, columns.candidatePattern)
+    else:
+        overlap = pairs.overlap()
+    pairs.select(overlap >= max(minOverlap, 1))
+    return pairs
+
+def searchBlock(measure, block, blockRows, columnBlocks, nNeighbors, tieRanks, minOverlap = None):
+    '''
+    Search the neighbors of a prepared block of rows (whose row indices are `blockRows`)
+    among column blocks [(index of the first row, RowBlock), ...], which may be streamed one at a time.
+    Without `minOverlap`, every pair is a candidate and whole tiles are computed.
+    With `minOverlap`, only the candidate pairs (see findCandidatePairs) are computed, with measure.computePairs.
+    Return the TopKBuffer of each row.
+    '''
+    blockRows = np.asarray(blockRows)
+    buffers = [TopKBuffer(nNeighbors, tieRanks) for row in blockRows]
+    for columnStart, columns in columnBlocks:
+        if minOverlap == None:
+            with instrument.recorder.phase("similarity"):
+                similarities = measure.compute(block, columns)
+            instrument.recorder.count("similarity evaluations", similarities.size)
+            columnIndices = np.arange(columnStart, columnStart + len(columns))
+            with instrument.recorder.phase("neighbor selection"):
+                for row, buffer, values in zip(blockRows.tolist(), buffers, similarities):
+                    selected = np.ones(len(values), dtype = bool)
+                    if columnStart <= row < columnStart + len(columns):
+                        selected[row - columnStart] = False
+                    buffer.push(columnIndices[selected], values[selected])
+            continue
+        
+        with instrument.recorder.phase("similarity"):
+            pairs = findCandidatePairs(block, columns, minOverlap)
+            pairs.select(blockRows[pairs.rows] != pairs.columns + columnStart)
+            similarities = measure.computePairs(block, columns, pairs)
+            rows, others = pairs.rows, pairs.columns + columnStart
+        instrument.recorder.count("similarity evaluations", len(similarities))
+        with instrument.recorder.phase("neighbor selection"):
+            bounds = np.searchsorted(rows, np.arange(len(blockRows) + 1))
+            for i in np.flatnonzero(np.diff(bounds)).tolist():
+                buffers[i].push(others[bounds[i]:bounds[i + 1]], similarities[bounds[i]:bounds[i + 1]])
+    return buffers
+
+def updateNeighbors(measure, prepared, neighborLists, changed, nNeighbors = None, tieRanks = None, minOverlap = None,
+                    previous = None):
+    '''
+    Update neighbor lists {row: (neighbors, similarities)} found by findNeighbors after the rows in `changed`
+    (including newly added rows) were modified. `previous` is (rows, pattern) of the changed rows which existed before,
+    with their sparsity pattern before the change. Only the similarities of pairs involving a changed row change, so
+    * changed rows get new neighbor lists,
+    * the other rows merge their new similarities to the changed rows into their current lists.
+    Only the rows whose lists may change are visited (see findUpdatedPairs and selectUpdatedPairs),
+    among all rows if `previous` is not given.
+    A full list that loses a changed neighbor below its former last entry may be missing an entity
+    which was not kept before; only such rows are searched again.
+    Return the rows whose neighbor lists were updated.
+    '''
+    changed = np.unique(np.asarray(changed, dtype = np.int64))
+    if tieRanks is None:
+        tieRanks = np.arange(len(prepared))
+    if len(changed) == 0:
+        return []
+    added = [row for row in changed.tolist() if row not in neighborLists]
+    for row, neighbors, similarities in findNeighbors(measure, prepared, changed, nNeighbors, tieRanks, minOverlap = minOverlap):
+        neighborLists[row] = (neighbors, similarities)
+    
+    with instrument.recorder.phase("similarity"):
+        rows, positions, values, selected = findUpdatedPairs(measure, prepared, neighborLists, changed, nNeighbors,
+                                                             minOverlap, previous, len(added) > 0)
+    updated = changed.tolist()
+    searchAgain = []
+    with instrument.recorder.phase("neighbor selection"):
+        rows, positions, values, selected = selectUpdatedPairs(neighborLists, changed, rows, positions, values, selected,
+                                                               nNeighbors, tieRanks)
+        isPaired = np.zeros(len(prepared), dtype = bool)
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(rows)) + 1, [len(rows)]))
+        for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if start == stop:
+                continue
+            row = int(rows[start])
+            others = changed[positions[start:stop]]
+            neighbors, oldSimilarities = neighborLists[row]
+            isPaired[others] = True
+            kept = ~isPaired[neighbors]
+            isPaired[others] = False
+            mergedNeighbors = np.concatenate((neighbors[kept], others[selected[start:stop]]))
+            mergedSimilarities = np.concatenate((oldSimilarities[kept], values[start:stop][selected[start:stop]]))
+            chosen = selectTopK(mergedSimilarities, tieRanks[mergedNeighbors], nNeighbors)
+            updated.append(row)
+            if nNeighbors != None and len(neighbors) >= nNeighbors and not kept.all():
+                # Entities outside of a full list rank below its last entry; the new list must not reach below it
+                boundary = (oldSimilarities[-1], tieRanks[neighbors[-1]])
+                if len(chosen) < nNeighbors or (mergedSimilarities[chosen[-1]], tieRanks[mergedNeighbors[chosen[-1]]]) < boundary:
+                    searchAgain.append(row)
+                    continue
+            neighborLists[row] = (mergedNeighbors[chosen], mergedSimilarities[chosen])
+    
+    for row, neighbors, similarities in findNeighbors(measure, prepared, searchAgain, nNeighbors, tieRanks, minOverlap = minOverlap):
+        neighborLists[row] = (neighbors, similarities)
+    return sorted(updated)
+
+def selectUpdatedPairs(neighborLists, changed, rows, positions, similarities, selected, nNeighbors, tieRanks):
+    '''
+    Pairs of findUpdatedPairs (sorted by row) of the rows whose lists change: those holding one of their changed rows,
+    and those a changed row enters, being a candidate which ranks above the last entry of the list or finds it not full.
+    The other rows keep their lists as they are, and none of their pairs is returned.
+    '''
+    uniqueRows, starts = np.unique(rows, return_index = True)
+    lists = [neighborLists[row] for row in uniqueRows.tolist()]
+    lengths = np.array([len(neighbors) for neighbors, listSimilarities in lists], dtype = np.int64)
+    neighbors = np.concatenate([np.empty(0, dtype = np.int64)] + [neighbors for neighbors, listSimilarities in lists])
+    owners = np.repeat(np.arange(len(uniqueRows)), np.diff(np.append(starts, len(rows))))
+    # Entries of the lists which are changed rows, matched with the pairs by (row, position in `changed`)
+    found = np.minimum(np.searchsorted(changed, neighbors), len(changed) - 1)
+    isChanged = changed[found] == neighbors
+    listKeys = np.repeat(np.arange(len(uniqueRows)), lengths)[isChanged] * len(changed) + found[isChanged]
+    visited = np.zeros(len(uniqueRows), dtype = bool)
+    visited[owners[np.isin(owners * len(changed) + positions, listKeys)]] = True
+    
+    ends = np.cumsum(lengths) - 1
+    lasts = np.full(len(uniqueRows), -np.inf)
+    lastRanks = np.zeros(len(uniqueRows), dtype = np.int64)
+    hasLast = lengths > 0
+    lasts[hasLast] = np.concatenate([np.empty(0)] + [listSimilarities[-1:] for neighbors, listSimilarities in lists])
+    lastRanks[hasLast] = tieRanks[neighbors[ends[hasLast]]]
+    isFull = lengths >= nNeighbors if nNeighbors != None else np.zeros(len(uniqueRows), dtype = bool)
+    rowLasts, rowLastRanks = lasts[owners], lastRanks[owners]
+    ranks = tieRanks[changed[positions]]
+    enters = selected & (~isFull[owners] | (similarities > rowLasts) | ((similarities == rowLasts) & (ranks > rowLastRanks)))
+    visited[owners[enters]] = True
+    
+    kept = visited[owners]
+    return rows[kept], positions[kept], similarities[kept], selected[kept]
+
+def findUpdatedPairs(measure, prepared, neighborLists, changed, nNeighbors, minOverlap, previous, grown):
+    '''
+    Pairs of an unchanged row and a changed row which updateNeighbors merges into the list of the unchanged row.
+    Pairs without a shared feature have similarity 0 (and are not candidates with `minOverlap`) before and after the change,
+    so the pairs sharing a feature after the change (computed with measure.computePairs) or before it (similarity 0 now)
+    are enough, except without `minOverlap`, where a new row (if the rows `grown`) of similarity 0 may enter the lists
+    which are not full or end at a similarity of 0 or less, and rows without any feature have a Jaccard similarity of -1
+    with each other. Such rows, or all rows if `previous` is not given, are compared with every changed row.
+    Return the rows, positions of the changed rows in `changed`, similarities and whether each pair is a neighbor candidate,
+    sorted by row and position.
+    '''
+    nRows = len(prepared)
+    isChanged = np.zeros(nRows, dtype = bool)
+    isChanged[changed] = True
+    changedBlock = prepared.take(changed)
+    parts = []
+    
+    if previous == None:
+        rows = np.arange(nRows)
+    elif minOverlap == None:
+        rows = np.flatnonzero(prepared.count == 0)
+        if grown:
+            rows = np.union1d(rows, np.array([row for row, (neighbors, similarities) in neighborLists.items()
+                                              if nNeighbors == None or len(neighbors) < nNeighbors or similarities[-1] <= 0],
+                                             dtype = np.int64))
+    else:
+        rows = np.empty(0, dtype = np.int64)
+    rows = rows[~isChanged[rows]]
+    rowBlockSize = getBlockSizes(len(rows), len(changed))[0]
+    for start in range(0, len(rows), rowBlockSize):
+        blockRows = rows[start:start + rowBlockSize]
+        block = prepared.take(blockRows)
+        similarities = measure.compute(block, changedBlock)
+        selected = np.ones(similarities.shape, dtype = bool)
+        if minOverlap != None:
+            pattern = "candidatePattern" if "candidatePattern" in block.fields else "pattern"
+            selected = product(block.fields[pattern], changedBlock.fields[pattern]) >= max(minOverlap, 1)
+        parts.append((np.repeat(blockRows, len(changed)), np.tile(np.arange(len(changed)), len(blockRows)),
+                      similarities.ravel(), selected.ravel()))
+    
+    pairs = CandidatePairs(changedBlock, prepared)
+    pairs.select(~isChanged[pairs.columns])
+    if minOverlap != None:
+        overlap = pairs.sample(changedBlock.candidatePattern, prepared.candidatePattern) \
+            if "candidatePattern" in prepared.fields else pairs.overlap()
+        selected = overlap >= max(minOverlap, 1)
+    else:
+        selected = np.ones(len(pairs), dtype = bool)
+    parts.append((pairs.columns, pairs.rows, measure.computePairs(changedBlock, prepared, pairs), selected))
+    
+    if previous != None and len(previous[0]) > 0:
+        oldRows, oldPattern = previous
+        oldPattern = sparse.csr_matrix((oldPattern.data, oldPattern.indices, oldPattern.indptr),
+                                       shape = (len(oldRows), prepared.pattern.shape[1]))
+        overlaps = sparseProduct(oldPattern, prepared.pattern)
+        rows = overlaps.indices.astype(np.int64)
+        positions = np.repeat(np.searchsorted(changed, oldRows), np.diff(overlaps.indptr))
+        kept = ~isChanged[rows]
+        parts.append((rows[kept], positions[kept], np.zeros(kept.sum()), np.full(kept.sum(), minOverlap == None)))
+    
+    # Pairs found more than once keep the values of the first part they appear in
+    rows, positions, similarities, selected = (np.concatenate(arrays) for arrays in zip(*parts))
+    instrument.recorder.count("similarity evaluations", len(rows))
+    keys, first = np.unique(rows * len(changed) + positions, return_index = True)
+    return rows[first], positions[first], similarities[first], selected[first]
+
+class SharedBlock(SharedArrays):
+    '''
+    Copy of a RowBlock (and the tie ranks) in shared memory.
+    Worker processes attach to the same pages by name instead of receiving a pickled copy.
+    '''
+    def __init__(self, block, tieRanks):
+        super().__init__()
+        self.spec = {}
+        for name, value in block.fields.items():
+            if sparse.issparse(value):
+                self.spec[name] = ("csr", value.shape, [self.share(value.data), self.share(value.indices), self.share(value.indptr)])
+            else:
+                self.spec[name] = ("array", value.shape, [self.share(value)])
+        self.tieRanks = self.share(tieRanks)
+
+def attachBlock(spec, tieRanks):
+    # State of a worker reading the SharedBlock of its pool (see shared.initWorker)
+    memories = []
+    fields = {}
+    for name, (kind, shape, arrays) in spec.items():
+        arrays = [attachArray(memories, *array) for array in arrays]
+        fields[name] = sparse.csr_matrix(tuple(arrays), shape = shape) if kind == "csr" else arrays[0]
+    return {"memories": memories, "prepared": RowBlock(**fields), "tieRanks": attachArray(memories, *tieRanks)}
+
+def findNeighborsInShard(rows, nNeighbors, rowBlockSize, columnBlockSize, minOverlap):
+    return list(findNeighbors(workerState["measure"], workerState["prepared"], rows, nNeighbors,
+                              workerState["tieRanks"], rowBlockSize, columnBlockSize, minOverlap))
+
+def findNeighborsParallel(measure, prepared, rows, nNeighbors = None, tieRanks = None, nJobs = -1,
+                          rowBlockSize = None, columnBlockSize = None, minOverlap = None):
+    '''
+    Parallel version of findNeighbors.
+    The rows are split into shards and each shard is processed by a pool of `nJobs` processes
+    (all CPU cores if nJobs is -1), which read the prepared data from shared memory.
+    The output is identical to that of findNeighbors, in the same order.
+    '''
+    rows = np.asarray(rows, dtype = np.int64)
+    if tieRanks is None:
+        tieRanks = np.arange(len(prepared))
+    if nJobs == None or nJobs < 1:
+        nJobs = os.cpu_count()
+    rowBlockSize, columnBlockSize = getBlockSizes(len(rows), len(prepared), rowBlockSize, columnBlockSize)
+    nShards = max(1, min(nJobs * 4, -(-len(rows) // rowBlockSize)))     # A few shards per worker to balance the load
+    
+    shared = SharedBlock(prepared, tieRanks)
+    try:
+        with ProcessPoolExecutor(max_workers = nJobs, initializer = initWorker,
+                                 initargs = ({"measure": measure}, attachBlock, shared.spec, shared.tieRanks)) as executor:
+            futures = [executor.submit(findNeighborsInShard, shard, nNeighbors, rowBlockSize, columnBlockSize, minOverlap)
+                       for shard in np.array_split(rows, nShards)]
+            for future in futures:
+                yield from future.result()
+    finally:
+        shared.release()
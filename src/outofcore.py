@@ -0,0 +1,168 @@
+'''
+Out-of-core model building for data sets whose ratings, similarity tiles or models do not fit in memory.
+
+The entity matrix (users x items for UserBased, items x users for ItemBased) is partitioned into blocks of
+`blockSize` rows saved on disk (BlockStore). The neighbors of each row block are searched against the column blocks,
+loaded one at a time, and the top-K of each row is written to the model file as soon as the row block is done.
+Memory holds the entity IDs, two blocks of ratings, one tile of blockSize x blockSize similarities
+and the top-K of one row block.
+'''
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import sparse
+import instrument
+from matrix import RatingMatrix, Statistics
+from modelfile import ModelWriter
+import neighborhood
+import similarity
+import tool
+
+
+class RowMatrix(object):
+    # Rows of an entity matrix seen as a rating matrix, for matrix.Statistics
+    def __init__(self, X):
+        self.X = X
+
+    def entityMatrix(self, inv = False):
+        return self.X
+
+class BlockStore(object):
+    '''
+    Rows of an entity matrix partitioned into blocks of `blockSize` rows, each saved as a sparse matrix in `directory`.
+    Only the entity IDs and the number of entities owning each feature (`popularity`) are kept in memory.
+    '''
+    def __init__(self, directory, ids, nFeatures, blockSize, popularity, unary = False):
+        self.directory = directory
+        self.ids = ids
+        self.nFeatures = nFeatures
+        self.blockSize = blockSize
+        self.popularity = popularity
+        self.unary = unary          # True if every rating is 1
+
+    def __len__(self):
+        # Number of blocks
+        return -(-len(self.ids) // self.blockSize)
+
+    def getStart(self, block):
+        return block * self.blockSize
+
+    def getPath(self, block):
+        return os.path.join(self.directory, "block{}.npz".format(block))
+
+    def getRows(self, block):
+        return sparse.load_npz(self.getPath(block)).tocsr()
+
+    def getPrepared(self, block, blockMeasure, maxPopularity = None):
+        # Prepared rows of a block, as getPreparedBlock of the recommenders prepares the whole entity matrix
+        X = self.getRows(block)
+        prepared = blockMeasure.prepare(X, Statistics(RowMatrix(X)))
+        return neighborhood.addCandidatePattern(prepared, maxPopularity, self.popularity)
+
+    @classmethod
+    def fromMatrix(cls, matrix, directory, blockSize, inv = False):
+        # Partition the entity matrix of a RatingMatrix
+        X = matrix.entityMatrix(inv)
+        store = cls(directory, list(matrix.entityIds(inv)), X.shape[1], blockSize,
+                    np.bincount(X.indices, minlength = X.shape[1]), bool(np.all(X.data == 1)))
+        for block in range(len(store)):
+            start = store.getStart(block)
+            sparse.save_npz(store.getPath(block), X[start:start + blockSize], compressed = False)
+        return store
+
+    @classmethod
+    def fromFile(cls, filePath, directory, blockSize, inv = False, chunkSize = 1 << 24):
+        '''
+        Partition a rating file (see tool.loadColumns for the format) without loading it.
+        The entries of each chunk of the file are appended to spill files of the blocks of their rows,
+        and each block is then converted into a sparse matrix on its own. Entities and features are indexed in order of their first appearance,
+        as tool.loadMatrix does, and the last rating of a repeated (user, item) pair is kept.
+        '''
+        rowIndex = {}
+        featureIndex = {}
+        unary = True
+        with tool.openFile(filePath) as file:
+            for chunk in tool.readChunks(file, chunkSize):
+                userTokens, itemTokens, ratings = tool.parseChunk(chunk)
+                unary = unary and bool(np.all(ratings == 1))
+                users = tool.encodeTokens(userTokens, rowIndex if inv == False else featureIndex)
+                items = tool.encodeTokens(itemTokens, featureIndex if inv == False else rowIndex)
+                rows, features = (users, items) if inv == False else (items, users)
+                blocks = rows // blockSize
+                order = np.argsort(blocks, kind = "stable")
+                bounds = np.flatnonzero(np.diff(blocks[order])) + 1
+                for part in np.split(order, bounds):
+                    if len(part) == 0:
+                        continue
+                    # The entries of the chunk are appended to the spill file of their block, which is closed again
+                    # at once, so that the number of open files does not grow with the number of blocks
+                    entries = np.empty(len(part), dtype = [("row", "<i8"), ("feature", "<i8"), ("rating", "<f8")])
+                    entries["row"], entries["feature"], entries["rating"] = rows[part], features[part], ratings[part]
+                    with open(os.path.join(directory, "spill{}.bin".format(int(blocks[part[0]]))), "ab") as spill:
+                        spill.write(entries.tobytes())
+
+        store = cls(directory, list(rowIndex), len(featureIndex), blockSize, np.zeros(len(featureIndex), dtype = np.int64), unary)
+        for block in range(len(store)):
+            spillPath = os.path.join(directory, "spill{}.bin".format(block))
+            entries = np.fromfile(spillPath, dtype = [("row", "<i8"), ("feature", "<i8"), ("rating", "<f8")])
+            start = store.getStart(block)
+            nRows = min(blockSize, len(store.ids) - start)
+            X = RatingMatrix.toCSR(entries["row"] - start, entries["feature"], entries["rating"], nRows, store.nFeatures)
+            store.popularity += np.bincount(X.indices, minlength = store.nFeatures)
+            sparse.save_npz(store.getPath(block), X, compressed = False)
+            os.remove(spillPath)
+        return store
+
+def buildModel(store, simMeasure, nNeighbors, pathDump, kind, normalizeRow = None, minOverlap = None, maxPopularity = None,
+               unary = False, bits = 32):
+    '''
+    Find the `nNeighbors` nearest neighbors of every row of a BlockStore and write them to a model file (`pathDump`).
+    `kind` is the kind of recommender recorded in the file, and `normalizeRow`, if given, maps the similarities
+    of each row to the values stored. If `unary` is True and every rating is 1, the measures for unary data are used.
+    With `bits` 16 or 8, the similarities are quantized (see modelfile.quantize).
+    The neighbors are the same as those found in memory by neighborhood.findNeighbors,
+    since similarities depend only on the two rows compared and ties are broken by ID.
+    '''
+    blockMeasure = similarity.getBlockMeasure(simMeasure, unary and store.unary)
+    if blockMeasure == None:
+        raise ValueError("Out-of-core building needs a similarity measure of similarity.py: {}".format(similarity.getMeasureName(simMeasure)))
+    if maxPopularity != None and minOverlap == None:
+        minOverlap = 1
+    tieRanks = neighborhood.getTieRanks(store.ids)
+    writer = ModelWriter(pathDump, store.ids, kind, similarity.getMeasureName(simMeasure), nNeighbors, bits)
+    try:
+        for block in instrument.recorder.track(range(len(store)), len(store), "Row blocks"):
+            prepared = store.getPrepared(block, blockMeasure, maxPopularity)
+            start = store.getStart(block)
+            rows = np.arange(start, start + len(prepared))
+            # Column blocks are loaded one at a time; the row block is reused as its own column block
+            columnBlocks = ((store.getStart(other), prepared if other == block else store.getPrepared(other, blockMeasure, maxPopularity))
+                            for other in range(len(store)))
+            buffers = neighborhood.searchBlock(blockMeasure, prepared, rows, columnBlocks, nNeighbors, tieRanks, minOverlap)
+            for buffer in buffers:
+                similarities = buffer.similarities if normalizeRow == None else normalizeRow(buffer.similarities)
+                writer.addRow(buffer.neighbors, similarities)
+    except:
+        writer.discard()
+        raise
+    writer.close()
+
+def buildModelFromData(data, simMeasure, nNeighbors, pathDump, kind, inv = False, blockSize = 2048, workDir = None,
+                       normalizeRow = None, minOverlap = None, maxPopularity = None, unary = False, bits = 32):
+    '''
+    Partition `data` (a file path of training data or a RatingMatrix) into blocks in a temporary directory
+    under `workDir` (the directory of `pathDump` by default), which is removed afterwards, and build the model file.
+    '''
+    if workDir == None:
+        workDir = os.path.dirname(os.path.abspath(pathDump))
+    directory = tempfile.mkdtemp(prefix = "blocks", dir = workDir)
+    try:
+        if isinstance(data, RatingMatrix):
+            store = BlockStore.fromMatrix(data, directory, blockSize, inv)
+        else:
+            store = BlockStore.fromFile(data, directory, blockSize, inv)
+        buildModel(store, simMeasure, nNeighbors, pathDump, kind, normalizeRow, minOverlap, maxPopularity, unary, bits)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
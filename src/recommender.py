@@ -1,8 +1,15 @@
 import abc
 from builtins import isinstance
+import heapq
 import pickle
 
 import numpy as np
+from scipy import sparse
+from matrix import InvertedIndex, RatingMatrix, Statistics, replaceRows
+from modelfile import NeighborModel, isModelFile
+import instrument
+import neighborhood
+import outofcore
 import similarity
 import tool
 
@@ -12,13 +19,102 @@ class DataType:
     Binary = 2      # Like/dislike, thumb-up/thumb-down, true/false, etc
     Explicit = 3    # User-Item-Score, etc
 
+class Backend:
+    Dict = 1        # Nested dictionaries: {user: {item: rating, ...}, ...}
+    Sparse = 2      # Sparse matrices (CSR by user, CSC by item); `prefs` is a read-only dictionary view
+
 class CollaborativeFiltering(object):
     __metaclass__ = abc.ABCMeta
+    inv = False         # True if the entities compared with each other are items
     
-    def __init__(self, dataType = DataType.Explicit):
+    def __init__(self, dataType = DataType.Explicit, backend = Backend.Dict, neighborIndex = None):
         self.dataType = dataType
+        self.backend = backend
+        self.neighborIndex = neighborIndex      # Approximate neighbor index (see ann.py), built in loadData
+        self.ratingMatrix = None
         self.prefs = None
         self.itemList = None
+        self.derived = {}               # Inverted index and statistics of the rating matrix, built on first use
+        self.blockCache = {}
+        self.neighborLists = None       # {row: (neighbors, similarities)} of the last model built
+        self.model = None               # Model assembled from the neighbor lists, patched by addRatings/removeRatings
+        self.modelParams = None
+        self.modelPrecision = None      # Precision of the compact model of the last model built, None for a dictionary model
+    
+    def loadData(self, data):
+        '''
+        Load training data.
+        'data' is preferences on users, a file path of training data or a RatingMatrix.
+        With the sparse backend, the rating matrix (`self.matrix`) is built here and `self.prefs` is a view over it.
+        With the dictionary backend, `self.prefs` holds nested dictionaries, and the rating matrix is built from them
+        only when a vectorized path first needs it (see matrix).
+        '''
+        with instrument.recorder.phase("load"):
+            prefs = None
+            self.ratingMatrix = None
+            if isinstance(data, RatingMatrix):
+                self.ratingMatrix = data
+            elif isinstance(data, dict):        # If 'data' is preferences on users for training
+                prefs = data
+            elif isinstance(data, str):         # If 'data' is a file path of training data
+                if self.backend == Backend.Sparse:
+                    self.ratingMatrix = tool.loadMatrix(data)
+                else:
+                    prefs = tool.loadData(data)
+            if self.backend == Backend.Sparse:
+                if self.ratingMatrix == None:
+                    self.ratingMatrix = RatingMatrix.fromPrefs(prefs)
+                prefs = self.ratingMatrix.toPrefs()
+            elif prefs == None:
+                prefs = self.ratingMatrix.toDict()
+            self.derived = {}
+            self.blockCache = {}
+            self.neighborLists = None
+            self.model = None
+            self.setPrefs(prefs)
+            if self.neighborIndex != None:
+                self.neighborIndex.build(self.matrix.entityMatrix(self.inv))
+    
+    @property
+    def matrix(self):
+        '''
+        Rating matrix of the training data (matrix.RatingMatrix).
+        With the dictionary backend, it is built from the dictionaries on first use.
+        '''
+        if self.ratingMatrix == None and self.prefs != None:
+            with instrument.recorder.phase("load"):
+                self.ratingMatrix = RatingMatrix.fromPrefs(self.prefsOnUser if self.inv else self.prefs)
+        return self.ratingMatrix
+    
+    def clearCaches(self):
+        '''
+        Drop what was derived from the rating matrix (statistics, inverted index, prepared blocks and tie ranks),
+        so that it is built again on first use, e.g. to time a cold run. The rating matrix and the model are kept.
+        '''
+        self.derived = {}
+        self.blockCache = {}
+    
+    def getDerived(self, name, build):
+        if name not in self.derived:
+            self.derived[name] = build()
+        return self.derived[name]
+    
+    @property
+    def index(self):
+        # Inverted index of the rating matrix (see matrix.InvertedIndex)
+        return self.getDerived("index", lambda: InvertedIndex(self.matrix, self.inv))
+    
+    @property
+    def userStats(self):
+        return self.getDerived("userStats", lambda: Statistics(self.matrix))
+    
+    @property
+    def itemStats(self):
+        return self.getDerived("itemStats", lambda: Statistics(self.matrix, inv = True))
+    
+    @abc.abstractmethod
+    def setPrefs(self, prefsOnUser):
+        raise NotImplementedError
     
     @classmethod
     @abc.abstractmethod
@@ -30,30 +126,358 @@ class CollaborativeFiltering(object):
     def Recommendation(cls):
         raise NotImplementedError
     
-    def getNearestNeighbors(self, target, simMeasure, nNeighbors = None):
-        similarities = [(simMeasure(self.prefs[target], self.prefs[other]), other) for other in self.prefs if target != other]
-        similarities.sort(reverse = True)
-        if nNeighbors != None:
-            similarities = similarities[0:nNeighbors]
-        return similarities     # similarities = [(similarity, neighbor), ...]
+    def getNearestNeighbors(self, target, simMeasure, nNeighbors = None, minOverlap = None, maxPopularity = None):
+        '''
+        Find the nearest neighbors of a target: [(similarity, neighbor), ...]
+        If the neighbor index supports the similarity measure, only the candidates it returns are scored,
+        so neighbors it misses are left out, and so are the entities without a shared rating.
+        Other measures are searched exactly, and the index reports it the first time (see ann.NeighborIndex.check).
+        `minOverlap` and `maxPopularity` restrict the candidates as in getNeighborhoods either way.
+        '''
+        if self.neighborIndex != None and self.neighborIndex.check(simMeasure):
+            return self.getApproximateNeighbors(target, simMeasure, nNeighbors, minOverlap, maxPopularity)
+        return self.getNeighborhoods(simMeasure, nNeighbors, [target], minOverlap = minOverlap,
+                                     maxPopularity = maxPopularity)[target]     # [(similarity, neighbor), ...]
+    
+    def getApproximateNeighbors(self, target, simMeasure, nNeighbors = None, minOverlap = None, maxPopularity = None):
+        row = self.matrix.entityIndex(self.inv)[target]
+        candidates = self.neighborIndex.query(row)
+        if minOverlap != None or maxPopularity != None:
+            # Only the candidates of the index which also share enough ratings with the target
+            overlapping, overlaps = self.index.getCandidates(row, minOverlap if minOverlap != None else 1, maxPopularity)
+            candidates = np.intersect1d(candidates, overlapping)
+        blockMeasure = self.getBlockMeasure(simMeasure)
+        prepared, tieRanks = self.getPreparedBlock(blockMeasure)
+        # Supported measures are symmetric, and the product with a single row on the right side is transposed cheaply
+        with instrument.recorder.phase("similarity"):
+            similarities = blockMeasure.compute(prepared.take(candidates), prepared.take([row]))[:, 0]
+        instrument.recorder.count("similarity evaluations", len(candidates))
+        with instrument.recorder.phase("neighbor selection"):
+            selected = neighborhood.selectTopK(similarities, tieRanks[candidates], nNeighbors)
+        ids = self.matrix.entityIds(self.inv)
+        return [(similarity, ids[neighbor]) for similarity, neighbor in zip(similarities[selected].tolist(), candidates[selected].tolist())]
+    
+    def getNeighborhoods(self, simMeasure, nNeighbors = None, targets = None, nJobs = 1, minOverlap = None, maxPopularity = None):
+        '''
+        Find the nearest neighbors of the targets (all entities if not given).
+        Measures in similarity.py are computed block by block with sparse matrix products,
+        in `nJobs` processes if nJobs is not 1 (-1: all CPU cores).
+        Any other measure is evaluated pair by pair in the current process.
+        If `minOverlap` or `maxPopularity` is given, only the entities sharing at least `minOverlap` (default 1)
+        rated items/users with the target are scored, found with the inverted index;
+        items/users rated by more than `maxPopularity` entities are not counted as shared.
+        Output format: {target: [(similarity, neighbor), ...], ...}
+        '''
+        if targets == None:
+            targets = self.prefs
+        ids = self.matrix.entityIds(self.inv)
+        index = self.matrix.entityIndex(self.inv)
+        rows = [index[target] for target in targets]
+        neighborhoods = {}
+        for row, neighbors, similarities in self.findNeighborLists(simMeasure, nNeighbors, rows, nJobs, minOverlap, maxPopularity):
+            neighborhoods[ids[row]] = list(zip(similarities.tolist(), [ids[neighbor] for neighbor in neighbors.tolist()]))
+        return neighborhoods
+    
+    def findNeighborLists(self, simMeasure, nNeighbors, rows, nJobs = 1, minOverlap = None, maxPopularity = None):
+        '''
+        Same as getNeighborhoods, but targets and neighbors are row indices of the rating matrix.
+        Yield (row, neighbors, similarities) for each row.
+        '''
+        if maxPopularity != None and minOverlap == None:
+            minOverlap = 1
+        blockMeasure = self.getBlockMeasure(simMeasure)
+        if blockMeasure == None:
+            ids = self.matrix.entityIds(self.inv)
+            index = self.matrix.entityIndex(self.inv)
+            for row in rows:
+                target = ids[row]
+                if minOverlap != None:
+                    candidates, overlaps = self.index.getCandidates(row, minOverlap, maxPopularity)
+                    others = [ids[candidate] for candidate in candidates.tolist()]
+                else:
+                    others = self.prefs
+                if instrument.recorder.enabled:
+                    instrument.recorder.count("similarity evaluations", len(others) - (target in others))
+                # Similarities are computed lazily while selecting, so the heap holds at most nNeighbors of them
+                similarities = ((simMeasure(self.prefs[target], self.prefs[other]), other) for other in others if target != other)
+                with instrument.recorder.phase("similarity"):
+                    if nNeighbors != None:
+                        similarities = heapq.nlargest(nNeighbors, similarities)     # Bounded heap instead of a full sort
+                    else:
+                        similarities = sorted(similarities, reverse = True)
+                yield (row, np.array([index[other] for similarity, other in similarities], dtype = np.int64),
+                       np.array([similarity for similarity, other in similarities], dtype = np.float64))
+            return
+        
+        prepared, tieRanks = self.getPreparedBlock(blockMeasure, maxPopularity)
+        if nJobs == 1:
+            yield from neighborhood.findNeighbors(blockMeasure, prepared, rows, nNeighbors, tieRanks, minOverlap = minOverlap)
+        else:
+            yield from neighborhood.findNeighborsParallel(blockMeasure, prepared, rows, nNeighbors, tieRanks, nJobs,
+                                                          minOverlap = minOverlap)
+    
+    def findModelNeighbors(self, simMeasure, nNeighbors, nJobs = 1, minOverlap = None, maxPopularity = None):
+        # Neighbor lists of all entities, kept with their parameters so that addRatings/removeRatings can update them
+        # The progress of the search is reported if instrumentation is enabled (see instrument.py)
+        rows = range(len(self.matrix.entityIds(self.inv)))
+        with instrument.recorder.phase("model building"):
+            neighborLists = self.findNeighborLists(simMeasure, nNeighbors, rows, nJobs, minOverlap, maxPopularity)
+            self.neighborLists = {row: (neighbors, similarities) for row, neighbors, similarities
+                                  in instrument.recorder.track(neighborLists, len(rows), "Neighbor search")}
+        self.model = None
+        self.modelParams = {"simMeasure": simMeasure, "nNeighbors": nNeighbors, "nJobs": nJobs,
+                            "minOverlap": minOverlap, "maxPopularity": maxPopularity}
+    
+    def assembleModel(self):
+        # Convert self.neighborLists into the model format of the recommender
+        return self.assembleRows(sorted(self.neighborLists))
+    
+    @abc.abstractmethod
+    def assembleRows(self, rows):
+        # Entries of the model for the neighbor lists of the given rows, in their order
+        raise NotImplementedError
+    
+    def assembleCompactModel(self, precision = 32):
+        '''
+        Convert self.neighborLists into a modelfile.NeighborModel: int32 neighbor indices and similarities
+        stored as float32 (`precision` 32) or as 16/8-bit codes with a scale per row (see modelfile.quantize).
+        '''
+        return NeighborModel.fromNeighborLists(self.matrix.entityIds(self.inv), self.neighborLists, type(self).__name__,
+                                               similarity.getMeasureName(self.modelParams["simMeasure"]),
+                                               self.modelParams["nNeighbors"], precision, self.normalizeRow)
+    
+    def getModel(self):
+        # Model of the current neighbor lists in the format chosen in buildModel
+        if self.model == None:
+            if self.modelPrecision == None:
+                self.model = self.assembleModel()
+            else:
+                self.model = self.assembleCompactModel(self.modelPrecision)
+        return self.model
+    
+    def patchModel(self, rows):
+        '''
+        Bring the model of getModel up to date with the neighbor lists of the given rows, in place,
+        without assembling the other rows again.
+        '''
+        if self.model == None:
+            return self.getModel()
+        if isinstance(self.model, NeighborModel):
+            self.model.updateRows(self.matrix.entityIds(self.inv), self.neighborLists, rows, self.normalizeRow)
+        else:
+            self.model.update(self.assembleRows(rows))
+        return self.model
+    
+    def normalizeRow(self, similarities):
+        # Values stored in the model for the similarities of a neighbor list
+        return similarities
+    
+    def buildModelOutOfCore(self, data, pathDump, simMeasure, nNeighbors, blockSize = 2048, workDir = None,
+                            minOverlap = None, maxPopularity = None, precision = None):
+        '''
+        Build a model file without loading the data or holding the model in memory (see outofcore.py).
+        'data' is a file path of training data or a RatingMatrix. It is partitioned into blocks of `blockSize`
+        users (items for ItemBased) in a temporary directory under `workDir` (the directory of `pathDump` by default),
+        and peak memory is about 40 * blockSize^2 bytes (a tile of similarities and its temporaries) plus the ratings of two blocks.
+        Smaller blocks use less memory but load every column block more often.
+        The file is the same as the one written by buildModel with the same parameters after loading the data
+        as a RatingMatrix (e.g. with tool.loadMatrix); only measures of similarity.py are supported.
+        With `precision` 16 or 8, similarities are quantized row by row as they are written (see buildModel).
+        Return the model mapped from the file (modelfile.NeighborModel), or None if the data could not be read.
+        '''
+        model = self.loadExtModel(pathDump, simMeasure, nNeighbors, precision)
+        if model != None:
+            return model
+        
+        print("Out-of-core model builder is running...")
+        try:
+            outofcore.buildModelFromData(data, simMeasure, nNeighbors, pathDump, type(self).__name__, self.inv, blockSize, workDir,
+                                         self.normalizeRow, minOverlap, maxPopularity, self.dataType == DataType.Unary,
+                                         precision if precision != None else 32)
+        except IOError as e:
+            print(e)
+            return None
+        print("\tComplete!")
+        return NeighborModel.load(pathDump)
+    
+    def addRatings(self, ratings):
+        '''
+        Add new ratings or overwrite existing ones: {user: {item: rating, ...}, ...}
+        The rating matrix, prefs, statistics and inverted index are updated in place.
+        If a model was built, only the affected neighbor lists are updated (see neighborhood.updateNeighbors),
+        and the model returned by buildModel (or the last update) is patched in place and returned; otherwise, None is returned.
+        '''
+        entries = [(user, item, rating) for user in ratings for item, rating in ratings[user].items()]
+        if self.ratingMatrix == None:
+            # Nothing was derived from the matrix yet
+            self.updatePrefs(entries, remove = False)
+            return None
+        previous = self.getPatterns(entries)
+        changedUsers, changedItems = self.matrix.setRatings(entries)
+        self.updatePrefs(entries, remove = False)
+        return self.updateModel(changedUsers, changedItems, previous)
+    
+    def removeRatings(self, ratings):
+        '''
+        Remove ratings: {user: [item, ...], ...}
+        Users and items stay in the data even if none of their ratings is left.
+        Same as addRatings for the rest.
+        '''
+        if self.ratingMatrix == None:
+            prefsOnUser = self.prefsOnUser if self.inv else self.prefs
+            self.updatePrefs([(user, item) for user in ratings for item in ratings[user]
+                              if user in prefsOnUser and item in prefsOnUser[user]], remove = True)
+            return None
+        entries = [(user, item) for user in ratings for item in ratings[user]
+                   if user in self.matrix.userIndex and item in self.matrix.itemIndex]
+        previous = self.getPatterns(entries)
+        changedUsers, changedItems = self.matrix.removeRatings(entries)
+        self.updatePrefs(entries, remove = True)
+        return self.updateModel(changedUsers, changedItems, previous)
+    
+    @abc.abstractmethod
+    def updatePrefs(self, entries, remove = False):
+        raise NotImplementedError
+    
+    def getPatterns(self, entries):
+        # Rows of the existing entities of (userID, itemID, ...) entries and their sparsity patterns, before the entries are applied
+        if self.neighborLists == None:
+            return None
+        index = self.matrix.entityIndex(self.inv)
+        entities = [entry[1] if self.inv else entry[0] for entry in entries]
+        rows = np.unique(np.array([index[entity] for entity in entities if entity in index], dtype = np.int64))
+        X = self.matrix.entityMatrix(self.inv)[rows]
+        return rows, similarity.withData(X, np.ones(X.nnz))
+    
+    def updateModel(self, changedUsers, changedItems, previous = None):
+        '''
+        Update what was derived from the rating matrix after the ratings of the given users and items changed.
+        `previous` is given by getPatterns before the change. Statistics and prepared blocks are updated row by row,
+        and only the neighbor lists which may change are visited (see neighborhood.updateNeighbors).
+        Return the patched model (see patchModel), or None if no model was built.
+        '''
+        self.derived.pop("index", None)
+        if "userStats" in self.derived:
+            self.userStats.update(changedUsers)
+        if "itemStats" in self.derived:
+            self.itemStats.update(changedItems)
+        changed = changedItems if self.inv else changedUsers
+        self.updateBlockCache(changed)
+        if self.neighborIndex != None:
+            self.neighborIndex.update(self.matrix.entityMatrix(self.inv), changed)
+        if self.neighborLists == None:
+            return None
+        
+        params = self.modelParams
+        blockMeasure = self.getBlockMeasure(params["simMeasure"])
+        if blockMeasure == None or params["maxPopularity"] != None:
+            # Popularity caps may change the candidates of any pair, and scalar measures are not updated incrementally
+            self.findModelNeighbors(**params)
+            return self.getModel()
+        prepared, tieRanks = self.getPreparedBlock(blockMeasure)
+        updated = neighborhood.updateNeighbors(blockMeasure, prepared, self.neighborLists, changed,
+                                               params["nNeighbors"], tieRanks, params["minOverlap"], previous)
+        return self.patchModel(updated)
+    
+    def updateBlockCache(self, changed):
+        # Prepared blocks are updated row by row, except those with a popularity cap, which may change on any row.
+        # Tie ranks are ranked again only if new IDs were added.
+        self.blockCache.pop("unary", None)
+        X = self.matrix.entityMatrix(self.inv)
+        for key in list(self.blockCache):
+            if key[0] == "tieRanks":
+                if len(self.blockCache[key]) != len(self.matrix.entityIds(key[1])):
+                    del self.blockCache[key]
+            elif key[1] != None:
+                del self.blockCache[key]
+            else:
+                stats = self.itemStats if self.inv else self.userStats
+                prepared = key[0].update(self.blockCache[key], X, changed, stats)
+                self.blockCache[key] = neighborhood.addCandidatePattern(prepared)
+    
+    def getRatedItems(self):
+        # Items with at least one rating; items whose ratings were all removed are not recommended
+        if self.ratingMatrix == None:
+            prefsOnUser = self.prefsOnUser if self.inv else self.prefs
+            return list(dict.fromkeys(item for user in prefsOnUser for item in prefsOnUser[user]))
+        return [self.matrix.itemIds[item] for item in np.flatnonzero(np.diff(self.matrix.byItem.indptr)).tolist()]
+    
+    def isUnary(self):
+        # Implicit feedback: unary data whose ratings are all 1
+        if "unary" not in self.blockCache:
+            self.blockCache["unary"] = self.dataType == DataType.Unary and bool(np.all(self.matrix.byUser.data == 1))
+        return self.blockCache["unary"]
     
-    def loadExtModel(self, pathDump):
+    def getBlockMeasure(self, simMeasure):
+        # Measures on implicit feedback only count shared ratings (see similarity.UnaryBlock)
+        return similarity.getBlockMeasure(simMeasure, self.isUnary())
+    
+    def getPreparedBlock(self, blockMeasure, maxPopularity = None):
+        # Derived data of the entity matrix is reused until new data is loaded (see updateBlockCache for updates)
+        key = (blockMeasure, maxPopularity)
+        if key not in self.blockCache:
+            stats = self.itemStats if self.inv else self.userStats
+            prepared = blockMeasure.prepare(self.matrix.entityMatrix(self.inv), stats)
+            self.blockCache[key] = neighborhood.addCandidatePattern(prepared, maxPopularity)
+        return self.blockCache[key], self.getTieRanks(self.inv)
+    
+    def getTieRanks(self, inv = False):
+        # Ranks of user IDs (item IDs if `inv` is True) used to order equal scores like sorting (score, ID) tuples in reverse
+        key = ("tieRanks", inv)
+        if key not in self.blockCache:
+            self.blockCache[key] = neighborhood.getTieRanks(self.matrix.entityIds(inv))
+        return self.blockCache[key]
+    
+    def selectRecommendations(self, users, scores, candidates, topN = None, withScores = False):
+        '''
+        Pick the top-N candidate items of each user from a block of dense scores (users x items).
+        Items with equal scores are ordered as in Recommendation.
+        Output format: {user: [item, ...], ...}, or {user: [(score, item), ...], ...} if `withScores` is True
+        '''
+        itemIds = self.matrix.itemIds
+        tieRanks = self.getTieRanks(inv = True)
+        recommendations = {}
+        with instrument.recorder.phase("sort"):
+            for user, userScores, userCandidates in zip(users, scores, candidates):
+                items = np.flatnonzero(userCandidates)
+                selected = neighborhood.selectTopK(userScores[items], tieRanks[items], topN)
+                recommendations[user] = [itemIds[item] for item in items[selected].tolist()]
+                if withScores == True:
+                    recommendations[user] = list(zip(userScores[items[selected]].tolist(), recommendations[user]))
+        return recommendations
+    
+    def loadExtModel(self, pathDump, simMeasure = None, nNeighbors = None, precision = None):
+        '''
+        Load a model file written by dumpModel. Its arrays are memory-mapped (see modelfile.NeighborModel).
+        If `simMeasure` is given, a model built by another kind of recommender, with another similarity measure,
+        number of neighbors or precision (float32 if None) is rejected. Pickled models of older versions are loaded without the check.
+        '''
         print("Loading external model...")
         try:
-            file = open(pathDump, "rb")
-            model = pickle.load(file)
-            file.close()
+            if isModelFile(pathDump):
+                model = NeighborModel.load(pathDump)
+                if simMeasure != None and not model.matches(type(self).__name__, similarity.getMeasureName(simMeasure), nNeighbors,
+                                                            precision if precision != None else 32):
+                    print("\tFailed! The model was built by {} with {} and {} neighbors in {} bits."
+                          .format(model.kind, model.measure, model.nNeighbors, model.bits))
+                    return None
+            else:
+                file = open(pathDump, "rb")
+                model = pickle.load(file)
+                file.close()
             print("\tDone!")
             return model
         except:
             print("\tFailed!")
             return None
         
-    def dumpModel(self, model, pathDump):
+    def dumpModel(self, model, pathDump, simMeasure = None, nNeighbors = None):
         try:
-            file = open(pathDump, "wb")
-            pickle.dump(model, file)
-            file.close()
+            if isinstance(model, NeighborModel):
+                model.save(pathDump)
+                return
+            measure = similarity.getMeasureName(simMeasure) if simMeasure != None else None
+            NeighborModel.fromModel(model, type(self).__name__, measure, nNeighbors).save(pathDump)
         except IOError as e:
             print(e)
 
@@ -62,37 +486,51 @@ class UserBased(CollaborativeFiltering):
     For more details, reference the following paper:
     An Algorithmic Framework for Performing Collaborative Filtering - Herlocker, Konstan, Borchers, Riedl (SIGIR 1999)
     '''
-    def __init__(self, dataType = DataType.Explicit):
-        super().__init__(dataType)
+    def __init__(self, dataType = DataType.Explicit, backend = Backend.Dict, neighborIndex = None):
+        super().__init__(dataType, backend, neighborIndex)
         print("User-based Collaborative Filtering")
         
-    def loadData(self, data):
-        if isinstance(data, dict):          # If 'data' is preferences on users for training
-            self.prefs = data
-        elif isinstance(data, str):         # If 'data' is a file path of training data
-            self.prefs = tool.loadData(data)
-        self.itemList = {}
-        for user in self.prefs:
-            for item in self.prefs[user]:
-                self.itemList[item] = None
-    
-    def buildModel(self, simMeasure = similarity.cosine_intersection, nNeighbors = None, pathDump = None):
+    def setPrefs(self, prefsOnUser):
+        self.prefs = prefsOnUser
+        self.itemList = dict.fromkeys(self.getRatedItems())
+    
+    def buildModel(self, simMeasure = similarity.cosine_intersection, nNeighbors = None, pathDump = None, nJobs = 1,
+                   minOverlap = None, maxPopularity = None, precision = None):
         # Model contains top-K similar users for each user and their similarities.
         # Model format: {user: [(similarity, neighbor), ...], ...}
-        model = self.loadExtModel(pathDump)
+        # With `precision` (32, 16 or 8), the model is a compact modelfile.NeighborModel read in the same format
+        model = self.loadExtModel(pathDump, simMeasure, nNeighbors, precision)
         if model != None:
+            self.neighborLists = None
+            self.model = None
             return model
         
         print("Model builder is running...")
-        model = {}
-        for user in self.prefs:
-            model[user] = self.getNearestNeighbors(user, simMeasure, nNeighbors)
+        self.findModelNeighbors(simMeasure, nNeighbors, nJobs, minOverlap, maxPopularity)
+        self.modelPrecision = precision
+        model = self.getModel()
             
         if pathDump != None:
-            self.dumpModel(model, pathDump)
+            self.dumpModel(model, pathDump, simMeasure, nNeighbors)
         print("\tComplete!")
         return model
     
+    def assembleRows(self, rows):
+        ids = self.matrix.userIds
+        return {ids[row]: list(zip(similarities.tolist(), [ids[neighbor] for neighbor in neighbors.tolist()]))
+                for row, (neighbors, similarities) in ((row, self.neighborLists[row]) for row in rows)}
+    
+    def updatePrefs(self, entries, remove = False):
+        if self.backend == Backend.Sparse:
+            self.setPrefs(self.matrix.toPrefs())
+            return
+        for entry in entries:
+            if remove == True:
+                self.prefs[entry[0]].pop(entry[1], None)
+            else:
+                self.prefs.setdefault(entry[0], {})[entry[1]] = entry[2]
+        self.itemList = dict.fromkeys(self.getRatedItems())
+    
     def getPredictedRating(self, user, item, nearestNeighbors):
         if self.dataType == DataType.Unary:
             if item in self.prefs[user]:
@@ -105,21 +543,54 @@ class UserBased(CollaborativeFiltering):
             # Not supported yet
             return 0.0
         elif self.dataType == DataType.Explicit:
-            if item in self.prefs[user]:
-                return self.prefs[user][item]
-            meanRating = np.mean([score for score in self.prefs[user].values()])
+            userPrefs = self.prefs[user]
+            if item in userPrefs:
+                return userPrefs[item]
+            meanRating = self.userStats.getMean(user)       # Mean ratings are precomputed once (see matrix.Statistics)
             weightedSum = 0
             normalizingFactor = 0
             for neighbor, similarity in nearestNeighbors.items():
-                if item not in self.prefs[neighbor]:
+                neighborPrefs = self.prefs[neighbor]
+                if item not in neighborPrefs:
                     continue
-                meanRatingOfNeighbor = np.mean([r for r in self.prefs[neighbor].values()])
-                weightedSum += similarity * (self.prefs[neighbor][item] - meanRatingOfNeighbor)
+                meanRatingOfNeighbor = self.userStats.getMean(neighbor)
+                weightedSum += similarity * (neighborPrefs[item] - meanRatingOfNeighbor)
                 normalizingFactor += np.abs(similarity)
             if normalizingFactor == 0:
                 return 0
             return meanRating + (weightedSum / normalizingFactor)
     
+    def getUnaryScores(self, neighbors, similarities, nNeighbors = None):
+        '''
+        Predicted scores of unary data for all items as a vector, computed as getPredictedRating does:
+        the mean similarity of the first `nNeighbors` (all if None) neighbors who rated each item, or 0 if none did.
+        The neighbors (row indices) must be sorted by descending similarity. Votes are counted on the rating pattern
+        of the neighbors, taken column by column so that the first raters of each item are found without a Python loop.
+        '''
+        byItem = self.matrix.byUser[neighbors].tocsc()
+        byItem.sort_indices()           # Raters of each item in the order of the neighbors
+        counts = np.diff(byItem.indptr)
+        items = np.repeat(np.arange(byItem.shape[1]), counts)
+        if nNeighbors != None:
+            ranks = np.arange(byItem.nnz) - np.repeat(byItem.indptr[:-1], counts)
+            items = items[ranks < nNeighbors]
+            raters = byItem.indices[ranks < nNeighbors]
+        else:
+            raters = byItem.indices
+        votes = np.bincount(items, minlength = byItem.shape[1])
+        sums = np.bincount(items, weights = np.asarray(similarities, dtype = np.float64)[raters], minlength = byItem.shape[1])
+        return np.divide(sums, votes, out = np.zeros(byItem.shape[1]), where = votes > 0)
+    
+    def recommendUnary(self, user, neighbors, similarities, candidates, nNeighbors = None, topN = None):
+        # Recommendation on implicit feedback: votes of the neighbors (row indices sorted by descending similarity) scored at once
+        with instrument.recorder.phase("prediction"):
+            scores = self.getUnaryScores(neighbors, similarities, nNeighbors)
+        rated = self.matrix.byUser[self.matrix.userIndex[user]]
+        candidates[rated.indices] = False
+        if instrument.recorder.enabled:
+            instrument.recorder.count("predictions", int(candidates.sum()))
+        return self.selectRecommendations([user], scores[None, :], candidates[None, :], topN)[user]
+    
     def Recommendation(self, user, simMeasure = similarity.cosine_intersection, nNeighbors = 50, model = None, topN = None):
         if model != None:
             '''
@@ -127,6 +598,16 @@ class UserBased(CollaborativeFiltering):
             other parameters such as similarity measure and the number of nearest neighbors are ignored.
             It is because that the similarity measure and # of neighbors are determined during the model building.
             '''
+            if isinstance(model, NeighborModel):
+                return self.recommendFromArrays(user, model, topN)
+            if self.dataType == DataType.Unary:
+                nearestNeighbors = [(similarity, neighbor) for similarity, neighbor in model[user] if similarity > 0]
+                neighbors = np.array([self.matrix.userIndex[neighbor] for similarity, neighbor in nearestNeighbors], dtype = np.int64)
+                # Candidates are the items rated by the neighbors, which are the items with a vote
+                candidates = np.zeros(self.matrix.nItems, dtype = bool)
+                candidates[self.matrix.byUser[neighbors].indices] = True
+                return self.recommendUnary(user, neighbors, [similarity for similarity, neighbor in nearestNeighbors], candidates, topN = topN)
+            userPrefs = self.prefs[user]
             candidateItems = {}         # List of candidate items to be recommended
             nearestNeighbors = {}       # List of nearest neighbors
             for similarity, neighbor in model[user]:
@@ -135,83 +616,222 @@ class UserBased(CollaborativeFiltering):
                 nearestNeighbors[neighbor] = similarity
                 for item in self.prefs[neighbor]:
                     candidateItems[item] = None
-            predictedScores = [(self.getPredictedRating(user, item, nearestNeighbors), item)
-                               for item in candidateItems if item not in self.prefs[user]]
+            with instrument.recorder.phase("prediction"):
+                predictedScores = [(self.getPredictedRating(user, item, nearestNeighbors), item)
+                                   for item in candidateItems if item not in userPrefs]
         else:
             '''
             If a model is not given, the recommendation task follows the original CF method.
             After finding K-nearest neighbors who have rating history on the item,
             the recommendation is made by using their similarities.
             '''
+            userPrefs = self.prefs[user]
             predictedScores = []        # predictedScores = [(predicted_score, item), ...]
             similarities = self.getNearestNeighbors(user, simMeasure)   # similarities = [(similarity, neighbor), ...]
-            for item in self.itemList:
-                if item in self.prefs[user]:
-                    continue
-                itemRaters = {}         # Nearest neighbors who rated on the item
-                for similarity, neighbor in similarities:
-                    if similarity <= 0 or len(itemRaters) == nNeighbors:
-                        break
-                    if item in self.prefs[neighbor]:
-                        itemRaters[neighbor] = similarity
-                predictedScores.append((self.getPredictedRating(user, item, itemRaters), item))
+            if self.dataType == DataType.Unary:
+                # Every item with a rating is a candidate
+                nearestNeighbors = [(similarity, neighbor) for similarity, neighbor in similarities if similarity > 0]
+                return self.recommendUnary(user, np.array([self.matrix.userIndex[neighbor] for similarity, neighbor in nearestNeighbors], dtype = np.int64),
+                                           [similarity for similarity, neighbor in nearestNeighbors],
+                                           np.diff(self.matrix.byItem.indptr) > 0, nNeighbors, topN)
+            with instrument.recorder.phase("prediction"):
+                for item in self.itemList:
+                    if item in userPrefs:
+                        continue
+                    itemRaters = {}         # Nearest neighbors who rated on the item
+                    for similarity, neighbor in similarities:
+                        if similarity <= 0 or len(itemRaters) == nNeighbors:
+                            break
+                        if item in self.prefs[neighbor]:
+                            itemRaters[neighbor] = similarity
+                    predictedScores.append((self.getPredictedRating(user, item, itemRaters), item))
+        instrument.recorder.count("predictions", len(predictedScores))
         
-        predictedScores.sort(reverse = True)
+        with instrument.recorder.phase("sort"):
+            predictedScores.sort(reverse = True)
         recommendation = [item for similarity, item in predictedScores]
         if topN != None:
             recommendation = recommendation[0:topN]
         return recommendation
     
+    def recommendFromArrays(self, user, model, topN = None):
+        '''
+        Recommendation with a modelfile.NeighborModel, without building a list of tuples for the model row:
+        the neighbors up to the first similarity <= 0 are taken from the arrays and the predicted ratings of all candidate items
+        are summed with bincounts, adding the terms in the order of the neighbors as getPredictedRating does,
+        so the recommendations are the same.
+        '''
+        neighbors, similarities = model.getRow(model.index[user])
+        similarities = np.asarray(similarities, dtype = np.float64)
+        nPositive = int(np.argmin(similarities > 0)) if (similarities <= 0).any() else len(similarities)
+        neighbors, similarities = model.getMapping(self.matrix.userIndex)[neighbors[:nPositive]], similarities[:nPositive]
+        known = neighbors >= 0          # Neighbors missing from the data have no ratings
+        neighbors, similarities = neighbors[known], similarities[known]
+        ratings = self.matrix.byUser[neighbors]
+        candidates = np.zeros(self.matrix.nItems, dtype = bool)
+        candidates[ratings.indices] = True
+        if self.dataType == DataType.Unary:
+            return self.recommendUnary(user, neighbors, similarities, candidates, topN = topN)
+        
+        row = self.matrix.userIndex[user]
+        candidates[self.matrix.byUser.indices[self.matrix.byUser.indptr[row]:self.matrix.byUser.indptr[row + 1]]] = False
+        with instrument.recorder.phase("prediction"):
+            if self.dataType == DataType.Binary:
+                # Not supported yet
+                scores = np.zeros(self.matrix.nItems)
+            elif self.dataType == DataType.Explicit:
+                weights = np.repeat(similarities, np.diff(ratings.indptr))
+                deviations = ratings.data - np.repeat(self.userStats.mean[neighbors], np.diff(ratings.indptr))
+                weightedSum = np.bincount(ratings.indices, weights = weights * deviations, minlength = self.matrix.nItems)
+                normalizingFactor = np.bincount(ratings.indices, weights = np.abs(weights), minlength = self.matrix.nItems)
+                with np.errstate(divide = "ignore", invalid = "ignore"):
+                    scores = self.userStats.mean[row] + weightedSum / normalizingFactor
+        if instrument.recorder.enabled:
+            instrument.recorder.count("predictions", int(candidates.sum()))
+        return self.selectRecommendations([user], scores[None, :], candidates[None, :], topN)[user]
+    
+    def recommendBatch(self, users, topN = None, model = None, simMeasure = similarity.cosine_intersection, nNeighbors = 50,
+                       withScores = False):
+        '''
+        Recommend items to many users in one pass.
+        The predicted scores are those of Recommendation with a model, computed for a block of users at once:
+            S <- similarities of the users to their neighbors (positive ones only)
+            x <- mean + S(R - mean) / S|R|     # |R|: 1 if rated, otherwise 0
+        Already rated items are masked and the top-N items are selected with a partition.
+        If a model is not given, a model of the `nNeighbors` nearest neighbors of the users is built with `simMeasure`.
+        Output format: {user: [item, ...], ...}, or {user: [(score, item), ...], ...} if `withScores` is True
+        '''
+        users = list(users)
+        if model == None:
+            model = self.getNeighborhoods(simMeasure, nNeighbors, targets = users)
+        userIndex = self.matrix.userIndex
+        ratings = self.matrix.byUser
+        pattern = sparse.csr_matrix((np.ones(ratings.nnz), ratings.indices, ratings.indptr), shape = ratings.shape)
+        centered = sparse.csr_matrix((ratings.data - np.repeat(self.userStats.mean, np.diff(ratings.indptr)),
+                                      ratings.indices, ratings.indptr), shape = ratings.shape)
+        
+        recommendations = {}
+        blockSize = neighborhood.getBlockSizes(len(users), self.matrix.nItems)[0]
+        for start in range(0, len(users), blockSize):
+            blockUsers = users[start:start + blockSize]
+            rows, columns, similarities = [], [], []
+            for i, user in enumerate(blockUsers):
+                for similarity, neighbor in model[user]:
+                    if similarity <= 0:
+                        break
+                    rows.append(i)
+                    columns.append(userIndex[neighbor])
+                    similarities.append(similarity)
+            S = sparse.csr_matrix((similarities, (rows, columns)), shape = (len(blockUsers), self.matrix.nUsers))
+            with instrument.recorder.phase("prediction"):
+                normalizingFactor = (S @ pattern).toarray()
+                if self.dataType == DataType.Unary:
+                    # The sum of the similarities is the normalizing factor itself
+                    counts = (sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape = S.shape) @ pattern).toarray()
+                    with np.errstate(divide = "ignore", invalid = "ignore"):
+                        scores = normalizingFactor / counts
+                elif self.dataType == DataType.Binary:
+                    # Not supported yet
+                    scores = np.zeros(normalizingFactor.shape)
+                elif self.dataType == DataType.Explicit:
+                    means = self.userStats.mean[[userIndex[user] for user in blockUsers]]
+                    with np.errstate(divide = "ignore", invalid = "ignore"):
+                        scores = means[:, None] + (S @ centered).toarray() / normalizingFactor
+            
+            candidates = normalizingFactor > 0              # Items rated by at least one neighbor
+            rated = ratings[[userIndex[user] for user in blockUsers]]
+            candidates[np.repeat(np.arange(len(blockUsers)), np.diff(rated.indptr)), rated.indices] = False
+            if instrument.recorder.enabled:
+                instrument.recorder.count("predictions", int(candidates.sum()))
+            recommendations.update(self.selectRecommendations(blockUsers, scores, candidates, topN, withScores))
+        return recommendations
+    
 class ItemBased(CollaborativeFiltering):
     '''
     For more details, reference the following paper:
     Item-based Top-N Recommendation Algorithms - Deshpande, Karypis (TOIS 2004)
     '''
-    def __init__(self, dataType = DataType.Explicit):
-        super().__init__(dataType)
+    inv = True
+    
+    def __init__(self, dataType = DataType.Explicit, backend = Backend.Dict, neighborIndex = None):
+        super().__init__(dataType, backend, neighborIndex)
+        self.modelMatrix = None         # (model, rating matrix, # of items, W) of the last model converted (see getModelMatrix)
         print("Item-based Collaborative Filtering")
         
-    def loadData(self, data):
-        if isinstance(data, dict):          # If 'data' is preferences on users for training
-            self.prefsOnUser = data
-            self.prefs = tool.transposePrefs(self.prefsOnUser)
-        elif isinstance(data, str):         # If 'data' is a file path of training data
-            self.prefsOnUser = tool.loadData(data)
+    def clearCaches(self):
+        super().clearCaches()
+        self.modelMatrix = None
+    
+    def setPrefs(self, prefsOnUser):
+        self.prefsOnUser = prefsOnUser
+        if self.backend == Backend.Sparse:
+            self.prefs = self.matrix.toPrefs(inv = True)    # Item view comes from the CSC storage without copying
+        else:
             self.prefs = tool.transposePrefs(self.prefsOnUser)
-        self.itemList = self.prefs.keys()
+        self.itemList = dict.fromkeys(self.getRatedItems())
     
-    def buildModel(self, simMeasure = similarity.cosine, nNeighbors = 20, pathDump = None):
+    def buildModel(self, simMeasure = similarity.cosine, nNeighbors = 20, pathDump = None, nJobs = 1,
+                   minOverlap = None, maxPopularity = None, precision = None):
         '''
         The j-th column of the model(matrix) stores the k most similar items to item j.
-        But, in this project, the model is not matrix but dictionary type.
+        But, in this project, the model is not matrix but dictionary type,
+        or flat arrays (modelfile.NeighborModel) if `precision` is given: 32 for float32 similarities,
+        16 or 8 for similarities quantized with a scale per row, which take less memory but may tie close neighbors.
         '''
         # Model contains top-K similar items for each item and their similarities.
         # Model format: {item: {neighbor: similarity, ...}, ...}
-        model = self.loadExtModel(pathDump)
+        model = self.loadExtModel(pathDump, simMeasure, nNeighbors, precision)
         if model != None:
+            self.neighborLists = None
+            self.model = None
             return model
         
         print("Model builder is running...")
-        model = {}
-        for item in self.prefs:
-            model.setdefault(item, {})
-            correlations = self.getNearestNeighbors(item, simMeasure, nNeighbors)
-            for correlation, neighbor in correlations:
-                model[item][neighbor] = correlation
-        
-        # Row normalization
-        for c in model:
-            COLSUM = sum([model[c][r] for r in model[c]])
-            if COLSUM > 0:
-                for r in model[c]:
-                    model[c][r] /= COLSUM
+        self.findModelNeighbors(simMeasure, nNeighbors, nJobs, minOverlap, maxPopularity)
+        self.modelPrecision = precision
+        model = self.getModel()
         
         if pathDump != None:
-            self.dumpModel(model, pathDump)
+            self.dumpModel(model, pathDump, simMeasure, nNeighbors)
         print("\tComplete!")
         return model
     
-    def Recommendation(self, user, simMeasure = similarity.cosine, nNeighbors = 20, model = None, topN = None):
+    def assembleRows(self, rows):
+        ids = self.matrix.itemIds
+        model = {}
+        for row in rows:
+            neighbors, correlations = self.neighborLists[row]
+            model[ids[row]] = {ids[neighbor]: correlation for neighbor, correlation in zip(neighbors.tolist(), self.normalizeRow(correlations).tolist())}
+        return model
+    
+    def normalizeRow(self, correlations):
+        # Row normalization
+        COLSUM = sum(correlations.tolist())
+        if COLSUM > 0:
+            return correlations / COLSUM
+        return correlations
+    
+    def assembleNeighborhoods(self, targets, simMeasure, nNeighbors):
+        # Model rows of the given items only, normalized as in assembleModel, for recommendations without a model
+        ids = self.matrix.itemIds
+        rows = [self.matrix.itemIndex[target] for target in targets]
+        return {ids[row]: {ids[neighbor]: correlation for neighbor, correlation in zip(neighbors.tolist(), self.normalizeRow(correlations).tolist())}
+                for row, neighbors, correlations in self.findNeighborLists(simMeasure, nNeighbors, rows)}
+    
+    def updatePrefs(self, entries, remove = False):
+        if self.backend == Backend.Sparse:
+            self.setPrefs(self.matrix.toPrefs())
+            return
+        for entry in entries:
+            if remove == True:
+                self.prefsOnUser[entry[0]].pop(entry[1], None)
+                self.prefs[entry[1]].pop(entry[0], None)
+            else:
+                self.prefsOnUser.setdefault(entry[0], {})[entry[1]] = entry[2]
+                self.prefs.setdefault(entry[1], {})[entry[0]] = entry[2]
+        self.itemList = dict.fromkeys(self.getRatedItems())
+    
+    def Recommendation(self, user, simMeasure = similarity.cosine, nNeighbors = 20, model = None, topN = None, earlyTermination = False):
         '''
         Pseudo code:
         ApplyModel(M, U, N):
@@ -222,22 +842,190 @@ class ItemBased(CollaborativeFiltering):
             for j <- 1 to m:
                 if x_i != among the N largest values in x:
                     x_i <- 0
+        Only the items in the model rows of the rated items can get a nonzero score,
+        so the scores are accumulated by walking those rows; the other items score 0.
+        If `earlyTermination` is True and `topN` is given, the rows are scanned in parallel (threshold algorithm)
+        and the scan stops as soon as no unseen item can enter the top-N. This requires nonnegative ratings
+        and model rows sorted by descending similarity, as built by buildModel. It pays off when a few neighbors
+        dominate long model rows; with flat similarities most items are seen before the scan can stop.
+        A modelfile.NeighborModel is read from its arrays (see recommendFromArrays).
         '''
-        predictedScores = []
-        for candidate in self.itemList:
-            if candidate in self.prefsOnUser[user]:
-                continue
-            
-            if model != None:
-                correlations = model[candidate]
-            else:
-                correlations = self.getNearestNeighbors(candidate, simMeasure, nNeighbors)
-            
-            score = sum([correlations[candidate] * self.prefsOnUser[user][item]
-                         for item in self.prefsOnUser[user] if candidate in correlations])
-            predictedScores.append((score, candidate))
-        predictedScores.sort(reverse = True)
+        userPrefs = self.prefsOnUser[user]
+        if model == None:
+            model = self.assembleNeighborhoods(userPrefs, simMeasure, nNeighbors)
+        
+        if earlyTermination == True and topN != None:
+            with instrument.recorder.phase("prediction"):
+                recommendation = self.getTopCandidates(userPrefs, {item: model[item] for item in userPrefs}, topN)
+            if recommendation != None:
+                return recommendation
+        if isinstance(model, NeighborModel):
+            return self.recommendFromArrays(user, userPrefs, model, topN)
+        
+        # The j-th column of the model holds the neighbors of item j, so candidates are looked up in the model of rated items
+        correlations = {item: model[item] for item in userPrefs}
+        with instrument.recorder.phase("prediction"):
+            scores = {}
+            for item, rating in userPrefs.items():
+                for candidate, correlation in correlations[item].items():
+                    if candidate in self.itemList and candidate not in userPrefs:
+                        scores[candidate] = scores.get(candidate, 0) + correlation * rating
+            predictedScores = [(score, candidate) for candidate, score in scores.items() if score > 0]
+            if topN == None or len(predictedScores) < topN:
+                # Items scoring 0 or less are needed as well
+                predictedScores = [(scores.get(candidate, 0), candidate) for candidate in self.itemList if candidate not in userPrefs]
+        instrument.recorder.count("predictions", len(scores))
+        with instrument.recorder.phase("sort"):
+            predictedScores.sort(reverse = True)
         recommendation = [item for similarity, item in predictedScores]
         if topN != None:
             recommendation = recommendation[0:topN]
         return recommendation
+    
+    def recommendFromArrays(self, user, userPrefs, model, topN = None):
+        '''
+        Recommendation with a modelfile.NeighborModel, without building a dictionary per model row:
+        the rows of the rated items are gathered from the arrays and the scores are summed per item with one bincount,
+        adding the terms in the same order as the dictionary loop, so the recommendations are the same.
+        '''
+        mapping = model.getMapping(self.matrix.itemIndex)
+        with instrument.recorder.phase("prediction"):
+            neighbors, weights = [np.empty(0, dtype = np.int64)], [np.empty(0)]
+            for item, rating in userPrefs.items():
+                rowNeighbors, rowSimilarities = model.getRow(model.index[item])
+                neighbors.append(mapping[rowNeighbors])
+                weights.append(np.asarray(rowSimilarities, dtype = np.float64) * rating)
+            neighbors, weights = np.concatenate(neighbors), np.concatenate(weights)
+            known = neighbors >= 0          # Neighbors missing from the data are not recommended
+            scores = np.bincount(neighbors[known], weights = weights[known], minlength = self.matrix.nItems)
+        # Every rated item the user has not rated is a candidate; items outside of the rows score 0
+        candidates = np.diff(self.matrix.byItem.indptr) > 0
+        byUser, row = self.matrix.byUser, self.matrix.userIndex[user]
+        candidates[byUser.indices[byUser.indptr[row]:byUser.indptr[row + 1]]] = False
+        if instrument.recorder.enabled:
+            scored = neighbors[known]
+            instrument.recorder.count("predictions", len(np.unique(scored[candidates[scored]])))
+        return self.selectRecommendations([user], scores[None, :], candidates[None, :], topN)[user]
+    
+    def getTopCandidates(self, userPrefs, correlations, topN):
+        '''
+        Threshold algorithm over the model rows of the rated items, read one rank at a time.
+        An unseen item scores at most the sum of rating * (similarity at the current rank) over the rows,
+        so the scan stops once the N-th best score seen is above that bound.
+        Return None if the scan cannot stop early; Recommendation then scores all candidates.
+        '''
+        if any(rating < 0 for rating in userPrefs.values()):
+            return None
+        rows = [(rating, list(correlations[item].items())) for item, rating in userPrefs.items()]
+        seen = {}
+        best = []               # Min-heap of the N best scores seen
+        for rank in range(max([len(row) for rating, row in rows] + [0])):
+            threshold = 0
+            for rating, row in rows:
+                if rank >= len(row):
+                    continue
+                candidate, correlation = row[rank]
+                threshold += rating * max(correlation, 0)
+                if candidate in seen or candidate in userPrefs or candidate not in self.itemList:
+                    continue
+                # Random access to the other rows gives the exact score
+                seen[candidate] = sum([correlations[item][candidate] * userPrefs[item] for item in userPrefs if candidate in correlations[item]])
+                heapq.heappush(best, seen[candidate])
+                if len(best) > topN:
+                    heapq.heappop(best)
+            if threshold <= 0:
+                break
+            if len(best) == topN and best[0] > threshold:
+                predictedScores = sorted([(score, candidate) for candidate, score in seen.items()], reverse = True)
+                return [item for similarity, item in predictedScores[0:topN]]
+        return None
+    
+    def getModelMatrix(self, model):
+        '''
+        Convert a model into a sparse item-item matrix W, where W[j, i] is the (normalized) similarity
+        of item i in the neighborhood of item j.
+        The matrix of the last model converted is cached until other data is loaded or new items are added,
+        so a model loaded from a file is converted once. The matrix of the model kept by the recommender
+        (returned by buildModel, addRatings and removeRatings) is patched row by row instead (see patchModel).
+        '''
+        cached = self.modelMatrix
+        if cached != None and cached[0] is model and cached[1] is self.ratingMatrix and cached[2] == self.matrix.nItems:
+            return cached[3]
+        itemIndex = self.matrix.itemIndex
+        if isinstance(model, NeighborModel):
+            W = model.toMatrix(itemIndex, self.matrix.nItems)
+        else:
+            rows, columns, correlations = [], [], []
+            for item, neighbors in model.items():
+                for neighbor, correlation in neighbors.items():
+                    rows.append(itemIndex[item])
+                    columns.append(itemIndex[neighbor])
+                    correlations.append(correlation)
+            W = sparse.csr_matrix((correlations, (rows, columns)), shape = (self.matrix.nItems, self.matrix.nItems))
+        self.modelMatrix = (model, self.ratingMatrix, self.matrix.nItems, W)
+        return W
+    
+    def getModelRows(self, model, rows):
+        # Rows of getModelMatrix for the given items (row indices of the rating matrix), as a (len(rows) x # of items) matrix
+        itemIds, itemIndex = self.matrix.itemIds, self.matrix.itemIndex
+        localRows, columns, correlations = [], [], []
+        for i, row in enumerate(rows):
+            if isinstance(model, NeighborModel):
+                neighbors, similarities = model.getRow(model.index[itemIds[row]])
+                neighbors = model.getMapping(itemIndex)[neighbors].tolist()
+                similarities = np.asarray(similarities, dtype = np.float64).tolist()
+            else:
+                neighbors = [itemIndex[neighbor] for neighbor in model[itemIds[row]]]
+                similarities = list(model[itemIds[row]].values())
+            localRows.extend([i] * len(neighbors))
+            columns.extend(neighbors)
+            correlations.extend(similarities)
+        return sparse.csr_matrix((correlations, (localRows, columns)), shape = (len(rows), self.matrix.nItems))
+    
+    def patchModel(self, rows):
+        # The cached matrix of the model (see getModelMatrix) is patched along with it
+        cached = self.modelMatrix
+        model = super().patchModel(rows)
+        if cached != None and cached[0] is model:
+            self.modelMatrix = None
+            if cached[1] is self.ratingMatrix:
+                rows = np.unique(np.asarray(rows, dtype = np.int64))
+                W, patch = cached[3], self.getModelRows(model, rows)
+                indptr, (indices, data) = replaceRows(W.indptr, (W.indices, W.data), rows, patch.indptr, (patch.indices, patch.data),
+                                                      self.matrix.nItems)
+                W = sparse.csr_matrix((data, indices, indptr), shape = (self.matrix.nItems, self.matrix.nItems))
+                W.has_sorted_indices = True
+                self.modelMatrix = (model, self.ratingMatrix, self.matrix.nItems, W)
+        return model
+    
+    def recommendBatch(self, users, topN = None, model = None, simMeasure = similarity.cosine, nNeighbors = 20,
+                       withScores = False):
+        '''
+        Recommend items to many users in one pass: x <- UW for a block of users U (users x items),
+        where W is the item-item model (see getModelMatrix).
+        Already rated items are masked and the top-N items are selected with a partition.
+        If a model is not given, the `nNeighbors` nearest neighbors of the items rated by the users are found with `simMeasure`
+        and normalized as in buildModel.
+        Output format: {user: [item, ...], ...}, or {user: [(score, item), ...], ...} if `withScores` is True
+        '''
+        users = list(users)
+        userIndex = self.matrix.userIndex
+        if model == None:
+            ratedItems = np.unique(self.matrix.byUser[[userIndex[user] for user in users]].indices)
+            model = self.assembleNeighborhoods([self.matrix.itemIds[item] for item in ratedItems.tolist()], simMeasure, nNeighbors)
+        W = self.getModelMatrix(model)
+        rated = np.diff(self.matrix.byItem.indptr) > 0
+        
+        recommendations = {}
+        blockSize = neighborhood.getBlockSizes(len(users), self.matrix.nItems)[0]
+        for start in range(0, len(users), blockSize):
+            blockUsers = users[start:start + blockSize]
+            U = self.matrix.byUser[[userIndex[user] for user in blockUsers]]
+            with instrument.recorder.phase("prediction"):
+                scores = (U @ W).toarray()
+            candidates = np.repeat(rated[None, :], len(blockUsers), axis = 0)
+            candidates[np.repeat(np.arange(len(blockUsers)), np.diff(U.indptr)), U.indices] = False
+            if instrument.recorder.enabled:
+                instrument.recorder.count("predictions", int(candidates.sum()))
+            recommendations.update(self.selectRecommendations(blockUsers, scores, candidates, topN, withScores))
+        return recommendations
@@ -0,0 +1,269 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import time
+
+from shared import initWorker, workerState
+
+
+class RecommendationServer(object):
+    '''
+    Serves recommendations from a recommender with loaded data and a preloaded model.
+    The top-`depth` recommendations of each user are computed with recommendBatch and kept with their scores
+    in an LRU cache of at most `cacheSize` users, so memory is bounded by cacheSize * depth entries.
+    Entries older than `ttl` seconds (if given) are computed again.
+    Requests for more than `depth` items bypass the cache.
+    '''
+    def __init__(self, recommender, model, depth = 100, cacheSize = 10000, ttl = None):
+        self.recommender = recommender
+        self.model = model
+        self.depth = depth
+        self.cacheSize = cacheSize
+        self.ttl = ttl
+        self.cache = OrderedDict()          # {user: (expiration time, [(score, item), ...])}
+        self.lock = threading.RLock()       # Guards the cache and the recommender
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def getStats(self):
+        with self.lock:
+            return {"Hits": self.hits, "Misses": self.misses, "Evictions": self.evictions,
+                    "Expirations": self.expirations, "Size": len(self.cache)}
+
+    def lookup(self, user):
+        # Cached scores of a user, or None if the user is not cached or the entry expired
+        entry = self.cache.get(user)
+        if entry == None:
+            return None
+        if entry[0] != None and entry[0] <= time.monotonic():
+            del self.cache[user]
+            self.expirations += 1
+            return None
+        self.cache.move_to_end(user)
+        return entry[1]
+
+    def store(self, user, scores):
+        expiration = time.monotonic() + self.ttl if self.ttl != None else None
+        self.cache[user] = (expiration, scores)
+        self.cache.move_to_end(user)
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last = False)
+            self.evictions += 1
+
+    def getScores(self, users, topN = None):
+        '''
+        Top-N recommendations of the users with their predicted scores: {user: [(score, item), ...], ...}
+        Users missing from the cache are scored together in one recommendBatch call.
+        '''
+        users = list(users)
+        if topN == None:
+            topN = self.depth
+        with self.lock:
+            if topN > self.depth:
+                return self.recommender.recommendBatch(users, topN = topN, model = self.model, withScores = True)
+            results = {}
+            missing = []
+            for user in users:
+                scores = self.lookup(user)
+                if scores == None:
+                    missing.append(user)
+                else:
+                    results[user] = scores
+            self.hits += len(users) - len(missing)
+            self.misses += len(missing)
+            if len(missing) > 0:
+                computed = self.recommender.recommendBatch(dict.fromkeys(missing), topN = self.depth, model = self.model,
+                                                           withScores = True)
+                for user, scores in computed.items():
+                    self.store(user, scores)
+                results.update(computed)
+        return {user: results[user][0:topN] for user in users}
+
+    def isKnown(self, user):
+        # Users of the training data; recommendBatch raises a KeyError for the others
+        with self.lock:
+            return user in self.recommender.matrix.userIndex
+
+    def recommend(self, user, topN = 10):
+        return [item for score, item in self.getScores([user], topN)[user]]
+
+    def recommendMany(self, users, topN = 10):
+        # Output format: {user: [item, ...], ...}
+        return {user: [item for score, item in scores] for user, scores in self.getScores(users, topN).items()}
+
+    def invalidate(self, users = None):
+        # Drop the cached results of the users (all users if not given)
+        with self.lock:
+            if users == None:
+                self.cache.clear()
+                return
+            for user in users:
+                self.cache.pop(user, None)
+
+    def setModel(self, model):
+        with self.lock:
+            self.model = model
+            self.cache.clear()
+
+    def addRatings(self, ratings):
+        '''
+        Add ratings ({user: {item: rating, ...}, ...}) through the recommender and invalidate those users.
+        If the recommender updates its model incrementally, the updated model is served from now on;
+        other users whose results it changes get them when their entries expire (see `ttl`) or are invalidated.
+        '''
+        with self.lock:
+            model = self.recommender.addRatings(ratings)
+            if model != None:
+                self.model = model
+            self.invalidate(ratings)
+
+    def removeRatings(self, ratings):
+        # Remove ratings ({user: [item, ...], ...}); same as addRatings for the rest
+        with self.lock:
+            model = self.recommender.removeRatings(ratings)
+            if model != None:
+                self.model = model
+            self.invalidate(ratings)
+
+class RequestBatcher(object):
+    '''
+    Coalesces concurrent requests into batches scored by one RecommendationServer.getScores call.
+    A background thread waits up to `maxDelay` seconds after the first pending request
+    for more requests to come, up to `maxBatch` users, and then scores them together.
+    '''
+    def __init__(self, server, maxBatch = 256, maxDelay = 0.005):
+        self.server = server
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.pending = []                   # [(user, topN, future), ...]
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def submit(self, user, topN = 10):
+        # Return a concurrent.futures.Future of the recommendation: [item, ...]
+        future = Future()
+        if topN == None:
+            topN = self.server.depth
+        with self.condition:
+            if self.closed == True:
+                raise RuntimeError("The batcher is closed")
+            self.pending.append((user, topN, future))
+            self.condition.notify()
+        return future
+
+    def recommend(self, user, topN = 10, timeout = None):
+        return self.submit(user, topN).result(timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and self.closed == False:
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    return
+                deadline = time.monotonic() + self.maxDelay
+                while len(self.pending) < self.maxBatch and self.closed == False and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                batch = self.pending[0:self.maxBatch]
+                self.pending = self.pending[self.maxBatch:]
+            self.process(batch)
+
+    def process(self, batch):
+        batch = [(user, topN, future) for user, topN, future in batch if future.set_running_or_notify_cancel()]
+        # Requests for unknown users fail alone, before the others are scored together
+        known = []
+        for user, topN, future in batch:
+            if self.server.isKnown(user):
+                known.append((user, topN, future))
+            else:
+                future.set_exception(KeyError(user))
+        try:
+            largest = max([topN for user, topN, future in known] + [0])
+            scores = self.server.getScores([user for user, topN, future in known], largest)
+        except Exception as e:
+            for user, topN, future in known:
+                future.set_exception(e)
+            return
+        for user, topN, future in known:
+            future.set_result([item for score, item in scores[user][0:topN]])
+
+    def close(self):
+        # Finish the pending requests and stop the background thread
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+class Overloaded(RuntimeError):
+    # Raised when a request is rejected because too many requests are pending
+    pass
+
+def recommendInWorker(user, topN, options):
+    return workerState["recommender"].Recommendation(user, model = workerState["model"], topN = topN, **options)
+
+class AsyncRecommender(object):
+    '''
+    Asyncio facade of a recommender: `await facade.recommend_async(user, topN)` runs Recommendation
+    in a pool of `nWorkers` threads, or processes if `processes` is True, so the event loop is never blocked.
+    Process workers receive a copy of the recommender once; a model loaded from a model file is mapped
+    from the same file by every worker. `options` are passed to Recommendation (e.g. simMeasure, nNeighbors).
+    At most `maxPending` requests are queued or running; further requests raise Overloaded at once.
+    A request taking longer than its timeout (`timeout` by default) raises asyncio.TimeoutError.
+    A request that times out or is cancelled before it starts is dropped from the queue. One that is already
+    running finishes in its worker, and its result is discarded.
+    '''
+    def __init__(self, recommender, model = None, nWorkers = None, processes = False, maxPending = 64, timeout = None, **options):
+        self.maxPending = maxPending
+        self.timeout = timeout
+        self.options = options
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.processes = processes
+        if processes == True:
+            self.executor = ProcessPoolExecutor(max_workers = nWorkers, initializer = initWorker,
+                                                initargs = ({"recommender": recommender, "model": model},))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers = nWorkers)
+            self.recommender = recommender
+            self.model = model
+
+    def release(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, user, topN):
+        with self.lock:
+            if self.pending >= self.maxPending:
+                raise Overloaded("{} requests are pending".format(self.pending))
+            self.pending += 1
+        try:
+            if self.processes == True:
+                future = self.executor.submit(recommendInWorker, user, topN, self.options)
+            else:
+                future = self.executor.submit(self.recommender.Recommendation, user, model = self.model, topN = topN, **self.options)
+        except:
+            self.release(None)
+            raise
+        future.add_done_callback(self.release)     # The slot is freed when the work is done or cancelled, not when the caller gives up
+        return future
+
+    async def recommend_async(self, user, topN = 10, timeout = None):
+        future = self.submit(user, topN)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout if timeout != None else self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            future.cancel()
+            raise
+
+    def getPending(self):
+        with self.lock:
+            return self.pending
+
+    def close(self):
+        # Cancel the queued requests and wait for the running ones
+        self.executor.shutdown(wait = True, cancel_futures = True)
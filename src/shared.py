@@ -0,0 +1,44 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays(object):
+    '''
+    Copies of numpy arrays in shared memory.
+    Worker processes attach to the same pages by name (see attachArray) instead of receiving pickled copies.
+    '''
+    def __init__(self):
+        self.memories = []
+    
+    def share(self, array):
+        # Return the spec of the shared copy: (name, dtype, shape)
+        array = np.ascontiguousarray(array)
+        memory = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype = array.dtype, buffer = memory.buf)[...] = array
+        self.memories.append(memory)
+        return (memory.name, array.dtype.str, array.shape)
+    
+    def release(self):
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+
+def attachArray(memories, name, dtype, shape):
+    memory = shared_memory.SharedMemory(name = name)
+    memories.append(memory)     # The buffer is valid only while the handle is alive
+    return np.ndarray(shape, dtype = np.dtype(dtype), buffer = memory.buf)
+
+# State of a worker process, set once by initWorker
+workerState = {}
+
+def initWorker(state, setup = None, *args):
+    '''
+    Initializer of a worker process (see ProcessPoolExecutor): keep `state` ({name: value}) in workerState
+    for the tasks run by the worker, updated with what `setup(*args)` returns if given,
+    e.g. arrays attached to shared memory with attachArray.
+    '''
+    workerState.update(state)
+    if setup != None:
+        workerState.update(setup(*args))
@@ -1,6 +1,10 @@
+from functools import partial
 from math import sqrt
 
 import numpy as np
+from scipy import sparse
+
+from matrix import replaceRows
 
 
 def cosine(dataA, dataB):
@@ -103,8 +107,395 @@ def pearson(dataA, dataB, significanceWeighting = False):
     
 def jaccard(dataA, dataB):
     # Jaccard similarity is applicable to both list type and dictionary type.
-    nIntersection = sum([1 for obj in dataA if obj in dataB])
+    if type(dataA) is dict and type(dataB) is dict:
+        nIntersection = len(dataA.keys() & dataB.keys())
+    else:
+        nIntersection = sum([1 for obj in dataA if obj in dataB])
     nUnion = len(dataA) + len(dataB) - nIntersection
     if nUnion == 0:
         return -1
     return nIntersection / nUnion
+
+class RowBlock(object):
+    '''
+    Rows of an entity matrix together with the derived data a block measure needs.
+    Every field is indexed by row, so a block can be sliced with `take`.
+    '''
+    def __init__(self, **fields):
+        self.fields = fields
+        for name, value in fields.items():
+            setattr(self, name, value)
+    
+    def __len__(self):
+        return self.data.shape[0]
+    
+    def take(self, rows):
+        return RowBlock(**{name: value[rows] for name, value in self.fields.items()})
+    
+    def replace(self, rows, block, nColumns):
+        '''
+        Block with the given rows (sorted) replaced by the rows of `block`, in order, where rows past the end are appended,
+        and sparse fields having `nColumns` columns. Fields missing from `block` are left out.
+        Sparse fields are spliced (see matrix.replaceRows) and dense ones copied, without deriving anything again.
+        '''
+        rows = np.asarray(rows, dtype = np.int64)
+        nRows = max(len(self), int(rows[-1]) + 1 if len(rows) > 0 else 0)
+        fields = {}
+        for name, value in self.fields.items():
+            if name not in block.fields:
+                continue
+            new = block.fields[name]
+            if sparse.issparse(value):
+                indptr, (indices, data) = replaceRows(value.indptr, (value.indices, value.data), rows, new.indptr,
+                                                      (new.indices, new.data), nRows)
+                fields[name] = sparse.csr_matrix((data, indices, indptr), shape = (nRows, nColumns))
+                fields[name].has_sorted_indices = value.has_sorted_indices and new.has_sorted_indices
+            else:
+                # Bitsets get wider when columns are added, the new words of the old rows being zero
+                grown = np.zeros((nRows,) + new.shape[1:], dtype = value.dtype)
+                grown[(slice(0, len(value)),) + tuple(slice(0, size) for size in value.shape[1:])] = value
+                grown[rows] = new
+                fields[name] = grown
+        return RowBlock(**fields)
+
+def withData(X, data):
+    # Same sparsity structure as `X` (explicit zeros included) with different values
+    return sparse.csr_matrix((data, X.indices, X.indptr), shape = X.shape)
+
+def product(A, B):
+    # Dense (len(A) x len(B)) result of A * B^T
+    if transposeLeft(A, B):
+        return (B @ A.T).T.toarray()
+    return (A @ B.T).toarray()
+
+def sparseProduct(A, B):
+    # A * B^T as a CSR matrix
+    if transposeLeft(A, B):
+        return sparse.csr_matrix((B @ A.T).T)
+    return sparse.csr_matrix(A @ B.T)
+
+def transposeLeft(A, B):
+    '''
+    Whether A * B^T is computed as (B * A^T)^T, converting A and the result instead of B.
+    That is cheaper when a few rows are compared with a whole block (e.g. to update neighbors), and the sums are the same,
+    as both rows list their features in order.
+    '''
+    return A.nnz + A.shape[0] * B.shape[0] < B.nnz
+
+class CandidatePairs(object):
+    '''
+    Pairs of rows of two prepared blocks A and B sharing at least one feature, which are the entries of the sparse product
+    of their patterns (`overlaps`), grouped by row of A. `select` keeps some of the pairs, and `sample` reads the entries
+    of another product of the two blocks at the pairs kept.
+    A product of matrices with the sparsity structures of the patterns (see withData) holds the same entries in the same order
+    unless some of its sums cancel out to 0, so it is usually read as is, without looking up every pair.
+    '''
+    def __init__(self, A, B):
+        self.overlaps = sparseProduct(A.pattern, B.pattern)
+        self.positions = np.arange(self.overlaps.nnz)
+        self.rows = np.repeat(np.arange(self.overlaps.shape[0], dtype = np.int64), np.diff(self.overlaps.indptr))
+        self.columns = self.overlaps.indices.astype(np.int64)
+        self.index = None
+    
+    def __len__(self):
+        return len(self.positions)
+    
+    def select(self, selected):
+        self.positions = self.positions[selected]
+        self.rows = self.rows[selected]
+        self.columns = self.columns[selected]
+        self.index = None
+    
+    def overlap(self):
+        return self.overlaps.data[self.positions]
+    
+    def sample(self, X, Y):
+        # Entries of X * Y^T at the pairs, 0 where the product stores nothing
+        P = sparseProduct(X, Y)
+        if P.nnz == self.overlaps.nnz and np.array_equal(P.indptr, self.overlaps.indptr) \
+                and np.array_equal(P.indices, self.overlaps.indices):
+            return P.data[self.positions]
+        # The entries missing from P (or in another order) are looked up in a map of the tile to the pairs
+        if self.index is None:
+            self.index = np.full(self.overlaps.shape, -1, dtype = np.int64)
+            self.index[self.rows, self.columns] = np.arange(len(self))
+        positions = self.index[np.repeat(np.arange(P.shape[0]), np.diff(P.indptr)), P.indices]
+        found = positions >= 0
+        values = np.zeros(len(self))
+        values[positions[found]] = P.data[found]
+        return values
+
+# Similarities within this distance of 0 are reported as 0 by the block measures
+ZERO_TOLERANCE = 1e-12
+
+def snapZeros(similarities):
+    '''
+    Set similarities within ZERO_TOLERANCE of 0 to 0.
+    Sums of products cancelling out (e.g. the numerator of a correlation) are then exactly 0,
+    as they are in the measures on dictionaries, instead of a rounding error of either sign
+    depending on the order of the sum, which would pass the `similarity <= 0` cutoff of the recommenders.
+    The measures are bounded by 1, so the rounding errors are far below the tolerance.
+    '''
+    similarities[np.abs(similarities) < ZERO_TOLERANCE] = 0
+    return similarities
+
+class BlockMeasure(object):
+    '''
+    Vectorized counterpart of a similarity measure on dictionaries.
+    `prepare` derives what the measure needs from a CSR matrix whose rows are entities
+    (reading means and norms from `stats`, a matrix.Statistics of the same rows, if given), and `compute` returns the dense similarity matrix between two prepared blocks of rows,
+    using sparse matrix products instead of a dictionary intersection for every pair.
+    `computePairs` gives the same similarities for selected pairs of rows sharing at least one feature,
+    without computing the rest of the tile.
+    '''
+    def prepare(self, X, stats = None):
+        X = sparse.csr_matrix(X)
+        return RowBlock(data = X, pattern = withData(X, np.ones(X.nnz)), count = np.diff(X.indptr))
+    
+    def update(self, prepared, X, rows, stats = None):
+        '''
+        Block `prepared` from an earlier version of the entity matrix X, with the given (sorted) rows prepared again
+        from X and the rows added to X since (which must be among `rows`) appended, without preparing the other rows again.
+        '''
+        return prepared.replace(rows, self.prepare(X[rows], self.takeStats(stats, rows)), X.shape[1])
+    
+    @staticmethod
+    def takeStats(stats, rows):
+        # Statistics of the given rows only, for preparing them apart from the others
+        if stats == None:
+            return None
+        return RowBlock(count = stats.count[rows], mean = stats.mean[rows], norm = stats.norm[rows])
+    
+    def compute(self, A, B):
+        raise NotImplementedError
+    
+    def computePairs(self, A, B, pairs):
+        # Similarities of the CandidatePairs of A and B, in their order
+        raise NotImplementedError
+    
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+    
+    def __hash__(self):
+        return hash((type(self), tuple(sorted(vars(self).items()))))
+    
+    def overlap(self, A, B):
+        return product(A.pattern, B.pattern)
+    
+
+class CosineBlock(BlockMeasure):
+    def prepare(self, X, stats = None):
+        block = super().prepare(X)
+        X = block.data
+        if stats != None:
+            norm = stats.norm
+        else:
+            norm = np.sqrt(np.asarray(withData(X, X.data ** 2).sum(axis = 1)).ravel())
+        return RowBlock(norm = norm, **block.fields)
+    
+    def compute(self, A, B):
+        overlap = self.overlap(A, B)
+        denominator = np.outer(A.norm, B.norm)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            similarities = snapZeros(np.where(denominator == 0, -1.0, product(A.data, B.data) / denominator))
+        similarities[overlap == 0] = 0
+        return similarities
+    
+    def computePairs(self, A, B, pairs):
+        denominator = A.norm[pairs.rows] * B.norm[pairs.columns]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return snapZeros(np.where(denominator == 0, -1.0, pairs.sample(A.data, B.data) / denominator))
+
+class CosineIntersectionBlock(BlockMeasure):
+    def prepare(self, X, stats = None):
+        block = super().prepare(X)
+        return RowBlock(squared = withData(block.data, block.data.data ** 2), **block.fields)
+    
+    def compute(self, A, B):
+        overlap = self.overlap(A, B)
+        denominator = np.sqrt(product(A.squared, B.pattern)) * np.sqrt(product(A.pattern, B.squared))
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            similarities = snapZeros(np.where(denominator == 0, -1.0, product(A.data, B.data) / denominator))
+        similarities[overlap == 0] = 0
+        return similarities
+    
+    def computePairs(self, A, B, pairs):
+        denominator = (np.sqrt(pairs.sample(A.squared, B.pattern))
+                       * np.sqrt(pairs.sample(A.pattern, B.squared)))
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return snapZeros(np.where(denominator == 0, -1.0, pairs.sample(A.data, B.data) / denominator))
+
+class PearsonBlock(BlockMeasure):
+    def __init__(self, significanceWeighting = False):
+        self.significanceWeighting = significanceWeighting
+    
+    def prepare(self, X, stats = None):
+        block = super().prepare(X)
+        X, count = block.data, block.count
+        if stats != None:
+            mean = stats.mean
+        else:
+            sums = np.asarray(X.sum(axis = 1)).ravel()
+            mean = np.divide(sums, count, out = np.zeros(len(count)), where = count > 0)
+        centered = withData(X, X.data - np.repeat(mean, count))
+        return RowBlock(centered = centered, centeredSquared = withData(X, centered.data ** 2), **block.fields)
+    
+    def compute(self, A, B):
+        overlap = self.overlap(A, B)
+        deviation = np.sqrt(product(A.centeredSquared, B.pattern)) * np.sqrt(product(A.pattern, B.centeredSquared))
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            correlations = snapZeros(np.where(deviation == 0, 0.0, product(A.centered, B.centered) / deviation))
+        correlations[overlap == 0] = 0
+        
+        # Correlation significance weighting
+        if self.significanceWeighting == True:
+            correlations = np.where(overlap < 50, correlations * (overlap / 50), correlations)
+        return correlations
+    
+    def computePairs(self, A, B, pairs):
+        deviation = (np.sqrt(pairs.sample(A.centeredSquared, B.pattern))
+                     * np.sqrt(pairs.sample(A.pattern, B.centeredSquared)))
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            correlations = snapZeros(np.where(deviation == 0, 0.0, pairs.sample(A.centered, B.centered) / deviation))
+        if self.significanceWeighting == True:
+            overlap = pairs.overlap()
+            correlations = np.where(overlap < 50, correlations * (overlap / 50), correlations)
+        return correlations
+
+class JaccardBlock(BlockMeasure):
+    def compute(self, A, B):
+        nIntersection = self.overlap(A, B)
+        nUnion = A.count[:, None] + B.count[None, :] - nIntersection
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return np.where(nUnion == 0, -1.0, nIntersection / nUnion)
+    
+    def computePairs(self, A, B, pairs):
+        nIntersection = pairs.overlap()
+        nUnion = A.count[pairs.rows] + B.count[pairs.columns] - nIntersection
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return np.where(nUnion == 0, -1.0, nIntersection / nUnion)
+
+def packBits(X, chunkSize = 1 << 24):
+    # Rows of a CSR matrix as bitsets: (# of rows) x ceil(# of columns / 64) words,
+    # packed from a dense temporary of at most `chunkSize` bits at a time
+    nWords = -(-X.shape[1] // 64)
+    words = np.empty((X.shape[0], nWords), dtype = np.uint64)
+    step = max(1, chunkSize // max(nWords * 64, 1))
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    for start in range(0, X.shape[0], step):
+        stop = min(start + step, X.shape[0])
+        entries = slice(X.indptr[start], X.indptr[stop])
+        dense = np.zeros((stop - start, nWords * 64), dtype = bool)
+        dense[rows[entries] - start, X.indices[entries]] = True
+        words[start:stop] = np.packbits(dense, axis = 1, bitorder = "little").view(np.uint64)
+    return words
+
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype = np.uint8)
+
+def popcount(words):
+    if hasattr(np, "bitwise_count"):        # NumPy 2.0 or later
+        return np.bitwise_count(words)
+    return POPCOUNT[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis = -1, dtype = np.uint8)
+
+def intersectBits(A, B, chunkSize = 1 << 24):
+    # Dense (len(A) x len(B)) counts of the bits set in both rows, computed on at most `chunkSize` words at a time
+    counts = np.empty((A.shape[0], B.shape[0]))
+    step = max(1, chunkSize // max(B.shape[0] * A.shape[1], 1))
+    for start in range(0, A.shape[0], step):
+        counts[start:start + step] = popcount(A[start:start + step, None, :] & B[None, :, :]).sum(axis = 2, dtype = np.int64)
+    return counts
+
+class UnaryBlock(BlockMeasure):
+    '''
+    Base of the measures on unary data, where every rating is 1 and similarities depend only on intersection counts.
+    The counts of a tile come from one product of the sparsity patterns, a merge of the sorted feature indices of the rows,
+    while the measures on ratings need up to four products. Blocks in which more than `bitsetDensity` of the features
+    are set on average are also packed into bitsets, and the counts between two such blocks are popcounts
+    of their words, which is faster than the product only for such dense rows.
+    The similarities are exactly those of the measures on ratings.
+    '''
+    bitsetDensity = 0.15
+    
+    def prepare(self, X, stats = None):
+        block = super().prepare(X, stats)
+        X = block.data
+        if X.shape[0] > 0 and X.nnz > self.bitsetDensity * X.shape[0] * X.shape[1]:
+            return RowBlock(bits = packBits(X), **block.fields)
+        return block
+    
+    def update(self, prepared, X, rows, stats = None):
+        # The rows are packed into bitsets if and only if the whole block already is, whatever their own density
+        block = super(UnaryBlock, self).prepare(X[rows], self.takeStats(stats, rows))
+        if "bits" in prepared.fields:
+            block = RowBlock(bits = packBits(block.data), **block.fields)
+        return prepared.replace(rows, block, X.shape[1])
+    
+    def overlap(self, A, B):
+        if "bits" in A.fields and "bits" in B.fields:
+            return intersectBits(A.bits, B.bits)
+        return product(A.pattern, B.pattern)
+
+class UnaryCosineBlock(UnaryBlock, CosineBlock):
+    def compute(self, A, B):
+        # The dot product of two unary rows is their intersection count
+        overlap = self.overlap(A, B)
+        denominator = np.outer(A.norm, B.norm)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            similarities = np.where(denominator == 0, -1.0, overlap / denominator)
+        similarities[overlap == 0] = 0
+        return similarities
+    
+    def computePairs(self, A, B, pairs):
+        denominator = A.norm[pairs.rows] * B.norm[pairs.columns]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return np.where(denominator == 0, -1.0, pairs.overlap() / denominator)
+
+class UnaryCosineIntersectionBlock(UnaryBlock):
+    def compute(self, A, B):
+        # The squared norms of two unary rows over their intersection are the intersection count
+        overlap = self.overlap(A, B)
+        denominator = np.sqrt(overlap) * np.sqrt(overlap)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            similarities = np.where(denominator == 0, -1.0, overlap / denominator)
+        similarities[overlap == 0] = 0
+        return similarities
+    
+    def computePairs(self, A, B, pairs):
+        overlap = pairs.overlap()
+        denominator = np.sqrt(overlap) * np.sqrt(overlap)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return np.where(denominator == 0, -1.0, overlap / denominator)
+
+class UnaryJaccardBlock(UnaryBlock, JaccardBlock):
+    pass
+
+def getMeasureName(simMeasure):
+    '''
+    Name of a similarity measure recorded in model files, e.g. 'cosine' or 'pearson(significanceWeighting=True)'.
+    '''
+    if isinstance(simMeasure, partial):
+        arguments = [repr(arg) for arg in simMeasure.args] + ["{}={!r}".format(key, value) for key, value in sorted(simMeasure.keywords.items())]
+        return "{}({})".format(getMeasureName(simMeasure.func), ", ".join(arguments))
+    return getattr(simMeasure, "__name__", type(simMeasure).__name__)
+
+def getBlockMeasure(simMeasure, unary = False):
+    '''
+    Return the vectorized counterpart of a similarity measure, or None if there is no counterpart.
+    Keyword arguments given with functools.partial are supported, e.g. partial(pearson, significanceWeighting = True).
+    If `unary` is True, the data must be unary (every rating is 1), and the measures for unary data are returned when available.
+    '''
+    kwargs = {}
+    if isinstance(simMeasure, partial) and len(simMeasure.args) == 0:
+        kwargs = simMeasure.keywords
+        simMeasure = simMeasure.func
+    if simMeasure is pearson and set(kwargs) <= {"significanceWeighting"}:
+        return PearsonBlock(**kwargs)
+    if len(kwargs) > 0:
+        return None
+    if simMeasure is cosine:
+        return UnaryCosineBlock() if unary else CosineBlock()
+    if simMeasure is cosine_intersection:
+        return UnaryCosineIntersectionBlock() if unary else CosineIntersectionBlock()
+    if simMeasure is jaccard:
+        return UnaryJaccardBlock() if unary else JaccardBlock()
+    return None
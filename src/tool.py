@@ -1,42 +1,166 @@
+import gzip
 import os
 
+import numpy as np
+import instrument
+from matrix import RatingMatrix
 
-def loadData(filePath, inv = False):
+
+def openFile(filePath):
+    # Gzip-compressed files are detected by their magic number
+    with open(filePath, "rb") as file:
+        compressed = file.read(2) == b"\x1f\x8b"
+    return gzip.open(filePath, "rb") if compressed else open(filePath, "rb")
+
+def readChunks(file, chunkSize):
+    # Yield chunks of complete lines
+    remainder = b""
+    while True:
+        chunk = file.read(chunkSize)
+        if not chunk:
+            break
+        chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        if end > 0:
+            yield chunk[:end]
+    if remainder:
+        yield remainder
+
+def gatherFields(data, starts, ends):
+    # Copy byte ranges [starts[i], ends[i]) into a fixed-width byte string array
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if len(lengths) > 0 else 1
+    fields = np.zeros((len(starts), width), dtype = np.uint8)
+    for k in range(width):
+        column = data[np.minimum(starts + k, len(data) - 1)]
+        column[lengths <= k] = 0
+        fields[:, k] = column
+    return fields.view("S{}".format(width)).ravel()
+
+def parseChunk(chunk):
     '''
-    Load data from a input file into memory with dictionary format.
+    Split the lines of a chunk into fields without a Python loop over lines.
+    Return user tokens, item tokens and ratings of the lines having at least two fields (rating is 1 if missing).
+    '''
+    data = np.frombuffer(chunk, dtype = np.uint8)
+    ends = np.flatnonzero(data == ord("\n"))
+    if len(data) > 0 and data[-1] != ord("\n"):
+        ends = np.append(ends, len(data))
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)
+    ends = ends - ((ends > starts) & (data[np.maximum(ends - 1, 0)] == ord("\r")))    # Universal newlines, as in text mode
+    
+    tabs = np.append(np.flatnonzero(data == ord("\t")), len(data))
+    first = np.searchsorted(tabs, starts)
+    second = tabs[np.minimum(first + 1, len(tabs) - 1)]
+    third = tabs[np.minimum(first + 2, len(tabs) - 1)]
+    first = tabs[first]
+    valid = first < ends                # Lines with less than two fields are skipped
+    starts, ends, first, second, third = starts[valid], ends[valid], first[valid], second[valid], third[valid]
+    hasRating = second < ends
+    
+    users = gatherFields(data, starts, first)
+    items = gatherFields(data, first + 1, np.minimum(second, ends))
+    ratings = np.ones(len(starts))
+    ratings[hasRating] = gatherFields(data, second[hasRating] + 1, np.minimum(third, ends)[hasRating]).astype(np.float64)
+    return users, items, ratings
+
+def encodeTokens(tokens, index):
+    '''
+    Map byte-string tokens to integer IDs in `index` ({ID: code}), adding new IDs in order of their first appearance.
+    Only the distinct tokens of a chunk are handled in Python.
+    '''
+    keys = tokens
+    if 0 < tokens.itemsize <= 8:       # Short tokens are compared as integers, which sorts much faster
+        padded = np.zeros((len(tokens), 8), dtype = np.uint8)
+        padded[:, 0:tokens.itemsize] = tokens.view(np.uint8).reshape(len(tokens), tokens.itemsize)
+        keys = padded.view(np.uint64).ravel()
+    distinct, first, inverse = np.unique(keys, return_index = True, return_inverse = True)
+    codes = np.empty(len(distinct), dtype = np.int32)
+    for i in np.argsort(first, kind = "stable").tolist():
+        codes[i] = index.setdefault(tokens[first[i]].decode("utf-8"), len(index))
+    return codes[inverse.ravel()]
+
+def loadColumns(filePath, cache = False, chunkSize = 1 << 24, dtype = np.float32):
+    '''
+    Load data from a input file (optionally gzip-compressed) into columns.
+    The file is read in chunks of `chunkSize` bytes and each chunk is parsed with vectorized operations.
+    If `cache` is True, the columns are saved to a sidecar file (filePath + ".npz") with float64 ratings,
+    which is reused for any `dtype` as long as the size and modification time of the input file do not change.
     * Input file format: userID \t itemID \t rating \n
-    * Output data format: {userID: {itemID: rating, ...}, ...}
+    * Output data format: (users, items, ratings, userIDs, itemIDs)
+      users, items: int32 arrays of indices into userIDs and itemIDs (in order of first appearance)
+      ratings: array of rating scores (`dtype`)
     '''
-    data = {}
+    cachePath = filePath + ".npz"
     try:
-        with open(filePath) as file:
-            for line in file:
-                line = line.replace("\n", "")
-                tokens = line.split("\t")
-                
-                if len(tokens) < 2:
-                    continue
-                elif len(tokens) == 2:
-                    user = tokens[0]
-                    item = tokens[1]
-                    rating = 1
-                else:
-                    user = tokens[0]
-                    item = tokens[1]
-                    rating = tokens[2]
-                
-                # Store data
-                if inv == False:
-                    data.setdefault(user, {})
-                    data[user][item] = float(rating)
-                else:
-                    data.setdefault(item, {})
-                    data[item][user] = float(rating)
-            file.close()
+        status = os.stat(filePath)
+        if cache == True and os.path.exists(cachePath):
+            with np.load(cachePath) as cached:
+                if cached["source"].tolist() == [status.st_size, status.st_mtime_ns] and cached["ratings"].dtype == np.float64:
+                    return (cached["users"], cached["items"], cached["ratings"].astype(dtype),
+                            cached["userIds"].tolist(), cached["itemIds"].tolist())
+        
+        userIndex = {}
+        itemIndex = {}
+        users, items, ratings = [], [], []
+        with openFile(filePath) as file:
+            for chunk in readChunks(file, chunkSize):
+                userTokens, itemTokens, chunkRatings = parseChunk(chunk)
+                users.append(encodeTokens(userTokens, userIndex))
+                items.append(encodeTokens(itemTokens, itemIndex))
+                ratings.append(chunkRatings)
+        columns = (np.concatenate(users) if users else np.empty(0, dtype = np.int32),
+                   np.concatenate(items) if items else np.empty(0, dtype = np.int32),
+                   np.concatenate(ratings) if ratings else np.empty(0, dtype = np.float64),
+                   list(userIndex), list(itemIndex))
     except IOError as e:
         print(e)
+        return np.empty(0, dtype = np.int32), np.empty(0, dtype = np.int32), np.empty(0, dtype = dtype), [], []
+    
+    if cache == True:
+        try:
+            with open(cachePath, "wb") as file:
+                np.savez(file, users = columns[0], items = columns[1], ratings = columns[2],
+                         userIds = np.array(columns[3], dtype = str), itemIds = np.array(columns[4], dtype = str),
+                         source = np.array([status.st_size, status.st_mtime_ns], dtype = np.int64))
+        except IOError as e:
+            print(e)
+    return columns[0:2] + (columns[2].astype(dtype, copy = False),) + columns[3:]
+
+def loadData(filePath, inv = False, cache = False):
+    '''
+    Load data from a input file into memory with dictionary format.
+    The file is parsed by loadColumns, so `inv` only swaps the user and item columns.
+    * Input file format: userID \t itemID \t rating \n
+    * Output data format: {userID: {itemID: rating, ...}, ...}
+    '''
+    with instrument.recorder.phase("load"):
+        users, items, ratings, userIds, itemIds = loadColumns(filePath, cache, dtype = np.float64)
+        if inv == True:
+            users, items, userIds, itemIds = items, users, itemIds, userIds
+        data = {}
+        for user, item, rating in zip(users.tolist(), items.tolist(), ratings.tolist()):
+            data.setdefault(userIds[user], {})[itemIds[item]] = rating
+    instrument.recorder.count("ratings loaded", len(ratings))
     return data
 
+def loadMatrix(filePath, inv = False, cache = False, dtype = np.float64):
+    '''
+    Load data from a input file into a sparse rating matrix.
+    User and item IDs are mapped to dense integer indices, so no nested dictionary is built.
+    If `inv` is True, items are regarded as users and vice versa.
+    * Input file format: userID \t itemID \t rating \n
+    * Output data format: matrix.RatingMatrix
+    '''
+    with instrument.recorder.phase("load"):
+        users, items, ratings, userIds, itemIds = loadColumns(filePath, cache, dtype = dtype)
+        if inv == True:
+            users, items, userIds, itemIds = items, users, itemIds, userIds
+        matrix = RatingMatrix.fromColumns(users, items, ratings, userIds, itemIds)
+    instrument.recorder.count("ratings loaded", len(ratings))
+    return matrix
+
 def transposePrefs(prefs):
     '''
     Transpose the preference data by switching object and subject.
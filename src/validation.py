@@ -1,121 +1,338 @@
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import os
 
+import numpy as np
+from matrix import RatingMatrix, prefsToColumns
+from modelfile import NeighborModel
+from recommender import ItemBased
+from shared import SharedArrays, attachArray, initWorker, workerState
 
-def evaluateRecommender(testSet, recommender, simMeasure = None, nNeighbors = None, model = None, topN = None):
-    # Evaluation metrics
-    totalPrecision = 0
-    totalRecall = 0
-    totalF1score = 0
-    totalHit = 0
-    
-    for user in testSet:
-        recommendation = recommender.Recommendation(user, simMeasure = simMeasure, nNeighbors = nNeighbors, model = model, topN = topN)
-        hit = sum([1 for item in testSet[user] if item in recommendation])
-        precision = hit / topN
-        recall = hit / len(testSet[user])
-        f1score = 0 if hit == 0 else 2 * precision * recall / (precision + recall)
-        
-        totalPrecision += precision
-        totalRecall += recall
-        totalF1score += f1score
-        totalHit += hit
-    
-    # Find final results
+
+class Evaluation(object):
+    '''
+    Evaluation results of each test user: `users` and an array of each metric in the same order.
+    * Precision, Recall, F1-score: of the top-N recommendations
+    * Hit-rate: number of test items in the top-N recommendations
+    * NDCG: normalized discounted cumulative gain of the top-N recommendations
+    * MAP: average precision at the ranks of the hits, divided by min(# of test items, N)
+    * MRR: reciprocal rank of the first hit (0 if none)
+    Coverage is the fraction of the training items recommended to at least one user.
+    '''
+    metrics = ["Precision", "Recall", "F1-score", "Hit-rate", "NDCG", "MAP", "MRR"]
+
+    def __init__(self, users, values, coverage):
+        self.users = users
+        self.values = values
+        self.coverage = coverage
+
+    def __getitem__(self, metric):
+        return self.values[metric]
+
+    def summary(self):
+        # Averages over the test users
+        result = {}
+        for metric in self.metrics:
+            result[metric] = float(np.mean(self.values[metric])) if len(self.users) > 0 else 0.0
+        result["Coverage"] = self.coverage
+        return result
+
+def getRecommendations(recommender, users, simMeasure, nNeighbors, model, topN):
+    # recommendBatch gives the recommendations of Recommendation,
+    # except for UserBased without a model, which finds the nearest neighbors having rated each item
+    if model != None or isinstance(recommender, ItemBased):
+        return recommender.recommendBatch(users, topN = topN, model = model, simMeasure = simMeasure, nNeighbors = nNeighbors)
+    return {user: recommender.Recommendation(user, simMeasure = simMeasure, nNeighbors = nNeighbors, model = model, topN = topN)
+            for user in users}
+
+def evaluateShard(recommender, users, testItems, simMeasure, nNeighbors, model, topN):
+    '''
+    Metrics of a shard of test users, whose test items are given as lists in `testItems`.
+    Recommendations are ranked in a matrix of item codes (users x N), and hits are found by looking up
+    (user, item) keys of the test set in one np.isin call.
+    Return the metric arrays and the codes of the recommended items.
+    '''
+    recommendations = getRecommendations(recommender, users, simMeasure, nNeighbors, model, topN)
+    itemIndex = dict(recommender.matrix.itemIndex)
+    nItems = len(itemIndex)
+    lists = [recommendations[user] for user in users]
+    lengths = np.array([len(recommendation) for recommendation in lists], dtype = np.int64)
+    width = topN if topN != None else int(lengths.max(initial = 0))
+    rows = np.repeat(np.arange(len(users)), lengths)
+    ranks = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    recommended = np.array([itemIndex[item] for recommendation in lists for item in recommendation], dtype = np.int64)
+
+    nTests = np.array([len(items) for items in testItems], dtype = np.int64)
+    testCodes = np.array([itemIndex.setdefault(item, len(itemIndex)) for items in testItems for item in items], dtype = np.int64)
+    testKeys = np.repeat(np.arange(len(users)), nTests) * len(itemIndex) + testCodes
+    hits = np.zeros((len(users), max(width, 1)))
+    hits[rows, ranks] = np.isin(rows * len(itemIndex) + recommended, testKeys)
+
+    discounts = 1 / np.log2(np.arange(hits.shape[1]) + 2)
+    hit = hits.sum(axis = 1)
+    values = {}
+    values["Precision"] = hit / topN if topN != None else np.divide(hit, lengths, out = np.zeros(len(users)), where = lengths > 0)
+    values["Recall"] = np.divide(hit, nTests, out = np.zeros(len(users)), where = nTests > 0)
+    total = values["Precision"] + values["Recall"]
+    values["F1-score"] = np.divide(2 * values["Precision"] * values["Recall"], total, out = np.zeros(len(users)), where = hit > 0)
+    values["Hit-rate"] = hit
+    idealHits = np.minimum(nTests, hits.shape[1])
+    idealGains = np.concatenate(([0], np.cumsum(discounts)))[idealHits]
+    values["NDCG"] = np.divide(hits @ discounts, idealGains, out = np.zeros(len(users)), where = idealHits > 0)
+    precisions = np.cumsum(hits, axis = 1) / np.arange(1, hits.shape[1] + 1)
+    values["MAP"] = np.divide((precisions * hits).sum(axis = 1), idealHits, out = np.zeros(len(users)), where = idealHits > 0)
+    firstHits = hits.argmax(axis = 1)
+    values["MRR"] = np.where(hit > 0, 1 / (firstHits + 1), 0.0)
+    return values, np.unique(recommended[recommended < nItems])
+
+def evaluateUsers(testSet, recommender, simMeasure = None, nNeighbors = None, model = None, topN = None, nJobs = 1, batchSize = 1024):
+    '''
+    Evaluate the top-N recommendations of every user of the test set ({user: {item: rating, ...}, ...}).
+    Recommendations are made for `batchSize` users at a time (see recommendBatch),
+    in `nJobs` processes if nJobs is not 1 (-1: all CPU cores), each holding a copy of the recommender.
+    Return an Evaluation with the metrics of each user.
+    '''
+    users = list(testSet)
+    testItems = [list(testSet[user]) for user in users]
+    shards = [range(start, min(start + batchSize, len(users))) for start in range(0, len(users), batchSize)]
+    if nJobs == 1:
+        results = [evaluateShard(recommender, users[shard.start:shard.stop], testItems[shard.start:shard.stop],
+                                 simMeasure, nNeighbors, model, topN) for shard in shards]
+    else:
+        if nJobs == None or nJobs < 1:
+            nJobs = os.cpu_count()
+        with ProcessPoolExecutor(max_workers = nJobs, initializer = initWorker,
+                                 initargs = ({"recommender": recommender, "model": model},)) as executor:
+            futures = [executor.submit(evaluateShardInWorker, users[shard.start:shard.stop], testItems[shard.start:shard.stop],
+                                       simMeasure, nNeighbors, topN) for shard in shards]
+            results = [future.result() for future in futures]
+
+    values = {metric: np.concatenate([result[0][metric] for result in results]) if results else np.zeros(0)
+              for metric in Evaluation.metrics}
+    recommended = np.unique(np.concatenate([result[1] for result in results])) if results else []
+    nItems = np.count_nonzero(np.diff(recommender.matrix.byItem.indptr))     # Items having ratings in the training data
+    coverage = float(len(recommended) / nItems) if nItems > 0 else 0.0
+    return Evaluation(users, values, coverage)
+
+def evaluateRecommender(testSet, recommender, simMeasure = None, nNeighbors = None, model = None, topN = None, nJobs = 1):
+    '''
+    Evaluate the top-N recommendations with evaluateUsers.
+    Return the averages of the metrics over the test users and the coverage: {metric: value, ...}
+    '''
+    return evaluateUsers(testSet, recommender, simMeasure, nNeighbors, model, topN, nJobs).summary()
+
+def comparePrecisions(testSet, recommender, model, precisions = (32, 16, 8), topN = 10, nJobs = 1):
+    '''
+    Evaluate a model stored in each precision (see modelfile.NeighborModel.quantize) with evaluateRecommender,
+    to weigh the memory saved by quantized similarities against the ranking quality lost.
+    `model` is a model built by `recommender`, as a dictionary or a NeighborModel.
+    Output format: {precision: {metric: value, ..., "Bytes": bytes of the model arrays}, ...}
+    '''
+    if not isinstance(model, NeighborModel):
+        model = NeighborModel.fromModel(model, type(recommender).__name__)
+    results = {}
+    for precision in precisions:
+        compact = model.quantize(precision)
+        results[precision] = evaluateRecommender(testSet, recommender, model = compact, topN = topN, nJobs = nJobs)
+        results[precision]["Bytes"] = compact.nbytes
+    return results
+
+def averageResults(evaluations):
     result = {}
-    result["Precision"] = totalPrecision / len(testSet)
-    result["Recall"] = totalRecall / len(testSet)
-    result["F1-score"] = totalF1score / len(testSet)
-    result["Hit-rate"] = totalHit / len(testSet)
+    for key in evaluations[0]:
+        result[key] = sum([evaluation[key] for evaluation in evaluations]) / len(evaluations)
     return result
 
+class RatingStore(object):
+    '''
+    Ratings of a dataset in flat arrays, in the order of its nested dictionaries:
+    * users, items: indices into userIds and itemIds
+    * ratings: rating scores
+    * positions: position of each rating among the ratings of its user
+    Training and test sets are selected with boolean masks over these arrays instead of copying the dictionaries.
+    '''
+    def __init__(self, users, items, ratings, userIds, itemIds):
+        self.users = users
+        self.items = items
+        self.ratings = ratings
+        self.userIds = userIds
+        self.itemIds = itemIds
+        counts = np.bincount(users, minlength = len(userIds))
+        self.positions = np.arange(len(users)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    @classmethod
+    def fromPrefs(cls, prefs):
+        return cls(*prefsToColumns(prefs))
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def getFolds(self, nFolds):
+        '''
+        Fold of each rating for k-fold validation.
+        The ratings of a user are split into `nFolds` runs of int(# of ratings / nFolds) in order,
+        and the last fold takes the remainder.
+        '''
+        unitLength = (np.bincount(self.users, minlength = len(self.userIds)) // nFolds)[self.users]
+        folds = self.positions // np.maximum(unitLength, 1)
+        return np.where(unitLength > 0, np.minimum(folds, nFolds - 1), nFolds - 1)
+
+    def toMatrix(self, mask = None):
+        '''
+        Rating matrix of the selected ratings (all if `mask` is None).
+        Every user is kept, but items without any selected rating are left out, as if the data was read from dictionaries.
+        '''
+        if mask is None:
+            return RatingMatrix.fromColumns(self.users, self.items, self.ratings, self.userIds, self.itemIds)
+        users, items, ratings = self.users[mask], self.items[mask], self.ratings[mask]
+        present, first = np.unique(items, return_index = True)
+        present = present[np.argsort(first)]                # Items in order of their first appearance
+        mapping = np.zeros(len(self.itemIds), dtype = np.int64)
+        mapping[present] = np.arange(len(present))
+        return RatingMatrix.fromColumns(users, mapping[items], ratings, self.userIds,
+                                        [self.itemIds[item] for item in present.tolist()])
+
+    def toPrefs(self, mask):
+        # Selected ratings as preferences on users, including the users without any selected rating
+        prefs = {user: {} for user in self.userIds}
+        for i in np.flatnonzero(mask).tolist():
+            prefs[self.userIds[self.users[i]]][self.itemIds[self.items[i]]] = float(self.ratings[i])
+        return prefs
+
+def evaluateFold(recommender, store, folds, fold, simMeasure, nNeighbors, model, topN):
+    testMask = folds == fold
+    recommender.loadData(store.toMatrix(~testMask))
+    return evaluateRecommender(store.toPrefs(testMask), recommender, simMeasure = simMeasure, nNeighbors = nNeighbors,
+                               model = model, topN = topN)
+
+def evaluateTrials(recommender, store, trials, simMeasure, nNeighbors, model, topN, incremental):
+    '''
+    Leave-one-out trials on a recommender holding the whole data set.
+    Each rating is removed with removeRatings, which also removes its contribution from the model
+    if `incremental` is True, and is restored with addRatings after the evaluation.
+    '''
+    evaluations = []
+    for trial in trials:
+        user, item, rating = store.userIds[store.users[trial]], store.itemIds[store.items[trial]], float(store.ratings[trial])
+        updated = recommender.removeRatings({user: [item]})
+        evaluations.append(evaluateRecommender({user: {item: rating}}, recommender, simMeasure = simMeasure, nNeighbors = nNeighbors,
+                                               model = updated if incremental else model, topN = topN))
+        recommender.addRatings({user: {item: rating}})
+    return evaluations
+
+def loadAll(recommender, store, modelParams):
+    # Load the whole data set and rebuild the tracked model on it
+    recommender.loadData(store.toMatrix())
+    if modelParams != None:
+        recommender.findModelNeighbors(**modelParams)
+
+def evaluateShardInWorker(users, testItems, simMeasure, nNeighbors, topN):
+    return evaluateShard(workerState["recommender"], users, testItems, simMeasure, nNeighbors, workerState["model"], topN)
+
+def attachStore(spec, userIds, itemIds, recommenderType, dataType, backend, neighborIndex):
+    # State of a worker reading the rating arrays shared by CrossValidation.getExecutor (see shared.initWorker)
+    memories = []
+    store = RatingStore(*[attachArray(memories, *array) for array in spec], userIds, itemIds)
+    return {"memories": memories, "store": store, "recommender": recommenderType(dataType, backend, neighborIndex)}
+
+def evaluateFoldInWorker(fold, nFolds, simMeasure, nNeighbors, model, topN):
+    store = workerState["store"]
+    return evaluateFold(workerState["recommender"], store, store.getFolds(nFolds), fold, simMeasure, nNeighbors, model, topN)
+
+def evaluateTrialsInWorker(trials, simMeasure, nNeighbors, model, topN, modelParams):
+    if "loaded" not in workerState:        # The whole data set is loaded once per worker
+        loadAll(workerState["recommender"], workerState["store"], modelParams)
+        workerState["loaded"] = True
+    return evaluateTrials(workerState["recommender"], workerState["store"], trials, simMeasure, nNeighbors, model, topN,
+                          modelParams != None)
+
 class CrossValidation(object):
+    '''
+    K-fold and leave-one-out validation.
+    With `nJobs` other than 1 (-1: all CPU cores), folds or trials are evaluated in a pool of processes,
+    each with a new recommender of the same type, data type and backend as the given one.
+    The rating arrays are shared with the workers through shared memory, and similarity measures must be picklable
+    (functions of a module, not lambdas).
+    '''
     def KFoldSplit(self, data, fold, nFolds):           # fold: 0~4 when 5-Fold validation
-        trainSet = deepcopy(data)                       # data = {user: {item: rating, ...}, ...}
-        testSet = {}
-        for user in data:
-            testSet.setdefault(user, {})
-            unitLength = int(len(data[user]) / nFolds)  # data[user] = {item: rating, ...}
-            lowerbound = unitLength * fold
-            upperbound = unitLength * (fold + 1) if fold < nFolds - 1 else len(data[user])
-            testItems = {}
-            for i, item in enumerate(data[user]):
-                if lowerbound <= i and i < upperbound:
-                    testItems[item] = float(trainSet[user].pop(item))
-            testSet[user] = testItems
-        return trainSet, testSet
-    
-    def KFold(self, data, recommender, simMeasure = None, nNeighbors = None, model = None, topN = 10, nFolds = 5):
+        store = RatingStore.fromPrefs(data)             # data = {user: {item: rating, ...}, ...}
+        testMask = store.getFolds(nFolds) == fold
+        return store.toPrefs(~testMask), store.toPrefs(testMask)
+
+    def KFold(self, data, recommender, simMeasure = None, nNeighbors = None, model = None, topN = 10, nFolds = 5, nJobs = 1):
         start_time = datetime.now()
-        
-        # Evaluation metrics
-        totalPrecision = 0
-        totalRecall = 0
-        totalF1score = 0
-        totalHitrate = 0
-        
-        for fold in range(nFolds):
-            trainSet, testSet = self.KFoldSplit(data, fold, nFolds)
-            recommender.loadData(trainSet)
-            evaluation = evaluateRecommender(testSet, recommender, simMeasure = simMeasure, nNeighbors = nNeighbors, model = model, topN = topN)
-                
-            totalPrecision += evaluation["Precision"]
-            totalRecall += evaluation["Recall"]
-            totalF1score += evaluation["F1-score"]
-            totalHitrate += evaluation["Hit-rate"]
-            
-            del(trainSet)
-            del(testSet)
-        
+        store = RatingStore.fromPrefs(data)
+
+        if nJobs == 1:
+            folds = store.getFolds(nFolds)
+            evaluations = [evaluateFold(recommender, store, folds, fold, simMeasure, nNeighbors, model, topN) for fold in range(nFolds)]
+        else:
+            with self.getExecutor(store, recommender, min(nFolds, self.getJobs(nJobs))) as executor:
+                futures = [executor.submit(evaluateFoldInWorker, fold, nFolds, simMeasure, nNeighbors, model, topN)
+                           for fold in range(nFolds)]
+                evaluations = [future.result() for future in futures]
+
         # Find final results
-        result = {}
-        result["Precision"] = totalPrecision / nFolds
-        result["Recall"] = totalRecall / nFolds
-        result["F1-score"] = totalF1score / nFolds
-        result["Hit-rate"] = totalHitrate / nFolds
-        
+        result = averageResults(evaluations)
         print("Execution time: {}".format(datetime.now() - start_time))
         return result
-    
+
     def LeaveKOutSplit(self, data, user, items):        # `user` should have rating scores on `items` in `data`
-        trainSet = deepcopy(data)                       # To prevent original input data from being modified
-        testSet = {}
+        trainSet = {other: (ratings if other != user else dict(ratings)) for other, ratings in data.items()}
+        testSet = {}                                    # Only the ratings of `user` are copied
         testSet.setdefault(user, {})
         for item in items:
             testSet[user][item] = float(trainSet[user].pop(item))
         return trainSet, testSet
-    
-    def LeaveOneOut(self, data, recommender, simMeasure = None, nNeighbors = None, model = None, topN = 10):
+
+    def LeaveOneOut(self, data, recommender, simMeasure = None, nNeighbors = None, model = None, topN = 10, nJobs = 1):
+        '''
+        Leave each rating out in turn, in the order of `data`.
+        The data is loaded once, and each held-out rating is removed and restored incrementally.
+        If a model is given and the recommender has built a model with buildModel,
+        that model is rebuilt on the whole data set and each held-out rating is removed from it as well;
+        otherwise, the given model is used as it is.
+        '''
         start_time = datetime.now()
-        
-        # Evaluation metrics
-        totalPrecision = 0
-        totalRecall = 0
-        totalF1score = 0
-        totalHitrate = 0
-        
-        nTrials = 0
-        for user in data:
-            for item in data[user]:
-                trainSet, testSet = self.LeaveKOutSplit(data, user, [item])
-                recommender.loadData(trainSet)
-                evaluation = evaluateRecommender(testSet, recommender, simMeasure = simMeasure, nNeighbors = nNeighbors, model = model, topN = topN)
-                
-                totalPrecision += evaluation["Precision"]
-                totalRecall += evaluation["Recall"]
-                totalF1score += evaluation["F1-score"]
-                totalHitrate += evaluation["Hit-rate"]
-                nTrials += 1
-                
-                del(trainSet)
-                del(testSet)
-        
+        store = RatingStore.fromPrefs(data)
+        modelParams = recommender.modelParams if model != None else None
+        trials = np.arange(len(store))
+
+        if nJobs == 1:
+            loadAll(recommender, store, modelParams)
+            evaluations = evaluateTrials(recommender, store, trials, simMeasure, nNeighbors, model, topN, modelParams != None)
+        else:
+            nJobs = self.getJobs(nJobs)
+            evaluations = []
+            with self.getExecutor(store, recommender, nJobs) as executor:
+                futures = [executor.submit(evaluateTrialsInWorker, shard, simMeasure, nNeighbors, model, topN, modelParams)
+                           for shard in np.array_split(trials, max(1, min(nJobs * 4, len(trials))))]
+                for future in futures:
+                    evaluations.extend(future.result())
+
         # Find final results
-        result = {}
-        result["Precision"] = totalPrecision / nTrials
-        result["Recall"] = totalRecall / nTrials
-        result["F1-score"] = totalF1score / nTrials
-        result["Hit-rate"] = totalHitrate / nTrials
-        
+        result = averageResults(evaluations)
         print("Execution time: {}".format(datetime.now() - start_time))
         return result
+
+    def getJobs(self, nJobs):
+        return os.cpu_count() if nJobs == None or nJobs < 1 else nJobs
+
+    def getExecutor(self, store, recommender, nJobs):
+        shared = SharedArrays()
+        spec = [shared.share(store.users), shared.share(store.items), shared.share(store.ratings)]
+        return SharedExecutor(shared, max_workers = nJobs, initializer = initWorker,
+                              initargs = ({}, attachStore, spec, store.userIds, store.itemIds, type(recommender), recommender.dataType,
+                                          recommender.backend, recommender.neighborIndex))
+
+class SharedExecutor(ProcessPoolExecutor):
+    # Process pool which releases the shared arrays of its workers on exit
+    def __init__(self, shared, **kwargs):
+        super().__init__(**kwargs)
+        self.shared = shared
+
+    def shutdown(self, *args, **kwargs):
+        try:
+            super().shutdown(*args, **kwargs)
+        finally:
+            self.shared.release()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of the package are imported from src, as in the examples of the README
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
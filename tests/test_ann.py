@@ -0,0 +1,79 @@
+import random
+
+import numpy as np
+import pytest
+
+import ann
+import similarity
+from recommender import Backend, DataType, UserBased
+
+
+def makeClusteredPrefs(seed, nUsers = 120, nClusters = 6, nItems = 60):
+    # Users of a cluster rate items of the same slice, so that their nearest neighbors are mostly in their cluster
+    generator = random.Random(seed)
+    width = nItems // nClusters
+    prefs = {}
+    for user in range(nUsers):
+        cluster = user % nClusters
+        items = generator.sample(range(cluster * width, (cluster + 1) * width), generator.randint(3, 8))
+        items += generator.sample(range(nItems), generator.randint(0, 2))
+        prefs["u%d" % user] = {"i%d" % item: float(generator.randint(1, 5)) for item in items}
+    return prefs
+
+def makeRecommender(neighborIndex, prefs):
+    recommender = UserBased(DataType.Explicit, Backend.Sparse, neighborIndex)
+    recommender.loadData(prefs)
+    return recommender
+
+
+@pytest.mark.parametrize("neighborIndex, simMeasure, minRecall", [
+    (ann.MinHashLSH(nTables = 32), similarity.jaccard, 0.9),
+    (ann.HyperplaneLSH(nTables = 16, nBits = 4), similarity.cosine, 0.9),
+])
+def test_recall(neighborIndex, simMeasure, minRecall):
+    # Candidates of the index are scored exactly, and most of the true neighbors are found
+    recommender = makeRecommender(neighborIndex, makeClusteredPrefs(1))
+    targets = list(recommender.prefs)
+    assert ann.compareWithExact(recommender, simMeasure, targets, 10)["Recall"] >= minRecall
+    exact = recommender.getNeighborhoods(simMeasure, None, targets)
+    for target in targets:
+        similarities = {neighbor: value for value, neighbor in exact[target]}
+        approximate = recommender.getNearestNeighbors(target, simMeasure, 10)
+        assert all(value == similarities[neighbor] for value, neighbor in approximate)
+
+def test_unsupportedMeasure(capsys):
+    # Measures the index does not serve are searched exactly, and reported once
+    prefs = makeClusteredPrefs(2)
+    recommender = makeRecommender(ann.HyperplaneLSH(), prefs)
+    exact = makeRecommender(None, prefs)
+    for target in ["u0", "u1"]:
+        assert recommender.getNearestNeighbors(target, similarity.cosine_intersection, 10) == \
+            exact.getNearestNeighbors(target, similarity.cosine_intersection, 10)
+    assert capsys.readouterr().out.count("HyperplaneLSH does not support cosine_intersection") == 1
+
+@pytest.mark.parametrize("minOverlap, maxPopularity", [(2, None), (None, 25), (1, 25)])
+def test_candidateConditions(minOverlap, maxPopularity):
+    # Candidates of the index are kept only if they meet minOverlap/maxPopularity, as in the exact search
+    prefs = makeClusteredPrefs(3)
+    recommender = makeRecommender(ann.MinHashLSH(nTables = 8), prefs)
+    exact = makeRecommender(None, prefs)
+    for target in list(prefs)[0:20]:
+        allowed = {neighbor: value for value, neighbor in
+                   exact.getNearestNeighbors(target, similarity.jaccard, None, minOverlap, maxPopularity)}
+        row = recommender.matrix.userIndex[target]
+        indexed = {recommender.matrix.userIds[candidate] for candidate in recommender.neighborIndex.query(row).tolist()}
+        approximate = recommender.getNearestNeighbors(target, similarity.jaccard, None, minOverlap, maxPopularity)
+        assert {neighbor for value, neighbor in approximate} == indexed & set(allowed)
+        assert all(value == allowed[neighbor] for value, neighbor in approximate)
+
+def test_updates():
+    # Keys updated with the ratings are those of an index built from the final ratings
+    prefs = makeClusteredPrefs(4)
+    recommender = makeRecommender(ann.MinHashLSH(nTables = 8, nRows = 2), prefs)
+    recommender.addRatings({"u3": {"i7": 4.0, "new item": 2.0}, "new user": {"i1": 3.0}})
+    recommender.removeRatings({"u5": list(prefs["u5"])})
+    rebuilt = ann.MinHashLSH(nTables = 8, nRows = 2)
+    rebuilt.build(recommender.matrix.byUser)
+    assert np.array_equal(recommender.neighborIndex.keys, rebuilt.keys)
+    assert np.array_equal(recommender.neighborIndex.empty, rebuilt.empty)
+    assert len(recommender.neighborIndex.query(recommender.matrix.userIndex["u5"])) == 0
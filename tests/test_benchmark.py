@@ -0,0 +1,22 @@
+import benchmark
+import similarity
+from recommender import Backend, DataType, ItemBased
+
+
+def test_measureResetsBeforeEachRun():
+    # The traced run starts from cleared caches like the timed one, and gives the same result
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    users, items, ratings = benchmark.generateRatings(60, 40, 0.1, seed = 1)
+    prefs = {}
+    for user, item, rating in zip(users.tolist(), items.tolist(), ratings.tolist()):
+        prefs.setdefault("u%d" % user, {})["i%d" % item] = rating
+    recommender.loadData(prefs)
+    model = recommender.buildModel(similarity.cosine, 5)
+    targets = list(recommender.prefsOnUser)[0:10]
+    states = []
+    def task():
+        states.append((len(recommender.blockCache), recommender.modelMatrix))
+        return recommender.recommendBatch(targets, 5, model)
+    result, seconds, peakMemory, breakdown = benchmark.measure(task, reset = recommender.clearCaches)
+    assert states == [(0, None), (0, None)]
+    assert peakMemory > 0 and result == recommender.recommendBatch(targets, 5, model)
@@ -0,0 +1,122 @@
+import copy
+import random
+
+import numpy as np
+import pytest
+
+import similarity
+from matrix import RatingMatrix
+from modelfile import NeighborModel
+from recommender import Backend, DataType, ItemBased, UserBased
+
+
+def makeData(seed, nUsers = 40, nItems = 30, unary = False):
+    generator = random.Random(seed)
+    return {"u%d" % user: {"i%d" % item: 1.0 if unary else float(generator.randint(1, 5))
+                           for item in generator.sample(range(nItems), generator.randint(0, 12))}
+            for user in range(nUsers)}
+
+def updateRandomly(recommender, generator, step, unary = False):
+    # Add or remove a few ratings, with a new user and new items now and then; return the updated model
+    prefsOnUser = recommender.prefsOnUser if recommender.inv else recommender.prefs
+    users = list(prefsOnUser)
+    rating = lambda: 1.0 if unary else float(generator.randint(1, 5))
+    if generator.random() < 0.5:
+        ratings = {user: {"i%d" % generator.randint(0, 33): rating() for _ in range(generator.randint(1, 3))}
+                   for user in generator.sample(users, generator.randint(1, 3))}
+        if generator.random() < 0.3:
+            ratings["new%d" % step] = {"i%d" % generator.randint(0, 35): rating() for _ in range(generator.randint(1, 3))}
+        return recommender.addRatings(ratings)
+    ratings = {user: generator.sample(list(prefsOnUser[user]), min(len(prefsOnUser[user]), generator.randint(1, 4)))
+               for user in generator.sample(users, generator.randint(1, 4)) if len(prefsOnUser[user]) > 0}
+    return recommender.removeRatings(ratings)
+
+def assertSameModel(model, expected):
+    if isinstance(expected, NeighborModel):
+        assert model.ids == expected.ids
+        for name in ("offsets", "neighbors", "similarities", "scales"):
+            assert np.array_equal(getattr(model, name), getattr(expected, name)), name
+        assert model.similarities.dtype == expected.similarities.dtype
+    else:
+        assert model == expected
+        assert list(model) == list(expected)
+
+
+@pytest.mark.parametrize("recommenderType", [UserBased, ItemBased])
+@pytest.mark.parametrize("unary", [False, True])
+@pytest.mark.parametrize("simMeasure, nNeighbors, minOverlap, precision", [
+    (similarity.cosine, 6, None, None),
+    (similarity.pearson, 5, None, 16),
+    (similarity.jaccard, None, None, 32),
+    (similarity.cosine_intersection, 8, 2, 8),
+    (similarity.jaccard, 4, 1, None),
+])
+def test_updatesMatchRebuild(recommenderType, unary, simMeasure, nNeighbors, minOverlap, precision):
+    # After each update, the neighbor lists and the model patched in place are those of a model built from scratch
+    dataType = DataType.Unary if unary else DataType.Explicit
+    recommender = recommenderType(dataType, Backend.Sparse)
+    recommender.loadData(makeData(1, unary = unary))
+    recommender.buildModel(simMeasure, nNeighbors, minOverlap = minOverlap, precision = precision)
+    generator = random.Random(2)
+    for step in range(10):
+        model = updateRandomly(recommender, generator, step, unary)
+        rebuilt = recommenderType(dataType, Backend.Sparse)
+        rebuilt.loadData(copy.deepcopy(recommender.matrix))
+        expected = rebuilt.buildModel(simMeasure, nNeighbors, minOverlap = minOverlap, precision = precision)
+        assert sorted(recommender.neighborLists) == sorted(rebuilt.neighborLists)
+        for row, (neighbors, similarities) in rebuilt.neighborLists.items():
+            assert np.array_equal(recommender.neighborLists[row][0], neighbors)
+            assert np.array_equal(recommender.neighborLists[row][1], similarities)
+        assertSameModel(model, expected)
+        assert recommender.model is model
+
+@pytest.mark.parametrize("precision", [None, 16])
+def test_modelMatrixIsPatched(precision):
+    # The item-item matrix of the model is patched row by row along with the model
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makeData(3))
+    model = recommender.buildModel(similarity.cosine, 5, precision = precision)
+    recommender.getModelMatrix(model)
+    generator = random.Random(4)
+    for step in range(10):
+        model = updateRandomly(recommender, generator, step)
+        assert recommender.modelMatrix[0] is model
+        rebuilt = ItemBased(DataType.Explicit, Backend.Sparse)
+        rebuilt.loadData(copy.deepcopy(recommender.matrix))
+        expected = rebuilt.getModelMatrix(rebuilt.buildModel(similarity.cosine, 5, precision = precision))
+        expected.sort_indices()
+        W = recommender.getModelMatrix(model)
+        assert W.shape == expected.shape
+        for name in ("indptr", "indices", "data"):
+            assert np.array_equal(getattr(W, name), getattr(expected, name)), name
+        users = list(recommender.prefsOnUser)
+        assert recommender.recommendBatch(users, 5, model, withScores = True) == \
+            rebuilt.recommendBatch(users, 5, rebuilt.model, withScores = True)
+
+def test_ratingMatrixUpdates():
+    # Rows and columns merged in place hold the same arrays as a matrix built from the final ratings
+    data = makeData(5)
+    matrix = RatingMatrix.fromPrefs(copy.deepcopy(data))
+    generator = random.Random(6)
+    for step in range(20):
+        if generator.random() < 0.5:
+            ratings = [("u%d" % generator.randint(0, 45), "i%d" % generator.randint(0, 35), float(generator.randint(1, 5)))
+                       for _ in range(generator.randint(1, 5))]
+            matrix.setRatings(ratings)
+            for user, item, rating in ratings:
+                data.setdefault(user, {})[item] = rating
+        else:
+            ratings = [(user, item) for user in generator.sample(list(data), 3) for item in list(data[user])[:2]]
+            matrix.removeRatings(ratings)
+            for user, item in ratings:
+                data[user].pop(item, None)
+        # Entities keep their indices even without ratings, so the expected matrix is built with the same IDs
+        entries = [(matrix.userIndex[user], matrix.itemIndex[item], rating) for user in data for item, rating in data[user].items()]
+        users, items, ratings = zip(*entries)
+        expected = RatingMatrix.fromColumns(users, items, ratings, matrix.userIds, matrix.itemIds)
+        for name in ("byUser", "byItem"):
+            X, Y = getattr(matrix, name), getattr(expected, name)
+            Y.sort_indices()
+            assert X.shape == Y.shape and X.has_sorted_indices
+            for field in ("indptr", "indices", "data"):
+                assert np.array_equal(getattr(X, field), getattr(Y, field)), (name, field)
@@ -0,0 +1,98 @@
+import pickle
+import random
+
+import numpy as np
+import pytest
+
+import modelfile
+import similarity
+from modelfile import NeighborModel
+from recommender import Backend, DataType, ItemBased, UserBased
+
+
+def makeNeighborLists(seed, nRows = 30, nNeighbors = 6):
+    # Neighbor lists of random lengths (some empty), sorted by descending similarity
+    generator = np.random.default_rng(seed)
+    neighborLists = {}
+    for row in range(nRows):
+        neighbors = generator.choice(nRows, size = generator.integers(0, nNeighbors + 1), replace = False)
+        neighborLists[row] = (neighbors, -np.sort(-generator.uniform(-1, 1, len(neighbors))))
+    return neighborLists
+
+def makePrefs(seed, nUsers = 30, nItems = 20):
+    generator = random.Random(seed)
+    return {"u%d" % user: {"i%d" % item: float(generator.randint(1, 5)) for item in generator.sample(range(nItems), generator.randint(1, 8))}
+            for user in range(nUsers)}
+
+def readVersion(path):
+    with open(path, "rb") as file:
+        return int(np.frombuffer(file.read(len(modelfile.MAGIC) + 4)[-4:], dtype = "<u4")[0])
+
+
+@pytest.mark.parametrize("bits, version", [(32, modelfile.VERSION), (16, modelfile.QUANTIZED_VERSION), (8, modelfile.QUANTIZED_VERSION)])
+def test_roundTrip(tmp_path, bits, version):
+    ids = ["e%d" % row for row in range(30)]
+    model = NeighborModel.fromNeighborLists(ids, makeNeighborLists(1), "UserBased", "cosine", 6, bits)
+    path = str(tmp_path / "model.bin")
+    model.save(path)
+    assert readVersion(path) == version
+    loaded = NeighborModel.load(path)
+    assert loaded.matches("UserBased", "cosine", 6, bits) and loaded.path == path
+    assert loaded.ids == ids
+    for name in ("offsets", "neighbors", "similarities"):
+        assert np.array_equal(getattr(loaded, name), getattr(model, name)), name
+        assert getattr(loaded, name).dtype == getattr(model, name).dtype, name
+    assert (loaded.scales is None) == (bits == 32)
+    if bits != 32:
+        assert np.array_equal(loaded.scales, model.scales)
+    assert dict(loaded) == dict(model)
+    # A mapped model is pickled as its path
+    assert dict(pickle.loads(pickle.dumps(loaded))) == dict(model)
+
+@pytest.mark.parametrize("bits", [16, 8])
+def test_quantizationError(bits):
+    # Decoded similarities are within half a step of the float32 values, and the order of each row is kept
+    neighborLists = makeNeighborLists(2)
+    ids = list(range(len(neighborLists)))
+    exact = NeighborModel.fromNeighborLists(ids, neighborLists, "UserBased")
+    quantized = NeighborModel.fromNeighborLists(ids, neighborLists, "UserBased", bits = bits)
+    rows = np.repeat(np.arange(len(ids)), np.diff(exact.offsets))
+    errors = np.abs(quantized.getSimilarities() - exact.getSimilarities())
+    assert np.all(errors <= quantized.scales[rows, 1] / 2 + 1e-6)
+    for row in range(len(ids)):
+        assert np.all(np.diff(quantized.getRow(row)[1]) <= 0)
+
+@pytest.mark.parametrize("recommenderType", [UserBased, ItemBased])
+@pytest.mark.parametrize("precision", [None, 32, 16])
+def test_dumpAndLoadModel(tmp_path, recommenderType, precision):
+    # A model written by buildModel is loaded back by buildModel with the same parameters, and rejected with others
+    path = str(tmp_path / "model.bin")
+    recommender = recommenderType(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(3))
+    model = recommender.buildModel(similarity.cosine, 5, pathDump = path, precision = precision)
+    assert readVersion(path) == (modelfile.VERSION if precision in (None, 32) else modelfile.QUANTIZED_VERSION)
+    loaded = recommenderType(DataType.Explicit, Backend.Sparse).buildModel(similarity.cosine, 5, pathDump = path, precision = precision)
+    assert isinstance(loaded, NeighborModel) and loaded.path == path
+    assert list(loaded) == list(model)
+    for entity in model:
+        if isinstance(model, NeighborModel):
+            assert loaded[entity] == model[entity]
+        elif recommenderType is ItemBased:
+            assert loaded[entity].keys() == model[entity].keys()
+            assert np.allclose(list(loaded[entity].values()), list(model[entity].values()), atol = 1e-6)
+        else:
+            assert [neighbor for similarity, neighbor in loaded[entity]] == [neighbor for similarity, neighbor in model[entity]]
+            assert np.allclose([similarity for similarity, neighbor in loaded[entity]],
+                               [similarity for similarity, neighbor in model[entity]], atol = 1e-6)
+    assert recommenderType(DataType.Explicit, Backend.Sparse).loadExtModel(path, similarity.cosine, 6, precision) == None
+
+def test_pickledModel(tmp_path):
+    # Models pickled by older versions are still loaded, without the parameter check
+    path = str(tmp_path / "model.pkl")
+    recommender = UserBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(4))
+    model = recommender.buildModel(similarity.cosine, 5)
+    with open(path, "wb") as file:
+        pickle.dump(model, file)
+    assert not modelfile.isModelFile(path)
+    assert UserBased(DataType.Explicit, Backend.Sparse).loadExtModel(path, similarity.pearson, 3) == model
@@ -0,0 +1,79 @@
+import random
+
+import numpy as np
+import pytest
+
+import neighborhood
+import similarity
+from matrix import RatingMatrix
+from recommender import Backend, DataType, UserBased
+from similarity import getBlockMeasure
+
+
+def makeTiedPrefs(seed, nUsers = 40, nItems = 12):
+    # Unary data in which many users rate the same items, so that many similarities are tied;
+    # IDs are shuffled so that the order of the rows is not the order of the IDs
+    generator = random.Random(seed)
+    patterns = [generator.sample(range(nItems), generator.randint(1, 4)) for _ in range(8)]
+    ids = ["u%02d" % user for user in range(nUsers)]
+    generator.shuffle(ids)
+    return {user: {"i%d" % item: 1.0 for item in generator.choice(patterns)} for user in ids}
+
+def expectedNeighbors(tile, overlap, tieRanks, row, nNeighbors, minOverlap):
+    # Reference top-K of a row from the whole tile: descending similarity, then descending tie rank
+    candidates = np.flatnonzero(np.arange(tile.shape[1]) != row)
+    if minOverlap != None:
+        candidates = candidates[overlap[row, candidates] >= minOverlap]
+    order = np.lexsort((-tieRanks[candidates], -tile[row, candidates]))
+    return candidates[order[:nNeighbors]]
+
+
+@pytest.mark.parametrize("simMeasure", [similarity.jaccard, similarity.cosine])
+@pytest.mark.parametrize("nNeighbors", [None, 1, 5])
+@pytest.mark.parametrize("minOverlap", [None, 1, 2])
+def test_topKIsIndependentOfBlockSizes(simMeasure, nNeighbors, minOverlap):
+    matrix = RatingMatrix.fromPrefs(makeTiedPrefs(1))
+    measure = getBlockMeasure(simMeasure, unary = True)
+    prepared = measure.prepare(matrix.entityMatrix())
+    tieRanks = neighborhood.getTieRanks(matrix.userIds)
+    tile = measure.compute(prepared, prepared)
+    overlap = measure.overlap(prepared, prepared)
+    rows = np.arange(len(prepared))
+    for rowBlockSize, columnBlockSize in ((1, 1), (2, 3), (7, 5), (None, None)):
+        found = neighborhood.findNeighbors(measure, prepared, rows, nNeighbors, tieRanks, rowBlockSize, columnBlockSize,
+                                           minOverlap = minOverlap)
+        for row, neighbors, similarities in found:
+            expected = expectedNeighbors(tile, overlap, tieRanks, row, nNeighbors, minOverlap)
+            assert np.array_equal(neighbors, expected), (rowBlockSize, columnBlockSize, row)
+            assert np.array_equal(similarities, tile[row, expected])
+
+def test_selectTopKIgnoresInputOrder():
+    values = np.array([0.5, 0.2, 0.5, 0.9, 0.5, 0.2])
+    tieRanks = np.array([3, 0, 5, 1, 4, 2])
+    expected = [3, 2, 4, 0]
+    assert neighborhood.selectTopK(values, tieRanks, 4).tolist() == expected
+    generator = np.random.default_rng(0)
+    for _ in range(10):
+        permutation = generator.permutation(len(values))
+        selected = neighborhood.selectTopK(values[permutation], tieRanks[permutation], 4)
+        assert permutation[selected].tolist() == expected
+
+@pytest.mark.parametrize("minOverlap", [None, 1])
+def test_blockPathMatchesScalarOrder(minOverlap):
+    # Ties are broken as sorting (similarity, neighbor) tuples in reverse, as the scalar path does
+    prefs = makeTiedPrefs(2)
+    recommender = UserBased(DataType.Unary, Backend.Sparse)
+    recommender.loadData(prefs)
+    scalar = lambda dataA, dataB: similarity.jaccard(dataA, dataB)
+    for nNeighbors in (None, 3):
+        block = recommender.getNeighborhoods(similarity.jaccard, nNeighbors, minOverlap = minOverlap)
+        assert block == recommender.getNeighborhoods(scalar, nNeighbors, minOverlap = minOverlap)
+
+@pytest.mark.parametrize("simMeasure, minOverlap", [(similarity.pearson, None), (similarity.cosine_intersection, 2)])
+def test_parallelModel(simMeasure, minOverlap):
+    # Workers reading the prepared block from shared memory build the model built serially
+    generator = random.Random(4)
+    recommender = UserBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData({user: {item: float(generator.randint(1, 5)) for item in ratings} for user, ratings in makeTiedPrefs(4).items()})
+    serial = recommender.buildModel(simMeasure, 5, minOverlap = minOverlap)
+    assert recommender.buildModel(simMeasure, 5, nJobs = 2, minOverlap = minOverlap) == serial
@@ -0,0 +1,53 @@
+import random
+
+import numpy as np
+import pytest
+
+import outofcore
+import similarity
+import tool
+from recommender import Backend, DataType, ItemBased, UserBased
+
+
+def writeRatings(path, seed, nUsers = 60, nItems = 40, unary = False):
+    generator = random.Random(seed)
+    lines = ["u%d\ti%d\t%s" % (generator.randint(0, nUsers), generator.randint(0, nItems), "1" if unary else generator.randint(1, 5))
+             for line in range(400)]
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+@pytest.mark.parametrize("recommenderType", [UserBased, ItemBased])
+@pytest.mark.parametrize("simMeasure, nNeighbors, minOverlap, maxPopularity, precision, unary", [
+    (similarity.cosine, 5, None, None, None, False),
+    (similarity.pearson, 4, 2, None, 16, False),
+    (similarity.cosine_intersection, 6, 1, 20, 8, False),
+    (similarity.jaccard, 5, None, None, None, True),
+])
+def test_sameFileAsInMemory(tmp_path, recommenderType, simMeasure, nNeighbors, minOverlap, maxPopularity, precision, unary):
+    # The out-of-core file is byte for byte the file written by buildModel on the data loaded as a RatingMatrix
+    dataPath = writeRatings(tmp_path / "data.tsv", 1, unary = unary)
+    dataType = DataType.Unary if unary else DataType.Explicit
+    inMemory = recommenderType(dataType, Backend.Sparse)
+    inMemory.loadData(tool.loadMatrix(dataPath))
+    inMemory.buildModel(simMeasure, nNeighbors, str(tmp_path / "memory.bin"), minOverlap = minOverlap,
+                        maxPopularity = maxPopularity, precision = precision)
+    outOfCore = recommenderType(dataType, Backend.Sparse)
+    for data, name in [(dataPath, "file.bin"), (tool.loadMatrix(dataPath), "matrix.bin")]:
+        outOfCore.buildModelOutOfCore(data, str(tmp_path / name), simMeasure, nNeighbors, blockSize = 7, minOverlap = minOverlap,
+                                      maxPopularity = maxPopularity, precision = precision)
+        assert (tmp_path / name).read_bytes() == (tmp_path / "memory.bin").read_bytes()
+
+@pytest.mark.parametrize("inv", [False, True])
+def test_blocksFromFile(tmp_path, inv):
+    # Blocks spilled from small chunks hold the rows of the matrix loaded at once
+    dataPath = writeRatings(tmp_path / "data.tsv", 2)
+    matrix = tool.loadMatrix(dataPath, inv = inv)
+    (tmp_path / "blocks").mkdir()
+    store = outofcore.BlockStore.fromFile(dataPath, str(tmp_path / "blocks"), 6, inv, chunkSize = 50)
+    assert store.ids == matrix.userIds
+    assert np.array_equal(store.popularity, np.bincount(matrix.byUser.indices, minlength = matrix.nItems))
+    for block in range(len(store)):
+        start = store.getStart(block)
+        assert (store.getRows(block) != matrix.byUser[start:start + 6]).nnz == 0
+    assert sorted(path.name for path in (tmp_path / "blocks").iterdir()) == sorted("block{}.npz".format(block) for block in range(len(store)))
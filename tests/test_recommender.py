@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+import similarity
+from recommender import Backend, DataType, ItemBased
+
+
+def makePrefs(seed, nUsers = 30, nItems = 25, ratings = (1, 5)):
+    generator = random.Random(seed)
+    return {"u%d" % user: {"i%d" % item: float(generator.randint(*ratings)) for item in generator.sample(range(nItems), generator.randint(1, 8))}
+            for user in range(nUsers)}
+
+def scoreAll(recommender, user, model, topN):
+    # Scores of every rated item the user has not rated, summed over the model rows of the rated items
+    userPrefs = recommender.prefsOnUser[user]
+    scores = [(sum([model[item].get(candidate, 0) * rating for item, rating in userPrefs.items()]), candidate)
+              for candidate in recommender.itemList if candidate not in userPrefs]
+    return [item for score, item in sorted(scores, reverse = True)][0:topN]
+
+
+@pytest.mark.parametrize("ratings", [(1, 5), (-2, 3)])
+@pytest.mark.parametrize("topN", [None, 1, 5, 40])
+def test_itemBasedRecommendation(ratings, topN):
+    # With or without early termination, with or without a model, every user gets the exhaustive top-N;
+    # negative ratings fall back from early termination to the full scan
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(1, ratings = ratings))
+    model = recommender.buildModel(similarity.cosine, 6)
+    for user in recommender.prefsOnUser:
+        expected = scoreAll(recommender, user, model, topN)
+        assert recommender.Recommendation(user, model = model, topN = topN) == expected
+        assert recommender.Recommendation(user, model = model, topN = topN, earlyTermination = True) == expected
+        assert recommender.Recommendation(user, similarity.cosine, 6, topN = topN) == expected
+        assert recommender.Recommendation(user, similarity.cosine, 6, topN = topN, earlyTermination = True) == expected
+
+@pytest.mark.parametrize("topN", [None, 5])
+def test_itemBasedCompactModel(topN):
+    # A compact model gives the recommendations of the same similarities in dictionaries
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(2))
+    compact = recommender.buildModel(similarity.pearson, 6, precision = 16)
+    model = {item: compact[item] for item in compact}
+    for user in recommender.prefsOnUser:
+        assert recommender.Recommendation(user, model = compact, topN = topN) == recommender.Recommendation(user, model = model, topN = topN)
+        assert recommender.Recommendation(user, model = compact, topN = topN, earlyTermination = True) == \
+            recommender.Recommendation(user, model = model, topN = topN)
@@ -0,0 +1,161 @@
+import asyncio
+import random
+import threading
+
+import pytest
+
+import similarity
+from modelfile import NeighborModel
+from recommender import Backend, DataType, ItemBased, UserBased
+from serving import AsyncRecommender, Overloaded, RecommendationServer, RequestBatcher
+
+
+def makePrefs(seed, nUsers = 40, nItems = 30):
+    generator = random.Random(seed)
+    return {"u%d" % user: {"i%d" % item: float(generator.randint(1, 5)) for item in generator.sample(range(nItems), generator.randint(1, 10))}
+            for user in range(nUsers)}
+
+def makeServer(**options):
+    recommender = UserBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(2))
+    return RecommendationServer(recommender, recommender.buildModel(similarity.cosine, 5), depth = 5, **options)
+
+class BlockingRecommender(object):
+    # Recommendations which wait until `release` is set
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = []
+
+    def Recommendation(self, user, model = None, topN = 10, **options):
+        self.started.append(user)
+        self.release.wait(10)
+        return [user]
+
+
+def test_preloadedModelIsConvertedOnce(tmp_path, monkeypatch):
+    # The item-item matrix of a model loaded from a file is converted on the first request only
+    path = str(tmp_path / "model.bin")
+    built = ItemBased(DataType.Explicit, Backend.Sparse)
+    built.loadData(makePrefs(1))
+    built.buildModel(similarity.cosine, 5, pathDump = path)
+    expected = built.recommendBatch(list(built.prefsOnUser), 5, NeighborModel.load(path), withScores = True)
+
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(1))
+    model = recommender.buildModel(similarity.cosine, 5, pathDump = path)
+    assert recommender.model == None
+    conversions = []
+    toMatrix = type(model).toMatrix
+    monkeypatch.setattr(type(model), "toMatrix", lambda self, *args: conversions.append(self) or toMatrix(self, *args))
+    server = RecommendationServer(recommender, model, depth = 5)
+    for user in recommender.prefsOnUser:
+        assert server.getScores([user])[user] == expected[user]
+    assert len(conversions) == 1
+
+    # New items change the shape of the matrix, so it is converted again
+    server.addRatings({"u0": {"new": 3.0}})
+    server.getScores(["u0"])
+    assert len(conversions) == 2
+
+def test_lruEviction():
+    server = makeServer(cacheSize = 2)
+    expected = server.recommender.recommendBatch(["u0", "u1", "u2"], 5, server.model, withScores = True)
+    assert server.getScores(["u0", "u1"]) == {user: expected[user] for user in ["u0", "u1"]}
+    server.getScores(["u0"])            # u1 is now the least recently used
+    assert server.getScores(["u2"]) == {"u2": expected["u2"]}
+    assert list(server.cache) == ["u0", "u2"]
+    assert server.getStats() == {"Hits": 1, "Misses": 3, "Evictions": 1, "Expirations": 0, "Size": 2}
+    assert server.getScores(["u1"], 3) == {"u1": expected["u1"][0:3]}
+
+@pytest.mark.parametrize("ttl, hits, expirations", [(None, 1, 0), (3600, 1, 0), (0, 0, 1)])
+def test_ttl(ttl, hits, expirations):
+    server = makeServer(ttl = ttl)
+    server.getScores(["u0"])
+    server.getScores(["u0"])
+    stats = server.getStats()
+    assert (stats["Hits"], stats["Misses"], stats["Expirations"]) == (hits, 2 - hits, expirations)
+
+def test_addRatingsInvalidates():
+    # Users whose ratings change are scored again with the updated model; the others keep their entries
+    server = makeServer()
+    server.getScores(["u0", "u1"])
+    server.addRatings({"u0": {"i3": 5.0, "i40": 1.0}})
+    assert list(server.cache) == ["u1"]
+    assert server.model is server.recommender.model
+    assert server.getScores(["u0"]) == server.recommender.recommendBatch(["u0"], 5, server.model, withScores = True)
+    server.removeRatings({"u1": ["i3"]})
+    assert list(server.cache) == ["u0"]
+
+def test_batcherIsolatesFailures():
+    # A request for an unknown user fails alone, and the other requests of its batch are scored once
+    server = makeServer()
+    expected = server.recommender.recommendBatch(["u0", "u1"], 5, server.model)
+    batcher = RequestBatcher(server, maxDelay = 0.2)
+    try:
+        futures = [batcher.submit("u0", 5), batcher.submit("unknown", 5), batcher.submit("u1", 3)]
+        assert futures[0].result(10) == expected["u0"]
+        with pytest.raises(KeyError):
+            futures[1].result(10)
+        assert futures[2].result(10) == expected["u1"][0:3]
+    finally:
+        batcher.close()
+    assert server.getStats()["Misses"] == 2 and server.getStats()["Hits"] == 0
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_asyncRecommendations(tmp_path, processes):
+    # Threads and processes give the recommendations of Recommendation; process workers map the model file
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(3))
+    model = recommender.buildModel(similarity.cosine, 5, pathDump = str(tmp_path / "model.bin"), precision = 32)
+    users = list(recommender.prefsOnUser)[0:8]
+    facade = AsyncRecommender(recommender, model, nWorkers = 2, processes = processes)
+    async def recommendAll():
+        return await asyncio.gather(*[facade.recommend_async(user, 5) for user in users])
+    try:
+        assert asyncio.run(recommendAll()) == [recommender.Recommendation(user, model = model, topN = 5) for user in users]
+    finally:
+        facade.close()
+    assert facade.getPending() == 0
+
+def test_asyncTimeoutAndCancellation():
+    # A request timing out or cancelled while queued is dropped; the running one finishes in its worker
+    recommender = BlockingRecommender()
+    facade = AsyncRecommender(recommender, nWorkers = 1, maxPending = 3)
+    async def run():
+        running = asyncio.ensure_future(facade.recommend_async("running", timeout = 10))
+        await asyncio.sleep(0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await facade.recommend_async("timed out", timeout = 0.05)
+        queued = asyncio.ensure_future(facade.recommend_async("cancelled"))
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert facade.getPending() == 1
+        recommender.release.set()
+        return await running
+    try:
+        assert asyncio.run(run()) == ["running"]
+    finally:
+        recommender.release.set()
+        facade.close()
+    assert recommender.started == ["running"]
+    assert facade.getPending() == 0
+
+def test_asyncOverloaded():
+    # Requests beyond maxPending are rejected at once, and slots are freed as requests finish
+    recommender = BlockingRecommender()
+    facade = AsyncRecommender(recommender, nWorkers = 1, maxPending = 2)
+    async def run():
+        requests = [asyncio.ensure_future(facade.recommend_async(user)) for user in ["a", "b"]]
+        await asyncio.sleep(0.05)
+        with pytest.raises(Overloaded):
+            await facade.recommend_async("c")
+        recommender.release.set()
+        results = await asyncio.gather(*requests)
+        return results + [await facade.recommend_async("d")]
+    try:
+        assert asyncio.run(run()) == [["a"], ["b"], ["d"]]
+    finally:
+        recommender.release.set()
+        facade.close()
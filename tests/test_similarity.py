@@ -0,0 +1,90 @@
+from functools import partial
+import random
+
+import numpy as np
+import pytest
+
+import similarity
+from matrix import RatingMatrix, Statistics
+from similarity import CandidatePairs, getBlockMeasure
+
+MEASURES = [similarity.cosine, similarity.cosine_intersection, similarity.pearson,
+            partial(similarity.pearson, significanceWeighting = True), similarity.jaccard]
+
+
+def makePrefs(seed, nUsers = 30, nItems = 25, maxRatings = 10, unary = False):
+    # Some users have no rating and some rate every item alike, for the edge cases of the measures
+    generator = random.Random(seed)
+    prefs = {}
+    for user in range(nUsers):
+        items = generator.sample(range(nItems), generator.randint(0, maxRatings))
+        constant = float(generator.randint(1, 5)) if generator.random() < 0.1 else None
+        prefs["u%d" % user] = {"i%d" % item: 1.0 if unary else constant or float(generator.randint(1, 5)) for item in items}
+    return prefs
+
+def prepare(simMeasure, prefs, unary):
+    matrix = RatingMatrix.fromPrefs(prefs)
+    measure = getBlockMeasure(simMeasure, unary)
+    return matrix, measure, measure.prepare(matrix.entityMatrix(), Statistics(matrix))
+
+
+@pytest.mark.parametrize("simMeasure", MEASURES)
+@pytest.mark.parametrize("unary, maxRatings", [(False, 10), (True, 10), (True, 3)])
+def test_blockMatchesScalar(simMeasure, unary, maxRatings):
+    # Tiles of the block measures hold the similarities of the measures on dictionaries (dense unary rows use bitsets)
+    prefs = makePrefs(1, maxRatings = maxRatings, unary = unary)
+    matrix, measure, prepared = prepare(simMeasure, prefs, unary)
+    expected = np.array([[simMeasure(prefs.get(a, {}), prefs.get(b, {})) for b in matrix.userIds] for a in matrix.userIds])
+    assert np.allclose(measure.compute(prepared, prepared), expected, rtol = 1e-12, atol = 1e-12)
+
+@pytest.mark.parametrize("simMeasure", MEASURES)
+@pytest.mark.parametrize("unary", [False, True])
+def test_pairsMatchTile(simMeasure, unary):
+    # Similarities of candidate pairs are exactly those of the whole tile, between blocks of different rows as well
+    matrix, measure, prepared = prepare(simMeasure, makePrefs(2, unary = unary), unary)
+    rows = prepared.take(np.arange(0, len(prepared), 3))
+    tile = measure.compute(rows, prepared)
+    pairs = CandidatePairs(rows, prepared)
+    assert np.array_equal(measure.computePairs(rows, prepared, pairs), tile[pairs.rows, pairs.columns])
+    overlap = measure.overlap(rows, prepared)
+    assert np.array_equal(pairs.overlap(), overlap[pairs.rows, pairs.columns])
+    assert len(pairs) == np.count_nonzero(overlap)
+
+@pytest.mark.parametrize("simMeasure", MEASURES)
+@pytest.mark.parametrize("unary", [False, True])
+def test_updateMatchesPrepare(simMeasure, unary):
+    # Rows prepared again and appended by update give the block prepared from scratch
+    prefs = makePrefs(3, unary = unary)
+    matrix, measure, prepared = prepare(simMeasure, prefs, unary)
+    stats = Statistics(matrix)
+    users, items = matrix.setRatings([("u1", "i3", 1.0), ("u4", "i30", 1.0), ("new", "i0", 1.0)])
+    matrix.removeRatings([("u2", item) for item in prefs["u2"]])
+    users = np.union1d(users, [matrix.userIndex["u2"]])
+    stats.update(users)
+    X = matrix.entityMatrix()
+    updated = measure.update(prepared, X, users, stats)
+    expected = measure.prepare(X, stats)
+    assert sorted(updated.fields) == sorted(expected.fields)
+    for name, value in expected.fields.items():
+        if hasattr(value, "toarray"):
+            assert updated.fields[name].shape == value.shape
+            value, updatedValue = value.toarray(), updated.fields[name].toarray()
+        else:
+            updatedValue = updated.fields[name]
+        assert np.array_equal(updatedValue, value), name
+
+@pytest.mark.parametrize("simMeasure, prefs", [
+    (similarity.pearson, {"a": {"i1": 0.3, "i4": 0.2, "i0": 0.5, "i5": 0.5, "i3": -1.0},
+                          "b": {"i2": 0.2, "i0": 0.2, "i6": 1.0, "i5": 1.0, "i1": -1.0}}),
+    (similarity.cosine_intersection, {"a": {"i0": 0.7, "i3": -0.1, "i2": -0.7, "i1": -0.6},
+                                      "b": {"i3": -0.7, "i2": 0.1, "i0": 0.6, "i1": 0.7}}),
+    (similarity.cosine, {"a": {"i0": 0.7, "i3": -0.1, "i2": -0.7, "i1": -0.6},
+                         "b": {"i3": -0.7, "i2": 0.1, "i0": 0.6, "i1": 0.7}}),
+])
+def test_cancellingSumIsZero(simMeasure, prefs):
+    # A sum of products cancelling out gives exactly 0, as the measure on dictionaries does, whatever the order of the sum
+    assert simMeasure(prefs["a"], prefs["b"]) == 0
+    matrix, measure, prepared = prepare(simMeasure, prefs, False)
+    assert measure.compute(prepared, prepared)[0, 1] == 0
+    pairs = CandidatePairs(prepared, prepared)
+    assert measure.computePairs(prepared, prepared, pairs)[(pairs.rows == 0) & (pairs.columns == 1)].tolist() == [0]
@@ -0,0 +1,66 @@
+import gzip
+import random
+
+import numpy as np
+import pytest
+
+import tool
+
+
+def makeLines(seed, nLines = 200):
+    generator = random.Random(seed)
+    return ["user%d\titem%d\t%s" % (generator.randint(0, 30), generator.randint(0, 50), generator.choice(["1", "2.5", "0.1", "-3", "4"]))
+            for line in range(nLines)]
+
+def readPlain(lines):
+    # Reference parse of the lines with str.split
+    data = {}
+    for line in lines:
+        fields = line.split("\t")
+        if len(fields) >= 2:
+            data.setdefault(fields[0], {})[fields[1]] = float(fields[2]) if len(fields) > 2 else 1.0
+    return data
+
+def writeFile(path, lines, newline = "\n", compressed = False):
+    content = newline.join(lines).encode("utf-8") + newline.encode("utf-8")
+    with (gzip.open(path, "wb") if compressed else open(path, "wb")) as file:
+        file.write(content)
+    return str(path)
+
+
+@pytest.mark.parametrize("newline, compressed", [("\n", False), ("\r\n", False), ("\n", True), ("\r\n", True)])
+def test_loadData(tmp_path, newline, compressed):
+    lines = makeLines(1) + ["user1\titem99", "no fields", "", "user2\titem98\t2\textra"]
+    path = writeFile(tmp_path / "data.tsv", lines, newline, compressed)
+    assert tool.loadData(path) == readPlain(lines)
+
+@pytest.mark.parametrize("chunkSize", [1, 7, 64, 1 << 24])
+def test_chunkBoundaries(tmp_path, chunkSize):
+    # Lines split across chunks are parsed as a whole, including a last line without a newline
+    lines = makeLines(2)
+    path = tmp_path / "data.tsv"
+    path.write_bytes("\r\n".join(lines).encode("utf-8"))
+    expected = tool.loadColumns(str(path), chunkSize = len(lines) * 100, dtype = np.float64)
+    columns = tool.loadColumns(str(path), chunkSize = chunkSize, dtype = np.float64)
+    for column, expectedColumn in zip(columns, expected):
+        assert np.array_equal(column, expectedColumn)
+    assert len(columns[0]) == len(lines)
+
+def test_cacheKeepsRatings(tmp_path):
+    # The sidecar cache holds float64 ratings whatever dtype its writer asked for
+    lines = makeLines(3)
+    path = writeFile(tmp_path / "data.tsv", lines)
+    expected = readPlain(lines)
+    assert tool.loadColumns(path, cache = True)[2].dtype == np.float32
+    assert (tmp_path / "data.tsv.npz").exists()
+    assert tool.loadData(path, cache = True) == expected
+    matrix = tool.loadMatrix(path, cache = True, dtype = np.float32)
+    assert matrix.byUser.dtype == np.float32
+    assert tool.loadData(path, cache = True) == expected
+
+def test_cacheIsRefreshed(tmp_path):
+    # A changed input file is parsed again
+    path = writeFile(tmp_path / "data.tsv", ["a\tx\t1"])
+    assert tool.loadData(path, cache = True) == {"a": {"x": 1.0}}
+    writeFile(tmp_path / "data.tsv", ["a\tx\t1", "b\ty\t2"])
+    assert tool.loadData(path, cache = True) == {"a": {"x": 1.0}, "b": {"y": 2.0}}
@@ -0,0 +1,134 @@
+import copy
+import random
+
+import numpy as np
+import pytest
+
+import similarity
+import validation
+from matrix import RatingMatrix
+from recommender import Backend, DataType, ItemBased, UserBased
+from validation import CrossValidation, RatingStore
+
+
+def makePrefs(seed, nUsers = 20, nItems = 15):
+    generator = random.Random(seed)
+    return {"u%d" % user: {"i%d" % item: float(generator.randint(1, 5)) for item in generator.sample(range(nItems), generator.randint(1, 7))}
+            for user in range(nUsers)}
+
+def assertSameMatrix(matrix, expected):
+    assert matrix.userIds == expected.userIds and matrix.itemIds == expected.itemIds
+    for name in ("byUser", "byItem"):
+        assert (getattr(matrix, name) != getattr(expected, name)).nnz == 0, name
+
+
+def test_folds():
+    # The ratings of a user are split into runs of int(# of ratings / nFolds) in order, and the last fold takes the remainder
+    prefs = {"a": {"i%d" % item: 1.0 for item in range(7)}, "b": {"i0": 2.0, "i1": 3.0}, "c": {}}
+    store = RatingStore.fromPrefs(prefs)
+    assert store.getFolds(3).tolist() == [0, 0, 1, 1, 2, 2, 2] + [2, 2]
+
+@pytest.mark.parametrize("nFolds", [2, 5])
+def test_foldMasks(nFolds):
+    # Training and test sets selected with masks are the dictionaries split by KFoldSplit
+    prefs = makePrefs(1)
+    store = RatingStore.fromPrefs(prefs)
+    folds = store.getFolds(nFolds)
+    for fold in range(nFolds):
+        trainSet, testSet = CrossValidation().KFoldSplit(prefs, fold, nFolds)
+        assert sum(len(ratings) for ratings in testSet.values()) == np.count_nonzero(folds == fold)
+        assert store.toPrefs(folds != fold) == trainSet and store.toPrefs(folds == fold) == testSet
+        for user, ratings in prefs.items():
+            assert {**trainSet[user], **testSet[user]} == ratings
+        assertSameMatrix(store.toMatrix(folds != fold), RatingMatrix.fromPrefs(trainSet))
+
+@pytest.mark.parametrize("recommenderType", [UserBased, ItemBased])
+def test_parallelKFold(recommenderType):
+    # Folds evaluated in worker processes give the results of the serial evaluation
+    prefs = makePrefs(2)
+    recommender = recommenderType(DataType.Explicit, Backend.Sparse)
+    serial = CrossValidation().KFold(prefs, recommender, similarity.cosine, 5, topN = 5, nFolds = 3)
+    assert CrossValidation().KFold(prefs, recommender, similarity.cosine, 5, topN = 5, nFolds = 3, nJobs = 2) == serial
+
+@pytest.mark.parametrize("recommenderType", [UserBased, ItemBased])
+def test_leaveOneOut(recommenderType):
+    # Removing, evaluating and restoring each rating gives the evaluations of models rebuilt without it,
+    # and leaves the recommender as it was
+    prefs = makePrefs(3, nUsers = 12, nItems = 10)
+    recommender = recommenderType(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(copy.deepcopy(prefs))
+    model = recommender.buildModel(similarity.cosine, 4)
+    result = CrossValidation().LeaveOneOut(prefs, recommender, model = model, topN = 3)
+
+    evaluations = []
+    for user in prefs:
+        for item in prefs[user]:
+            trainSet, testSet = CrossValidation().LeaveKOutSplit(copy.deepcopy(prefs), user, [item])
+            rebuilt = recommenderType(DataType.Explicit, Backend.Sparse)
+            rebuilt.loadData(trainSet)
+            evaluations.append(validation.evaluateRecommender(testSet, rebuilt, model = rebuilt.buildModel(similarity.cosine, 4), topN = 3))
+    assert result == pytest.approx(validation.averageResults(evaluations), abs = 1e-12)
+
+    baseline = recommenderType(DataType.Explicit, Backend.Sparse)
+    baseline.loadData(RatingStore.fromPrefs(prefs).toMatrix())
+    baseline.buildModel(similarity.cosine, 4)
+    assertSameMatrix(recommender.matrix, baseline.matrix)
+    for row, (neighbors, similarities) in baseline.neighborLists.items():
+        assert np.array_equal(recommender.neighborLists[row][0], neighbors)
+        assert np.array_equal(recommender.neighborLists[row][1], similarities)
+
+    assert CrossValidation().LeaveOneOut(prefs, recommender, model = model, topN = 3, nJobs = 2) == result
+
+def test_metrics():
+    # Metrics of hand-picked hits among the top-3 recommendations
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(4))
+    model = recommender.buildModel(similarity.cosine, 5)
+    recommendations = recommender.recommendBatch(["u0", "u1", "u2"], topN = 3, model = model)
+    missed = lambda user: next(item for item in recommender.matrix.itemIds
+                               if item not in recommendations[user] and item not in recommender.prefsOnUser[user])
+    testSet = {"u0": {recommendations["u0"][0]: 5.0, recommendations["u0"][2]: 4.0, "unseen": 3.0},    # Hits at ranks 1 and 3
+               "u1": {recommendations["u1"][1]: 5.0},                                                   # Hit at rank 2
+               "u2": {missed("u2"): 4.0}}                                                                # No hit
+    evaluation = validation.evaluateUsers(testSet, recommender, model = model, topN = 3)
+    assert evaluation.users == ["u0", "u1", "u2"]
+    expected = {
+        "Precision": [2 / 3, 1 / 3, 0],
+        "Recall": [2 / 3, 1, 0],
+        "F1-score": [2 / 3, 2 * (1 / 3) / (1 / 3 + 1), 0],
+        "Hit-rate": [2, 1, 0],
+        "NDCG": [(1 + 1 / np.log2(4)) / (1 + 1 / np.log2(3) + 1 / np.log2(4)), 1 / np.log2(3), 0],
+        "MAP": [(1 / 1 + 2 / 3) / 3, (1 / 2) / 1, 0],
+        "MRR": [1, 1 / 2, 0],
+    }
+    for metric, values in expected.items():
+        assert evaluation[metric] == pytest.approx(values, abs = 1e-12), metric
+    recommended = {item for user in testSet for item in recommendations[user]}
+    assert evaluation.coverage == len(recommended) / len(recommender.getRatedItems())
+    summary = evaluation.summary()
+    assert summary["NDCG"] == pytest.approx(np.mean(expected["NDCG"]), abs = 1e-12) and summary["Coverage"] == evaluation.coverage
+
+def test_metricsWithoutTopN():
+    # Without topN, precision is relative to the length of each recommendation list, and every test item can be found
+    recommender = ItemBased(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(makePrefs(5))
+    model = recommender.buildModel(similarity.cosine, 5)
+    recommendations = recommender.recommendBatch(["u0"], model = model)["u0"]
+    evaluation = validation.evaluateUsers({"u0": {recommendations[-1]: 1.0}}, recommender, model = model)
+    assert evaluation["Precision"].tolist() == [1 / len(recommendations)]
+    assert evaluation["MRR"].tolist() == [1 / len(recommendations)]
+    assert evaluation["Recall"].tolist() == [1]
+
+@pytest.mark.parametrize("recommenderType", [UserBased, ItemBased])
+def test_parallelEvaluation(recommenderType):
+    # Shards evaluated in worker processes give the metrics of the serial evaluation
+    prefs = makePrefs(6, nUsers = 40)
+    trainSet, testSet = CrossValidation().KFoldSplit(prefs, 0, 4)
+    recommender = recommenderType(DataType.Explicit, Backend.Sparse)
+    recommender.loadData(trainSet)
+    model = recommender.buildModel(similarity.cosine, 5)
+    serial = validation.evaluateUsers(testSet, recommender, model = model, topN = 5, batchSize = 7)
+    parallel = validation.evaluateUsers(testSet, recommender, model = model, topN = 5, nJobs = 2, batchSize = 7)
+    assert parallel.users == serial.users and parallel.coverage == serial.coverage
+    for metric in validation.Evaluation.metrics:
+        assert np.array_equal(parallel[metric], serial[metric]), metric